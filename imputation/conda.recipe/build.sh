@@ -6,11 +6,16 @@ set -e
 wget -P $PREFIX/lib/impute https://f000.backblazeb2.com/file/bioinf/bert_bact_150_flatten.h5
 
 mkdir -p $PREFIX/bin
+# Helper modules and R scripts, kept apart from those of the other packages
+mkdir -p $PREFIX/share/imputation
 
 # Install the Python script
 echo "Installing the scripts..."
 cp $SRC_DIR/impute.py $PREFIX/bin/impute
-cp $SRC_DIR/impute.r $PREFIX/bin/impute.r
+cp $SRC_DIR/impute.r $PREFIX/share/imputation/impute.r
+cp $SRC_DIR/r_worker.py $PREFIX/share/imputation/r_worker.py
+cp $SRC_DIR/metrics.py $PREFIX/share/imputation/metrics.py
+cp $SRC_DIR/fasta_shards.py $PREFIX/share/imputation/fasta_shards.py
 
 # Make the script executable
 chmod +x $PREFIX/bin/impute
@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import numpy as np
+
+def index_fasta(input):
+    """
+    Find the records of a FASTA file.
+
+    Returns:
+    - offsets: Byte offset of every record header, followed by the file size.
+    - bases: Number of bases of every record.
+    """
+    offsets, bases = [], []
+    position = 0
+    with open(input, 'rb') as file:
+        for line in file:
+            if line.startswith(b'>'):
+                offsets.append(position)
+                bases.append(0)
+            elif bases:
+                bases[-1] += len(line.rstrip())
+            position += len(line)
+    offsets.append(position)
+    return np.array(offsets, dtype=np.int64), np.array(bases, dtype=np.int64)
+
+def split_fasta(input, workers, shard_dir):
+    """
+    Split a FASTA file into at most `workers` shards of consecutive records with about
+    the same number of bases each. Shards keep the record order, so concatenating their
+    predictions gives the order of the input.
+
+    Returns:
+    - shards: Paths of the shard FASTA files, in input order.
+    """
+    offsets, bases = index_fasta(input)
+    if bases.size == 0:
+        raise ValueError(f"No FASTA records found in {input}")
+
+    # Cut where the cumulative base count crosses multiples of total / workers
+    cumulative = np.cumsum(bases)
+    targets = cumulative[-1] * np.arange(1, workers) / workers
+    cuts = np.unique(np.r_[0, np.searchsorted(cumulative, targets, side='left') + 1, bases.size])
+
+    shards = []
+    with open(input, 'rb') as file:
+        for i, (first, last) in enumerate(zip(cuts[:-1], cuts[1:])):
+            shard = os.path.join(shard_dir, f"shard_{i}.fasta")
+            file.seek(offsets[first])
+            with open(shard, 'wb') as out:
+                remaining = offsets[last] - offsets[first]
+                while remaining > 0:
+                    chunk = file.read(min(remaining, 1 << 24))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+            shards.append(shard)
+    return shards
+
+def concatenate_shards(shard_outputs, output, header=False):
+    """
+    Concatenate the outputs of the shards in order. With header, the files start with
+    a header line that is only kept from the first one.
+    """
+    with open(output, 'wb') as out:
+        for i, shard_output in enumerate(shard_outputs):
+            with open(shard_output, 'rb') as file:
+                if header and i > 0:
+                    file.readline()
+                shutil.copyfileobj(file, out)
@@ -1,26 +1,122 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import shutil
 import subprocess
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-def run_prediction(input='test.fasta', output='imputed.fasta', batch_size=32, threshold=0.5):
+# The conda recipe installs the helper modules and R scripts into share/imputation, so
+# they do not clash with those of other packages in $PREFIX/bin. In the source tree
+# they are next to this script.
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "imputation")
+if not os.path.isdir(PACKAGE_DIR):
+    PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PACKAGE_DIR)
+
+from fasta_shards import concatenate_shards, split_fasta
+from metrics import Metrics, add_metrics_arguments, r_metrics_file
+from r_worker import RWorker, serve, submit
+
+# Define the path to your R script
+R_SCRIPT_PATH = os.path.join(PACKAGE_DIR, "impute.r")
+
+def start_worker(env=None):
+    """
+    Start a persistent R process with the model loaded. Pass it to run_prediction to
+    impute many files without loading R, TensorFlow and the model again.
+    """
+    return RWorker(["Rscript", R_SCRIPT_PATH], env=env)
+
+def run_prediction(input='test.fasta', output='imputed.fasta', batch_size=32, threshold=0.5, worker=None,
+                   all_windows=False, stats=None, env=None, metrics=None):
     """
     Function to run the R script for virus imputation using the specified arguments.
+    The job is sent to `worker` if given, either a worker from start_worker or the
+    socket path of a running `impute --serve`.
+
+    The records of the input are imputed one at a time and appended to the output, and
+    the length, ambiguous and imputed nucleotides of every record are written to the
+    `stats` TSV file if given. Only the windows that contain an N are predicted,
+    all_windows=True predicts the whole sequence instead. Both give the same imputed
+    sequence. The stage timings of the R script are added to `metrics` if given.
     """
+    with r_metrics_file(metrics, input=os.path.basename(input)) as metrics_file:
+        if isinstance(worker, RWorker):
+            return worker.run(input=input, output=output, threshold=threshold, batch_size=batch_size,
+                              all_windows=all_windows, stats=stats, metrics=metrics_file)
+        if worker is not None:
+            return submit(worker, input=os.path.abspath(input), output=os.path.abspath(output), threshold=threshold,
+                          batch_size=batch_size, all_windows=all_windows,
+                          stats=os.path.abspath(stats) if stats else None, metrics=metrics_file)
 
-    # Define the path to your R script
-    r_script_path = os.path.join(os.path.dirname(__file__), "impute.r")
+        # Define the command that you would use to run the R script from the command line
+        command = ["Rscript", R_SCRIPT_PATH, 
+               '--input', str(input),
+               '--output', str(output),
+               '--threshold', str(threshold),
+               '--batch_size', str(batch_size),
+               '--all_windows', str(all_windows)]
+        if stats:
+            command += ['--stats', str(stats)]
+        if metrics_file:
+            command += ['--metrics', metrics_file]
 
-    # Define the command that you would use to run the R script from the command line
-    command = ["Rscript", r_script_path, 
-           '--input', str(input),
-           '--output', str(output),
-           '--threshold', str(threshold),
-           '--batch_size', str(batch_size)]
+        # Run the command
+        return subprocess.run(command, env=env)
+
+def run_parallel_imputation(input='test.fasta', output='imputed.fasta', batch_size=32, threshold=0.5, workers=2,
+                            threads=None, all_windows=False, stats=None, metrics=None):
+    """
+    Impute a multi-record FASTA file with several R processes in parallel.
 
-    # Run the command
-    subprocess.run(command)
+    The records are split into shards of consecutive records with about the same
+    number of bases, one per worker. Records are imputed independently, so the merged
+    output, written in input order, is the same as that of a single run.
+
+    Parameters:
+    - workers: Number of parallel R processes.
+    - threads: TensorFlow threads per process, the CPUs divided by workers if None.
+    - metrics: Metrics the split, imputation and merge stages, and the stages of
+      every R process, are recorded in.
+    """
+    metrics = metrics or Metrics()
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    env = dict(os.environ,
+               TF_NUM_INTRAOP_THREADS=str(threads),
+               TF_NUM_INTEROP_THREADS="1",
+               OMP_NUM_THREADS=str(threads))
+
+    shard_dir = tempfile.mkdtemp(prefix="impute_")
+    try:
+        with metrics.stage("split") as stage:
+            shards = split_fasta(input, workers, shard_dir)
+            stage["rows"] = len(shards)
+        shard_outputs = [shard[:-len(".fasta")] + "_imputed.fasta" for shard in shards]
+        shard_stats = [shard[:-len(".fasta")] + "_stats.tsv" for shard in shards]
+        print(f"Imputing {len(shards)} shards with {threads} threads each")
+
+        def impute(shard, shard_output, shard_stat):
+            return run_prediction(input=shard, output=shard_output, batch_size=batch_size, threshold=threshold,
+                                  all_windows=all_windows, stats=shard_stat if stats else None, env=env,
+                                  metrics=metrics)
+
+        with metrics.stage("imputation", rows=len(shards)), ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(impute, shards, shard_outputs, shard_stats))
+
+        failed = [shard for shard, result in zip(shards, results) if result.returncode != 0]
+        if failed:
+            raise RuntimeError(f"Imputation failed for {len(failed)} of {len(shards)} shards")
+
+        with metrics.stage("merge"):
+            concatenate_shards(shard_outputs, output)
+            if stats:
+                concatenate_shards(shard_stats, stats, header=True)
+        print(f"Wrote imputed sequences to {output}")
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
 
 if __name__ == "__main__":
 
@@ -33,7 +129,38 @@ if __name__ == "__main__":
                         help='Probability threshold at which the imputation will occur.')
     parser.add_argument('-b', '--batch_size', type=int, default=32,
                         help='Number of samples processed in one batch.')
+    parser.add_argument('--stats', type=str,
+                        help='TSV file for the length, ambiguous and imputed nucleotides of every record.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of parallel imputation processes. Records are split into shards of similar base count. '
+                             'Can not be combined with --worker or --serve.')
+    parser.add_argument('--threads', type=int,
+                        help='TensorFlow threads per worker (default: CPUs divided by workers).')
+    parser.add_argument('--all_windows', action='store_true',
+                        help='Predict every window of the sequence instead of only the windows with an N.')
+    parser.add_argument('--serve', type=str, metavar='SOCKET',
+                        help='Load the model once and impute the jobs sent to this local socket until interrupted.')
+    parser.add_argument('--worker', type=str, metavar='SOCKET',
+                        help='Send the imputation to the model kept loaded by a running impute --serve.')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    # A running --serve has a single model process, it can not split the input into shards
+    if args.workers > 1 and (args.worker or args.serve):
+        parser.error("--workers can not be combined with --worker or --serve")
+    metrics = Metrics("impute")
+
+    if args.serve:
+        serve(start_worker(), args.serve)
+    elif args.workers > 1:
+        run_parallel_imputation(input=args.input, output=args.output, batch_size=args.batch_size,
+                                threshold=args.threshold, workers=args.workers, threads=args.threads,
+                                all_windows=args.all_windows, stats=args.stats, metrics=metrics)
+    else:
+        with metrics.stage("imputation"):
+            run_prediction(input=args.input, output=args.output, threshold=args.threshold,
+                           batch_size=args.batch_size, worker=args.worker, all_windows=args.all_windows,
+                           stats=args.stats, metrics=metrics)
 
-    run_prediction(input=args.input, output=args.output, threshold=args.threshold, batch_size=args.batch_size)
+    if not args.serve:
+        metrics.report(args.profile, args.metrics_json)
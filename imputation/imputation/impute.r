@@ -24,234 +24,244 @@ option_list <- list(
   make_option(c("-t", "--threshold"), type = "numeric", default = 0.5,
               help = "Threshold [default %default]", metavar = "number"),
   make_option(c("-b", "--batch_size"), type = "integer", default = 32,
-              help = "Number of samples processed in one batch [default %default].", metavar = "number")
+              help = "Number of samples processed in one batch [default %default].", metavar = "number"),
+  make_option(c("--stats"), type = "character", default = NULL,
+              help = "Write the length, ambiguous and imputed nucleotides of every record to this TSV file."),
+  make_option(c("--all_windows"), type = "logical", default = FALSE,
+              help = "Predict every window of the sequence, not only those with an ambiguous nucleotide [default %default]."),
+  make_option(c("--metrics"), type = "character", default = NULL,
+              help = "Append the wall time, rows, bases and peak memory of every stage to this file."),
+  make_option(c("--worker"), action = "store_true", default = FALSE,
+              help = "Keep the model loaded and run jobs read from stdin, one tab-separated command line per line.")
 )
 
 # Parse command line arguments
 opt_parser <- OptionParser(option_list = option_list)
 opt <- parse_args(opt_parser)
+
+peak_rss_mb <- function() {
+  # Peak resident memory of the R process, from /proc on Linux
+  status <- tryCatch(readLines("/proc/self/status"), error = function(e) character(0))
+  hwm <- grep("^VmHWM:", status, value = TRUE)
+  if (length(hwm) == 0) return(NA)
+  as.numeric(gsub("[^0-9]", "", hwm)) / 1024
+}
+
+write_metric <- function(file, stage, seconds, rows = NA, bases = NA) {
+  # One tab-separated line per stage, collected by the Python wrapper for --profile
+  if (is.null(file)) return(invisible(NULL))
+  cat(paste(stage, round(seconds, 4), rows, bases, round(peak_rss_mb(), 1), sep = "\t"), "\n",
+      sep = "", file = file, append = TRUE)
+}
+
+elapsed <- function(since) proc.time()[["elapsed"]] - since
+
 # Define paths
 message(paste0(Sys.getenv("CONDA_PREFIX"), "/lib/impute/bert_bact_150_flatten.h5"))
 model_path <- paste0(Sys.getenv("CONDA_PREFIX"), "/lib/impute/bert_bact_150_flatten.h5")
-tmp_file <- tempfile(fileext = ".h5")
 
 # Validate the model and annotation paths
 if (!file.exists(model_path)) stop("Model file not found")
 
 # Load model and annotations
 message("Loading model and processing file")
+load_started <- proc.time()[["elapsed"]]
 model <- load_cp(model_path)
-# Predict
-message("Predicting sequence")
-
-sequence <- microseq::readFasta(opt$input)$Sequence
-len <- nchar(sequence)
+maxlen <- 150
+write_metric(opt$metrics, "model load", elapsed(load_started))
 
-#### start prediction
+serve_jobs <- function(opt_parser, run_job) {
+  # Status lines on stdout tell the Python wrapper when the worker is ready and
+  # when each job is done, the messages of the jobs go to stderr
+  con <- file("stdin")
+  open(con)
+  on.exit(close(con), add = TRUE)
+  cat("@@worker ready\n")
+  flush(stdout())
+  while (length(line <- readLines(con, n = 1)) > 0) {
+    status <- tryCatch({
+      job <- parse_args(opt_parser, args = strsplit(line, "\t", fixed = TRUE)[[1]])
+      run_job(job)
+      "@@worker done"
+    }, error = function(e) paste("@@worker error", gsub("\n", " ", conditionMessage(e))))
+    cat(status, "\n", sep = "")
+    flush(stdout())
+  }
+}
 
-maxlen <- 150
-message("Processing FASTA file")
-pred <- predict_model(vocabulary = c("a", "c", "g", "t", "n"),
-                      output_format = "one_seq",
-                      model = model,
-                      layer_name = "flatten",
-                      sequence = sequence,
-                      round_digits = 4,
-                      filename = NULL,
-                      step = maxlen,
-                      batch_size = 512,
-                      verbose = FALSE,
-                      return_states = TRUE,
-                      padding = "standard",
-                      mode = "label",
-                      format = "fasta", 
-                      return_int = TRUE)
+for_each_record <- function(path, callback, block_size = 100000) {
+  # Stream a FASTA file and call callback(header, sequence) for each record, so
+  # only one record is held in memory
+  con <- file(path, "r")
+  on.exit(close(con), add = TRUE)
+  header <- NULL
+  lines_of_record <- character(0)
+  emit <- function() {
+    if (!is.null(header)) callback(header, gsub("\\s", "", paste0(lines_of_record, collapse = "")))
+  }
+  while (length(lines <- readLines(con, n = block_size)) > 0) {
+    starts <- which(startsWith(lines, ">"))
+    ends <- c(starts[-1] - 1, length(lines))
+    # Lines before the first header continue the record of the previous block
+    continued <- if (length(starts) > 0) starts[1] - 1 else length(lines)
+    lines_of_record <- c(lines_of_record, lines[seq_len(continued)])
+    for (i in seq_along(starts)) {
+      emit()
+      header <- substring(lines[starts[i]], 2)
+      lines_of_record <- lines[seq.int(starts[i] + 1, length.out = ends[i] - starts[i])]
+    }
+  }
+  emit()
+}
 
+predict_windows <- function(sequence, batch_size) {
+  # States of the consecutive maxlen windows of a sequence, one row per window
+  # with the 4 nucleotide probabilities of every position
+  predict_model(vocabulary = c("a", "c", "g", "t", "n"),
+                output_format = "one_seq",
+                model = model,
+                layer_name = "flatten",
+                sequence = sequence,
+                round_digits = 4,
+                filename = NULL,
+                step = maxlen,
+                batch_size = batch_size,
+                verbose = FALSE,
+                return_states = TRUE,
+                padding = "standard",
+                mode = "label",
+                format = "fasta",
+                return_int = TRUE)$states
+}
 
-if (len > maxlen) {
-  pred1 <- predict_model(vocabulary = c("a", "c", "g", "t", "n"),
-                      output_format = "one_seq",
-                      model = model,
-                      layer_name = "flatten",
-                      sequence = substr(sequence, len - maxlen + 1, len),
-                      round_digits = 4,
-                      filename = NULL,
-                      step = maxlen,
-                      batch_size = 4,
-                      verbose = FALSE,
-                      return_states = TRUE,
-                      padding = "standard",
-                      mode = "label",
-                      format = "fasta",
-                      return_int = TRUE)
-} else{
-  k <- (maxlen - len) * 4
+locate_positions <- function(n_positions, len) {
+  # Window of every position, as in a full pass: the consecutive maxlen windows,
+  # 0 for the positions after the last full window, which are predicted from the
+  # last maxlen bases, and 1 for a sequence shorter than maxlen, which is padded
+  # at the start. offset is the position within its window.
+  if (len <= maxlen) {
+    return(list(window = rep(1, length(n_positions)), offset = n_positions + maxlen - len))
+  }
+  last_pred <- (len %/% maxlen) * maxlen
+  window <- ifelse(n_positions <= last_pred, (n_positions - 1) %/% maxlen + 1, 0)
+  offset <- ifelse(window > 0, (n_positions - 1) %% maxlen + 1, n_positions - (len - maxlen))
+  list(window = window, offset = offset)
 }
 
-num_of_pred <- len %/% maxlen
-last_pred <- num_of_pred * maxlen
-last_piece <- len %% maxlen
-last_addition <- (maxlen - last_piece) * 4
-n_positions <- which(strsplit(sequence, "")[[1]] == "N")
-orig_ambigous_n <- length(which(strsplit(sequence, "")[[1]] == "N"))
-message(paste0("Found ", length(n_positions), " ambiguous nucleotides in the file"))
+predict_positions <- function(sequence, n_positions, all_windows = FALSE) {
+  # Predict the windows holding the ambiguous positions and return the row of
+  # the states of every position. Only the windows with an N are predicted
+  # unless all_windows is set; each window is predicted on its own, so the
+  # states are the same either way.
+  len <- nchar(sequence)
+  located <- locate_positions(n_positions, len)
+  window <- located$window
+  tail_piece <- substr(sequence, len - maxlen + 1, len)
 
-theshold <- opt$threshold
+  if (len <= maxlen) {
+    states <- predict_windows(sequence, 512)
+    rows <- window
+  } else if (all_windows) {
+    states <- predict_windows(sequence, 512)
+    if (any(window == 0)) states <- rbind(states, predict_windows(tail_piece, 4))
+    rows <- ifelse(window > 0, window, nrow(states))
+  } else {
+    needed <- sort(unique(window[window > 0]))
+    starts <- (needed - 1) * maxlen + 1
+    pieces <- substring(sequence, starts, starts + maxlen - 1)
+    if (any(window == 0)) pieces <- c(pieces, tail_piece)
+    message(paste0("Predicting ", length(pieces), " of ", len %/% maxlen + (len %% maxlen > 0),
+                   " windows"))
+    # The windows are joined so they are predicted in batches of the same maxlen windows
+    states <- predict_windows(paste0(pieces, collapse = ""), 512)
+    rows <- ifelse(window > 0, match(window, needed), length(pieces))
+  }
+  list(states = states, rows = rows, offset = located$offset)
+}
 
-i <- 1
-if (len > maxlen) {
-  while (i <= length(n_positions)) {
-    j <- n_positions[i]
-    j_rem_maxlen <- ((j - 1) %% maxlen) + 1
-    if  (j <= last_pred) {
-        a <- which.max(pred$state[((j - 1) %/% maxlen) + 1,(j_rem_maxlen * 4 - 3):(j_rem_maxlen * 4)])
-        a_prob <- max(pred$state[((j - 1) %/% maxlen) + 1,(j_rem_maxlen * 4 - 3):(j_rem_maxlen * 4)])
+impute_sequence <- function(sequence, opt) {
+  # Impute the ambiguous nucleotides of one sequence whose probability reaches the
+  # threshold. Returns the imputed sequence and the number of Ns found and imputed.
+  nucleotides <- strsplit(sequence, "")[[1]]
+  n_positions <- which(nucleotides == "N")
+  message(paste0("Found ", length(n_positions), " ambiguous nucleotides in the record"))
+  if (length(n_positions) == 0) {
+    return(list(sequence = sequence, found = 0, imputed = 0))
+  }
 
-      if (a == 1){
-          
-        if (a_prob >= theshold) {
-            substring(sequence, j) <- "A"
-             message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'A' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-        } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-        }
-          
-      } else if (a == 2){
-      
-        if (a_prob >= theshold) {
-            substring(sequence, j) <- "C"
-                            message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'C' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-        } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-        }
-          
-      } else if (a == 3){
-       
-        if (a_prob >= theshold) {
-            substring(sequence, j) <- "G"
-                            message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'G' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-        } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-        }
-          
-      } else if (a == 4){
-        
-        if (a_prob >= theshold) {
-            substring(sequence, j) <- "T"
-                            message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'A' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-        } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-        }
-          
-      } 
-    } else {
-      a = which.max(pred1$state[1,(last_addition + 
-                                   j_rem_maxlen * 4 - 3):(last_addition + j_rem_maxlen * 4)])
-      a_prob = which.max(pred1$state[1,(last_addition + 
-                                        j_rem_maxlen * 4 - 3):(last_addition + j_rem_maxlen * 4)])
+  pred <- predict_positions(sequence, n_positions, opt$all_windows)
 
-      if (a == 1){
-           
-            if (a_prob >= theshold) {
-                substring(sequence, j) <- "A"
-                  message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'A' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-            } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-            }
-          
-          
-      }else if (a == 2){
-       
-          
-            if (a_prob >= theshold) {
-                substring(sequence, j) <- "C"
-                   message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'C' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-            } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-            }
+  # Probabilities of A, C, G and T at every ambiguous position, one row each
+  columns <- pred$offset * 4
+  probs <- matrix(pred$states[cbind(rep(pred$rows, 4), rep(columns, 4) - rep(3:0, each = length(columns)))],
+                  ncol = 4)
+  a <- max.col(probs, ties.method = "first")
+  a_prob <- probs[cbind(seq_along(a), a)]
+  imputed <- a_prob >= opt$threshold
+  predicted <- c("A", "C", "G", "T")[a]
 
-      }else if (a == 3){
-          
-          if (a_prob >= theshold) {
-            substring(sequence, j) <- "G"
-               message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'G' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-        } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-        }
-          
-      }else if (a == 4){
+  message(paste(ifelse(imputed,
+                       paste0("Position ", n_positions, ": Imputing nucleotide 'N' with '", predicted,
+                              "' (probability ", round(a_prob, digits = 2) * 100, "%)"),
+                       paste0("Position ", n_positions,
+                              ": Skipping ambiguous nucleotide 'N' since no probability is above threshold")),
+                collapse = "\n"))
+  nucleotides[n_positions[imputed]] <- predicted[imputed]
+  list(sequence = paste0(nucleotides, collapse = ""), found = length(n_positions), imputed = sum(imputed))
+}
 
-          if (a_prob >= theshold) {
-            substring(sequence, j) <- "T"
-               message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'T' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-        } else {
-                 message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-        }
-      }
-    } 
-  i <- i + 1
+impute_file <- function(opt) {
+  # Impute the records of the input one at a time and append each one to the
+  # output, so only one record is held in memory
+  if (!file.exists(opt$input)) stop("Input file not found")
+  out <- file(opt$output, "w")
+  on.exit(close(out), add = TRUE)
+  if (!is.null(opt$stats)) {
+    writeLines(paste("record", "length", "ambiguous", "imputed", sep = "\t"), opt$stats)
   }
-} else {
-  while (i <= length(n_positions)) {
-    j <- n_positions[i]
-    j_rem_maxlen <- ((j - 1) %% maxlen) + 1
-    a <- which.max(pred$state[1,(k + j_rem_maxlen * 4 - 3):(k + j_rem_maxlen * 4)])
-    a_prob <- which.max(pred$state[1,(k+j_rem_maxlen * 4 - 3):(k+j_rem_maxlen * 4)])
-    if (a == 1){
-         if (a_prob >= theshold) {
-               substring(sequence, j) <- "A"
-                 message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'A' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-         } else {
-           message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-         }
-    
-    }else if (a == 2) {
-            if (a_prob >= theshold) {
-               substring(sequence, j) <- "C"
-                 message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'C' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-         } else {
-           message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-         }
-        
-    }else if (a == 3) {
-           if (a_prob >= theshold) {
-               substring(sequence, j) <- "G"
-                 message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'G' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-         } else {
-           message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-         }
-        
-    }else if (a == 4) {
-            if (a_prob >= theshold) {
-               substring(sequence, j) <- "T"
-                 message(paste0("Position " , j, ": Imputing nucleotide 'N' with 'T' (probability ",
-                       round(a_prob, digits = 2) * 100, "%)"))
-         } else {
-           message(paste0("Position " , j, ": Skipping ambiguous nucleotide 'N' since no probability is above threshold"))
-         }
-        
+
+  records <- 0
+  bases <- 0
+  orig_ambigous_n <- 0
+  imputed_n <- 0
+  inference_seconds <- 0
+  write_seconds <- 0
+  started <- proc.time()[["elapsed"]]
+  for_each_record(opt$input, function(header, sequence) {
+    id <- sub("\\s.*", "", header)
+    message(paste0("Imputing ", id, " (", nchar(sequence), " bp)"))
+    inference_started <- proc.time()[["elapsed"]]
+    result <- impute_sequence(sequence, opt)
+    inference_seconds <<- inference_seconds + elapsed(inference_started)
+
+    write_started <- proc.time()[["elapsed"]]
+    writeLines(c(paste0(">", header), result$sequence), out)
+    flush(out)
+    if (!is.null(opt$stats)) {
+      cat(paste(id, nchar(sequence), result$found, result$imputed, sep = "\t"), "\n", sep = "",
+          file = opt$stats, append = TRUE)
     }
-  i <- i + 1
-  }
-}
+    write_seconds <<- write_seconds + elapsed(write_started)
+    message(paste0("Imputed ", result$imputed, " of ", result$found, " ambiguous nucleotides in ", id))
+    records <<- records + 1
+    bases <<- bases + nchar(sequence)
+    orig_ambigous_n <<- orig_ambigous_n + result$found
+    imputed_n <<- imputed_n + result$imputed
+  })
 
-### end prediction
-seq <- microseq::readFasta(opt$input)
-seq$Sequence <- sequence
-microseq::writeFasta(seq, opt$output)
-new_ambigous_n <- length(which(strsplit(sequence, "")[[1]] == "N"))
+  # Reading the records is what remains of the streaming loop
+  write_metric(opt$metrics, "fasta parse", elapsed(started) - inference_seconds - write_seconds,
+               rows = records, bases = bases)
+  write_metric(opt$metrics, "inference", inference_seconds, rows = orig_ambigous_n, bases = bases)
+  write_metric(opt$metrics, "write", write_seconds, rows = records, bases = bases)
 
-message(paste0("Successfully imputed ", orig_ambigous_n - new_ambigous_n,
-               " positions out of ", orig_ambigous_n, " that meet criteria"))
-message(paste0("Wrote predictions to ", opt$output))
\ No newline at end of file
+  message(paste0("Successfully imputed ", imputed_n,
+                 " positions out of ", orig_ambigous_n, " that meet criteria in ", records, " records"))
+  message(paste0("Wrote predictions to ", opt$output))
+}
+
+if (opt$worker) {
+  serve_jobs(opt_parser, impute_file)
+} else {
+  impute_file(opt)
+}
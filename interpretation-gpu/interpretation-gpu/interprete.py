@@ -1,9 +1,25 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import shutil
 import subprocess
+import tempfile
 import argparse
-import requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# The conda recipe installs the helper modules and R scripts into share/interpretation-gpu, so
+# they do not clash with those of other packages in $PREFIX/bin. In the source tree
+# they are next to this script.
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "interpretation-gpu")
+if not os.path.isdir(PACKAGE_DIR):
+    PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PACKAGE_DIR)
+
+from metrics import Metrics, add_metrics_arguments, r_metrics_file
+from r_worker import RWorker, serve, submit
+from model_cache import DEFAULT_CACHE_DIR, cache_url, install, is_installed
 
 MODEL_URLS = {
     'genus': 'https://f000.backblazeb2.com/file/genomenet/models/virus_genus_2023-01-23.hdf5',
@@ -11,12 +27,21 @@ MODEL_URLS = {
     'genomenet': 'https://f000.backblazeb2.com/file/bioinf/genomenet_intermediate.h5'
 }
 
-def model_exists_in_folder(model, model_folder):
+# SHA-256 of the published models, downloads are verified against them when set.
+# Models without one are verified against the digest recorded in the cache on
+# their first download.
+MODEL_SHA256 = {
+    'genus': None,
+    'crispr': None,
+    'genomenet': None
+}
+
+def model_exists_in_folder(model, model_folder, cache_dir=DEFAULT_CACHE_DIR):
     """
-    Check if the model exists within the specified folder.
+    Check if the model exists within the specified folder, and is not a truncated download.
     """
     model_path = os.path.join(model_folder, os.path.basename(MODEL_URLS[model]))
-    return os.path.exists(model_path)
+    return is_installed(MODEL_URLS[model], model_path, cache_dir)
 
 def is_valid_fasta(filepath):
     """
@@ -26,9 +51,13 @@ def is_valid_fasta(filepath):
         first_line = file.readline().strip()
         return first_line.startswith(">")
     
-def download_model(model_name, destination_folder):
+def download_model(model_name, destination_folder, cache_dir=DEFAULT_CACHE_DIR):
     """
     Function to download the specified hdf5 model.
+
+    The model is fetched into a content-addressed cache shared by all environments,
+    resuming interrupted downloads and verifying checksums, and then placed in the
+    destination folder with an atomic rename.
     """
     # Define the URL to the model
     url = MODEL_URLS[model_name]
@@ -39,34 +68,160 @@ def download_model(model_name, destination_folder):
     # Define the destination path
     destination_path = os.path.join(destination_folder, filename)
     
-    # Download the file
+    # Download the file, or reuse the cached copy
     print(f"Downloading {model_name} model...")
-    response = requests.get(url, stream=True)
-    with open(destination_path, 'wb') as file:
-        for chunk in response.iter_content(chunk_size=8192):
-            file.write(chunk)
+    blob = cache_url(url, cache_dir, MODEL_SHA256[model_name])
+    install(blob, destination_path)
     print(f"{model_name} model downloaded to {destination_path}")
 
+def download_models(model_names, destination_folder, cache_dir=DEFAULT_CACHE_DIR, workers=3):
+    """
+    Download several models in parallel.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_model, model_name, destination_folder, cache_dir)
+                   for model_name in model_names]
+    # Raise the first error after every download has finished
+    for future in futures:
+        future.result()
+
+
+# Define the path to your R script
+R_SCRIPT_PATH = os.path.join(PACKAGE_DIR, "predict.r")
 
-def run_prediction(input='test.fasta', output='states.csv', model='genus', step=1, batch_size=128, model_folder='models'):
+def start_worker(model='genus', model_folder='models'):
+    """
+    Start a persistent R process with the given model loaded. Pass it to
+    run_prediction to export the states of many files without loading R, TensorFlow
+    and the model again.
+    """
+    # predict.r expects the folder with a trailing separator
+    return RWorker(["Rscript", R_SCRIPT_PATH, '--model', model, '--model_folder', os.path.join(model_folder, "")])
+
+def run_prediction(input='test.fasta', output='states.csv', model='genus', step=1, batch_size=128, model_folder='models', format='csv',
+                   worker=None, pool=1, float16=False, metrics=None):
     """
     Function to run the R script for interpretation analysis using the specified arguments.
+    The job is sent to `worker` if given, either a worker from start_worker or the
+    socket path of a running `interprete serve`, which must have the same model loaded.
+
+    The states are copied from the deepG prediction to the output block by block. With
+    format='h5' they are stored in a chunked, compressed HDF5 file together with the
+    sequence position of every row, in half precision if float16 is set. pool > 1
+    averages every `pool` consecutive windows into one row. The stage timings of the
+    R script are added to `metrics` if given.
+    """
+    with r_metrics_file(metrics, input=os.path.basename(input), model=model) as metrics_file:
+        if isinstance(worker, RWorker):
+            return worker.run(input=input, output=output, model=model, step=step, batch_size=batch_size,
+                              format=format, pool=pool, float16=float16, metrics=metrics_file)
+        if worker is not None:
+            return submit(worker, input=os.path.abspath(input), output=os.path.abspath(output), model=model,
+                          step=step, batch_size=batch_size, format=format, pool=pool, float16=float16,
+                          metrics=metrics_file)
+
+        # Define the command that you would use to run the R script from the command line
+        command = ["Rscript", R_SCRIPT_PATH, 
+                   '--input', input,
+                   '--output', output,
+                   '--model', model,
+                   '--step', str(step),
+                   '--model_folder', model_folder,
+                   '--batch_size', str(batch_size),
+                   '--format', format,
+                   '--pool', str(pool),
+                   '--float16', str(float16)]
+        if metrics_file:
+            command += ['--metrics', metrics_file]
+
+        # Run the command
+        subprocess.run(command)
+
+def run_pipeline(input, positions, model='genus', model_folder='models', step=1, batch_size=128, top_k=100,
+                 min_similarity=None, fast_search=False, gff=None, seqid=None, output=None, output_format=None,
+                 states=None, format='npy', pool=1, float16=False, worker=None, threads=None, metrics=None):
     """
+    Export the states of a FASTA file and search them for the rows most similar to the
+    query positions in one call, without writing or parsing any text file in between.
 
-    # Define the path to your R script
-    r_script_path = os.path.join(os.path.dirname(__file__), "predict.r")
+    The states are written as a binary store (npy by default) into a temporary folder,
+    memory-mapped by the search and removed afterwards. Give `states` to keep them
+    under that prefix instead, e.g. for later `query.py` runs, and format='csv' only
+    if a text copy is needed.
 
-    # Define the command that you would use to run the R script from the command line
-    command = ["Rscript", r_script_path, 
-               '--input', input,
-               '--output', output,
-               '--model', model,
-               '--step', str(step),
-               '--model_folder', model_folder,
-               '--batch_size', str(batch_size)]
+    Parameters:
+    - input: Path to the FASTA file.
+    - positions: The query positions, sequence positions for format='h5' and 1-based
+      row numbers otherwise, like the Position of the hits.
+    - top_k: Number of most similar rows to return per query position.
+    - min_similarity: Only return rows above this similarity.
+    - fast_search: Search an approximate IVF index built in memory instead of the
+      exact block search.
+    - gff: Optional GFF file to annotate the hits with, limited to `seqid` if given.
+    - output: Optional path to write the hits to (CSV, TSV or Parquet).
+    - states: Optional prefix to keep the states under, model name and format
+      extension are appended as for `interprete run`.
+    - metrics: Metrics the prediction, search and annotation stages are recorded in.
 
-    # Run the command
-    subprocess.run(command)
+    Returns:
+    - hits: A DataFrame with the columns Query, Position, Similarity, Feature Type and
+      Description, sorted by query and position.
+    """
+    # The search modules need faiss and pandas, which only the pipeline uses
+    from query import compute_similarity
+    from gff_index import parse_gff
+    from result_writer import results_table, write_table
+    from state_store import load_sequence_positions, query_rows
+
+    metrics = metrics or Metrics()
+    work_dir = None
+    if states is None:
+        work_dir = tempfile.mkdtemp(prefix="interprete_pipeline_")
+        states = os.path.join(work_dir, "states")
+    states_file = f"{states}_{model}.{format}"
+    try:
+        with metrics.stage("prediction"):
+            if os.path.exists(states_file):
+                os.remove(states_file)
+            run_prediction(input=input, output=states, model=model, step=step, batch_size=batch_size,
+                           model_folder=model_folder, format=format, worker=worker, pool=pool, float16=float16,
+                           metrics=metrics)
+        if not os.path.exists(states_file):
+            raise RuntimeError(f"The prediction did not write the states file {states_file}")
+
+        row_nums = query_rows(states_file, positions).tolist()
+        batch_results, _, data = compute_similarity(states_file, row_nums, fast_search, top_k, min_similarity,
+                                                    threads=threads, metrics=metrics)
+        if len(data) == 0:
+            raise ValueError("A position is out of bounds or there was an issue processing the states file.")
+
+        features = {}
+        with metrics.stage("annotation") as stage:
+            if gff:
+                features = parse_gff(gff, seqid)
+            rows = np.concatenate([query_rows for query_rows, _ in batch_results])
+            similarities = np.concatenate([query_similarities for _, query_similarities in batch_results])
+            queries = np.repeat(positions, [len(query_rows) for query_rows, _ in batch_results])
+            hits = results_table(rows, similarities, features, queries, load_sequence_positions(states_file))
+            stage["rows"] = len(hits)
+
+        if output:
+            with metrics.stage("write", rows=len(hits)):
+                write_table(hits, output, output_format)
+        return hits
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def print_top_hits(hits, n=5):
+    """
+    Print the n most similar positions of every query position with their annotation.
+    """
+    for query, query_hits in hits.groupby("Query", sort=False):
+        print(f"\nTop similarities of position {query}:")
+        for _, hit in query_hits.nlargest(n, "Similarity").iterrows():
+            annotation = "" if hit["Feature Type"] == "NA" else f" | {hit['Feature Type']} (product={hit['Description']})"
+            print(f"Position {hit['Position']} ({round(float(hit['Similarity']), 2)}){annotation}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Interpreter tool commands.')
@@ -77,28 +232,70 @@ if __name__ == "__main__":
     download_parser.add_argument('--model', choices=['genus', 'crispr', 'genomenet', 'all'], required=True, 
                                  help='Which model to download: genus, crispr, genomenet or all.')
     download_parser.add_argument('--model_folder', type=str, default="models", help="Folder to save downloaded models.")
+    download_parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+                                 help="Model cache shared between environments (default: $GENOMENET_MODEL_CACHE or ~/.cache/genomenet/models).")
+    download_parser.add_argument('--workers', type=int, default=3, help="Number of models downloaded in parallel with --model all.")
+    add_metrics_arguments(download_parser)
 
     # Subparser for the 'run' command
     run_parser = subparsers.add_parser('run', help='Run generating neuron states.')
     run_parser.add_argument('-i', '--input', type=str, default='test.fasta', help='Input fasta file.')
-    run_parser.add_argument('-o', '--output', type=str, default='states', help='Prefix for the output CSV file. Model name will be appended.')
+    run_parser.add_argument('-o', '--output', type=str, default='states', help='Prefix for the output file. Model name and format extension will be appended.')
+    run_parser.add_argument('-f', '--format', choices=['csv', 'npy', 'h5'], default='csv', help='Output format of the state matrix: csv, the memory-mappable binary npy or the chunked, compressed HDF5 store h5 with a position for every row.')
+    run_parser.add_argument('--float16', action='store_true', help='Store the states of the h5 format in half precision.')
+    run_parser.add_argument('--pool', type=int, default=1, help='Average every N consecutive windows into one row.')
     run_parser.add_argument('-m', '--model', type=str, default='genus', help='Name of the model [genus, crispr, genomenet].')
     run_parser.add_argument('-s', '--step', type=int, default=1, help='Step size to iterate though sequences.')
     run_parser.add_argument('-b', '--batch_size', type=int, default=128, help='Number of samples processed in one batch.')
     run_parser.add_argument('--model_folder', type=str, default="models", help="Folder where models are located.")
+    run_parser.add_argument('--worker', type=str, metavar='SOCKET', help='Send the job to the model kept loaded by a running interprete serve.')
+    add_metrics_arguments(run_parser)
+
+    # Subparser for the 'pipeline' command
+    pipeline_parser = subparsers.add_parser('pipeline', help='Generate the neuron states and search them for positions similar to the query positions in one run.')
+    pipeline_parser.add_argument('-i', '--input', type=str, default='test.fasta', help='Input fasta file.')
+    pipeline_parser.add_argument('--position', type=int, nargs='+', help='Query positions, searched in one batch. Sequence positions with --format h5, row numbers otherwise, like the Position of the hits.')
+    pipeline_parser.add_argument('--positions-file', type=str, help='File with one query position per line.')
+    pipeline_parser.add_argument('-o', '--output', type=str, help='Optional file to write the annotated hits to (CSV, TSV or Parquet). Only the top hits are printed otherwise.')
+    pipeline_parser.add_argument('--output-format', choices=['csv', 'tsv', 'parquet'], help='Format of the output file, inferred from the extension by default.')
+    pipeline_parser.add_argument('--gff', type=str, help='Path to the GFF file for annotation.')
+    pipeline_parser.add_argument('--seqid', type=str, help='Only annotate with the features of this sequence id of a multi-sequence GFF file.')
+    pipeline_parser.add_argument('--top-k', type=int, help='Number of most similar positions to return per query position (default: 100, or every position above --min-similarity).')
+    pipeline_parser.add_argument('--min-similarity', type=float, help='Only return positions with a similarity above this threshold.')
+    pipeline_parser.add_argument('--fast-search', action='store_true', help='Search an approximate IVF index instead of the exact block search.')
+    pipeline_parser.add_argument('--threads', type=int, help='Number of threads of the exact search (default: one per CPU).')
+    pipeline_parser.add_argument('--states', type=str, help='Keep the states under this prefix instead of a temporary folder. Model name and format extension will be appended.')
+    pipeline_parser.add_argument('-f', '--format', choices=['npy', 'h5', 'csv'], default='npy', help='Format the states are handed to the search in (default: npy).')
+    pipeline_parser.add_argument('--float16', action='store_true', help='Store the states of the h5 format in half precision.')
+    pipeline_parser.add_argument('--pool', type=int, default=1, help='Average every N consecutive windows into one row.')
+    pipeline_parser.add_argument('-m', '--model', type=str, default='genus', help='Name of the model [genus, crispr, genomenet].')
+    pipeline_parser.add_argument('-s', '--step', type=int, default=1, help='Step size to iterate though sequences.')
+    pipeline_parser.add_argument('-b', '--batch_size', type=int, default=128, help='Number of samples processed in one batch.')
+    pipeline_parser.add_argument('--model_folder', type=str, default="models", help="Folder where models are located.")
+    pipeline_parser.add_argument('--worker', type=str, metavar='SOCKET', help='Send the prediction to the model kept loaded by a running interprete serve.')
+    add_metrics_arguments(pipeline_parser)
+
+    # Subparser for the 'serve' command
+    serve_parser = subparsers.add_parser('serve', help='Keep a model loaded and run the jobs sent to a local socket.')
+    serve_parser.add_argument('--socket', type=str, required=True, help='Path of the local socket to listen on.')
+    serve_parser.add_argument('-m', '--model', type=str, default='genus', help='Name of the model [genus, crispr, genomenet].')
+    serve_parser.add_argument('--model_folder', type=str, default="models", help="Folder where models are located.")
 
     args = parser.parse_args()
+    metrics = Metrics(f"interprete {args.command}")
 
     if args.command == "download":
         if not os.path.exists(args.model_folder):
             os.makedirs(args.model_folder)
         if args.model == "all":
-            for model_name in MODEL_URLS:
-                download_model(model_name, args.model_folder)
+            with metrics.stage("download", rows=len(MODEL_URLS)):
+                download_models(MODEL_URLS, args.model_folder, args.cache_dir, args.workers)
         else:
-            download_model(args.model, args.model_folder)
+            with metrics.stage("download", rows=1):
+                download_model(args.model, args.model_folder, args.cache_dir)
+        metrics.report(args.profile, args.metrics_json)
 
-    elif args.command == "run":
+    elif args.command in ("run", "pipeline"):
         # Check if the input file exists
         if not os.path.exists(args.input):
             print(f"Error: Input file '{args.input}' does not exist!")
@@ -109,14 +306,51 @@ if __name__ == "__main__":
             print(f"Error: Input file '{args.input}' does not appear to be a valid FASTA format!")
             exit(1)
 
-        # Check if the model_folder exists
-        if not os.path.exists(args.model_folder):
-            print(f"Error: Model folder '{args.model_folder}' does not exist!")
-            exit(1)
+        # A running worker has its model loaded already
+        if not args.worker:
+            # Check if the model_folder exists
+            if not os.path.exists(args.model_folder):
+                print(f"Error: Model folder '{args.model_folder}' does not exist!")
+                exit(1)
+
+            # Check if the model exists within the model_folder
+            if not model_exists_in_folder(args.model, args.model_folder):
+                print(f"Error: The specified model '{args.model}' does not exist in the folder '{args.model_folder}'!")
+                exit(1)
+
+        if args.command == "run":
+            with metrics.stage("prediction"):
+                run_prediction(input=args.input, output=args.output, step=args.step, model=args.model, batch_size=args.batch_size, model_folder=args.model_folder, format=args.format, worker=args.worker, pool=args.pool, float16=args.float16, metrics=metrics)
+        else:
+            # Collect the query positions
+            positions = list(args.position or [])
+            if args.positions_file:
+                with open(args.positions_file, 'r') as file:
+                    positions += [int(line) for line in file if line.strip()]
+            if not positions:
+                pipeline_parser.error("at least one position is required (--position or --positions-file)")
+
+            # --top-k only limits a threshold search if it is given
+            if args.top_k is None and args.min_similarity is None:
+                args.top_k = 100
+
+            try:
+                hits = run_pipeline(args.input, positions, model=args.model, model_folder=args.model_folder, step=args.step,
+                                    batch_size=args.batch_size, top_k=args.top_k, min_similarity=args.min_similarity,
+                                    fast_search=args.fast_search, gff=args.gff, seqid=args.seqid, output=args.output,
+                                    output_format=args.output_format, states=args.states, format=args.format, pool=args.pool,
+                                    float16=args.float16, worker=args.worker, threads=args.threads, metrics=metrics)
+            except (RuntimeError, ValueError) as e:
+                print(f"Error: {e}")
+                exit(1)
+            print_top_hits(hits)
+            if args.output:
+                print(f"Wrote {len(hits)} hits to {args.output}")
+        metrics.report(args.profile, args.metrics_json)
 
-        # Check if the model exists within the model_folder
+    elif args.command == "serve":
         if not model_exists_in_folder(args.model, args.model_folder):
             print(f"Error: The specified model '{args.model}' does not exist in the folder '{args.model_folder}'!")
             exit(1)
 
-        run_prediction(input=args.input, output=args.output, step=args.step, model=args.model, batch_size=args.batch_size, model_folder=args.model_folder)
+        serve(start_worker(args.model, args.model_folder), args.socket)
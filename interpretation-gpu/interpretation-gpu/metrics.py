@@ -0,0 +1,122 @@
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident memory of this process, or of its finished child processes such as
+    the Rscript runs with RUSAGE_CHILDREN, in MB.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+class Metrics:
+    """
+    Wall time, peak memory and the rows and bases processed by each stage of a
+    command, printed with --profile and written with --metrics-json.
+    """
+
+    def __init__(self, command=None):
+        self.command = command
+        self.stages = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, rows=None, bases=None):
+        """
+        Time the stage run in the with block. Counts only known at its end can be set
+        on the yielded record, e.g. record["rows"] = n.
+        """
+        record = {"rows": rows, "bases": bases}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add(name, time.perf_counter() - start, record["rows"], record["bases"], peak_rss_mb())
+
+    def add(self, name, seconds, rows=None, bases=None, peak_rss=None, source="python", **labels):
+        record = {"stage": name, "source": source, "seconds": seconds, "rows": rows, "bases": bases,
+                  "peak_rss_mb": peak_rss}
+        for unit, count in (("rows", rows), ("bases", bases)):
+            record[f"{unit}_per_second"] = count / seconds if count is not None and seconds > 0 else None
+        record.update(labels)
+        self.stages.append(record)
+
+    def read_r_metrics(self, path, **labels):
+        """
+        Add the stages an R script wrote to its --metrics file, one tab-separated line
+        of stage, seconds, rows, bases and peak RSS in MB each. NA marks unknown values.
+        """
+        if not os.path.exists(path):
+            return
+
+        def value(field):
+            return None if field in ("NA", "") else float(field)
+
+        with open(path, 'r') as file:
+            for line in file:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 5:
+                    continue
+                name, seconds, rows, bases, peak_rss = [fields[0]] + [value(field) for field in fields[1:]]
+                # R prints large counts in scientific notation, so they are parsed as floats
+                self.add(name, seconds, None if rows is None else int(rows), None if bases is None else int(bases),
+                         peak_rss, source="R", **labels)
+
+    def summary(self):
+        return {
+            "command": self.command,
+            "total_seconds": time.perf_counter() - self.start,
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_children_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+            "stages": self.stages,
+        }
+
+    def report(self, profile=False, metrics_json=None):
+        """
+        Print the stage table if profile is set and write the metrics to the
+        metrics_json file if given.
+        """
+        summary = self.summary()
+        if profile:
+            print(f"\n{'Stage':<24}{'Source':>8}{'Seconds':>10}{'Rows':>12}{'Bases':>14}{'Rows/s':>12}{'Peak RSS MB':>13}")
+            for stage in self.stages:
+                print(f"{stage['stage']:<24}{stage['source']:>8}{stage['seconds']:>10.3f}"
+                      f"{format_count(stage['rows']):>12}{format_count(stage['bases']):>14}"
+                      f"{format_count(stage['rows_per_second']):>12}{format_count(stage['peak_rss_mb']):>13}")
+            print(f"Total {summary['total_seconds']:.3f} s, peak RSS {summary['peak_rss_mb']:.0f} MB "
+                  f"(child processes {summary['peak_rss_children_mb']:.0f} MB)")
+        if metrics_json:
+            with open(metrics_json, 'w') as file:
+                json.dump(summary, file, indent=2)
+
+def format_count(value):
+    return "-" if value is None else f"{value:.0f}"
+
+@contextmanager
+def r_metrics_file(metrics, **labels):
+    """
+    Temporary file for the --metrics option of an R script, read into metrics once the
+    with block is done. Yields None, so no file is passed, if metrics is None.
+    """
+    if metrics is None:
+        yield None
+        return
+    descriptor, path = tempfile.mkstemp(prefix="r_metrics_", suffix=".tsv")
+    os.close(descriptor)
+    try:
+        yield path
+    finally:
+        metrics.read_r_metrics(path, **labels)
+        os.remove(path)
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--profile", action="store_true",
+                        help="Print the wall time, peak memory and throughput of every stage.")
+    parser.add_argument("--metrics-json", type=str, metavar="FILE",
+                        help="Write the stage metrics to this JSON file.")
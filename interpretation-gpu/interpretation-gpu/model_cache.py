@@ -0,0 +1,184 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+# Shared by all environments of a user unless GENOMENET_MODEL_CACHE points elsewhere
+DEFAULT_CACHE_DIR = os.environ.get("GENOMENET_MODEL_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "genomenet", "models"))
+CHUNK_SIZE = 1 << 20
+
+class IncompleteDownload(IOError):
+    pass
+
+def url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()[:32]
+
+def blob_path(cache_dir, sha256):
+    return os.path.join(cache_dir, "sha256", sha256)
+
+def ref_path(cache_dir, url):
+    return os.path.join(cache_dir, "refs", url_key(url) + ".json")
+
+def read_ref(cache_dir, url, check_blob=True):
+    """
+    The cache entry of a URL: its SHA-256 and size, or None if it is not cached. With
+    check_blob, entries whose cached file is missing or has the wrong size are ignored.
+    """
+    try:
+        with open(ref_path(cache_dir, url), 'r') as file:
+            ref = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if check_blob:
+        blob = blob_path(cache_dir, ref["sha256"])
+        if not os.path.exists(blob) or os.path.getsize(blob) != ref["size"]:
+            return None
+    return ref
+
+def write_json(path, data):
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmp_file, path)
+
+def hash_file(path):
+    """
+    SHA-256 and SHA-1 of a file, computed in one pass.
+    """
+    sha256, sha1 = hashlib.sha256(), hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            sha1.update(chunk)
+    return sha256.hexdigest(), sha1.hexdigest()
+
+def iter_body(response):
+    """
+    Yield the body of a streamed response as it arrives. Unlike iter_content, which
+    waits for whole chunks, an interrupted transfer has written every byte received
+    before it raises, so the download resumes exactly where it stopped.
+    """
+    if not hasattr(response.raw, "read1"):
+        # urllib3 < 2 has no read1, stay close to the received data with small chunks
+        yield from response.iter_content(chunk_size=1 << 16)
+        return
+    while True:
+        chunk = response.raw.read1(CHUNK_SIZE, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+def fetch(url, part_file, timeout=60, retries=3):
+    """
+    Download a URL into part_file, resuming from its current size with an HTTP range
+    request. A server that ignores the range, or whose file changed since the partial
+    download (If-Range), sends the whole file and the download restarts.
+
+    Returns:
+    - headers: The headers of the last response.
+    """
+    meta_file = part_file + ".json"
+    for attempt in range(retries + 1):
+        try:
+            headers = {}
+            if os.path.exists(part_file) and os.path.exists(meta_file):
+                with open(meta_file, 'r') as file:
+                    validator = json.load(file).get("validator")
+                headers["Range"] = f"bytes={os.path.getsize(part_file)}-"
+                if validator:
+                    headers["If-Range"] = validator
+
+            with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # The partial file is already complete
+                    return response.headers
+                response.raise_for_status()
+                resumed = response.status_code == 206
+                if resumed:
+                    total = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+                else:
+                    total = int(response.headers.get("Content-Length", -1))
+                    write_json(meta_file, {"validator": response.headers.get("ETag")
+                                           or response.headers.get("Last-Modified")})
+                with open(part_file, 'ab' if resumed else 'wb') as file:
+                    for chunk in iter_body(response):
+                        file.write(chunk)
+
+            size = os.path.getsize(part_file)
+            if total >= 0 and size != total:
+                raise IncompleteDownload(f"Incomplete download of {url}: {size} of {total} bytes")
+            return response.headers
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                ProtocolError, ReadTimeoutError, IncompleteDownload) as e:
+            if attempt == retries:
+                raise
+            print(f"Download interrupted ({e}), resuming...")
+            time.sleep(2 ** attempt)
+
+def cache_url(url, cache_dir=DEFAULT_CACHE_DIR, sha256=None):
+    """
+    Make sure the content of a URL is in the content-addressed cache and return its
+    path. Downloads resume from a previous partial download, are verified against
+    the expected SHA-256 and the SHA-1 the server reports (Backblaze B2's
+    x-bz-content-sha1), and are only moved into the cache once complete.
+
+    Without an expected SHA-256, the digest of the first download is recorded for the
+    URL and later downloads of it are verified against that. Cached files are checked
+    against their digest on every cache hit and downloaded again if they changed.
+    """
+    for folder in ("sha256", "refs", "partial"):
+        os.makedirs(os.path.join(cache_dir, folder), exist_ok=True)
+
+    part_file = os.path.join(cache_dir, "partial", url_key(url) + ".part")
+    # Environments sharing the cache wait for each other instead of writing the same file
+    with open(part_file + ".lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        recorded = read_ref(cache_dir, url, check_blob=False)
+        sha256 = sha256 or (recorded and recorded["sha256"])
+        ref = read_ref(cache_dir, url)
+        if ref and ref["sha256"] == sha256:
+            blob = blob_path(cache_dir, sha256)
+            if hash_file(blob)[0] == sha256:
+                return blob
+            print(f"The cached copy of {url} is corrupted, downloading it again")
+            os.remove(blob)
+
+        headers = fetch(url, part_file)
+        digest, sha1 = hash_file(part_file)
+        server_sha1 = headers.get("x-bz-content-sha1", "").replace("unverified:", "")
+        if (sha256 and digest != sha256) or (len(server_sha1) == 40 and server_sha1 != sha1):
+            os.remove(part_file)
+            raise ValueError(f"Checksum mismatch for {url}, the download was discarded. If the file was "
+                             f"updated on purpose, remove {ref_path(cache_dir, url)} to accept the new version.")
+
+        size = os.path.getsize(part_file)
+        os.replace(part_file, blob_path(cache_dir, digest))
+        if os.path.exists(part_file + ".json"):
+            os.remove(part_file + ".json")
+        write_json(ref_path(cache_dir, url), {"url": url, "sha256": digest, "size": size})
+        return blob_path(cache_dir, digest)
+
+def install(blob, destination_path):
+    """
+    Place a copy of a cached file at destination_path with an atomic rename. It is not
+    linked, so changing the installed file can not corrupt the cache.
+    """
+    tmp_file = f"{destination_path}.{os.getpid()}.tmp"
+    shutil.copyfile(blob, tmp_file)
+    os.replace(tmp_file, destination_path)
+
+def is_installed(url, destination_path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Check that a downloaded file exists and, if its URL is in the cache, that it has
+    the size of the cached file, so truncated downloads are not taken as present.
+    """
+    if not os.path.exists(destination_path):
+        return False
+    ref = read_ref(cache_dir, url, check_blob=False)
+    return ref is None or os.path.getsize(destination_path) == ref["size"]
@@ -17,7 +17,13 @@ option_list <- list(
   make_option(c("-i", "--input"), type = "character", default = "test.fasta",
               help = "Input FASTA file."),
   make_option(c("-o", "--output"), type = "character", default = "prediction",
-              help = "Prefix for the output CSV file. Model name will be appended."),
+              help = "Prefix for the output file. Model name will be appended."),
+  make_option(c("-f", "--format"), type = "character", default = "csv",
+              help = "Output format of the state matrix [csv, npy, h5] [default %default]."),
+  make_option(c("--float16"), type = "logical", default = FALSE,
+              help = "Store the states of the h5 format in half precision [default %default]."),
+  make_option(c("--pool"), type = "integer", default = 1,
+              help = "Average every N consecutive windows into one row [default %default].", metavar = "number"),
   make_option(c("-m", "--model"), type = "character", default = "genus",
               help = "Name of the model [genus, crispr, genomenet]."), 
   make_option(c("--model_folder"), type = "character", default = "models/", 
@@ -25,7 +31,11 @@ option_list <- list(
   make_option(c("-s", "--step"), type = "integer", default = 1000,
               help = "Step size to iterate through sequences [default %default].", metavar = "number"),
   make_option(c("-b", "--batch_size"), type = "integer", default = 32,
-              help = "Number of samples processed in one batch [default %default].", metavar = "number")
+              help = "Number of samples processed in one batch [default %default].", metavar = "number"),
+  make_option(c("--metrics"), type = "character", default = NULL,
+              help = "Append the wall time, rows, bases and peak memory of every stage to this file."),
+  make_option(c("--worker"), action = "store_true", default = FALSE,
+              help = "Keep the model loaded and run jobs read from stdin, one tab-separated command line per line.")
 )
 
 # Parse command line arguments
@@ -47,12 +57,113 @@ model_layer_names <- list(
 )
 
 # Functions
+write_npy_header <- function(con, n_rows, n_columns) {
+  # Header of a row-major float32 NumPy array that Python can memory-map
+  header <- sprintf("{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }", n_rows, n_columns)
+  # magic string, version and header length take 10 bytes, total must align to 64
+  header <- paste0(header, strrep(" ", (64 - (10 + nchar(header) + 1) %% 64) %% 64), "\n")
+  writeBin(as.raw(c(0x93, charToRaw("NUMPY"), 0x01, 0x00)), con)
+  writeBin(nchar(header), con, size = 2, endian = "little")
+  writeBin(charToRaw(header), con)
+}
+
+float16_type <- function() {
+  # IEEE half precision, built like h5py does, so h5py and NumPy read it as float16
+  dtype <- hdf5r::h5types$H5T_IEEE_F32LE$copy()
+  dtype$set_fields(spos = 15, epos = 10, esize = 5, mpos = 0, msize = 10)
+  dtype$set_size(2)
+  dtype$set_ebias(15)
+  dtype
+}
+
+states_writer <- function(output_file, format, n_rows, n_columns, float16 = FALSE) {
+  # Open an output for n_rows states, written block by block with write(block, positions)
+  if (format == "h5") {
+    out <- hdf5r::H5File$new(output_file, mode = "w")
+    # Chunks of about 1 MB of whole rows, compressed independently
+    chunk_rows <- max(1, min(n_rows, 2^18 %/% n_columns))
+    dtype <- if (float16) float16_type() else hdf5r::h5types$H5T_IEEE_F32LE
+    # hdf5r reverses the dimensions, store columns x rows so h5py and NumPy see rows x columns
+    states <- out$create_dataset("states", dtype = dtype, dims = c(n_columns, n_rows),
+                                 chunk_dims = c(n_columns, chunk_rows), gzip_level = 4)
+    position <- out$create_dataset("position", dtype = hdf5r::h5types$H5T_STD_I64LE, dims = n_rows,
+                                   chunk_dims = chunk_rows, gzip_level = 4)
+    written <- 0
+    write <- function(block, positions) {
+      rows <- written + seq_len(nrow(block))
+      states[, rows] <- t(block)
+      position[rows] <- positions
+      written <<- written + nrow(block)
+    }
+    return(list(write = write, close = function() out$close_all()))
+  }
+
+  if (format == "npy") {
+    con <- file(output_file, "wb")
+    write_npy_header(con, n_rows, n_columns)
+    write <- function(block, positions) writeBin(as.vector(t(block)), con, size = 4, endian = "little")
+    return(list(write = write, close = function() close(con)))
+  }
+
+  first_block <- TRUE
+  write <- function(block, positions) {
+    colnames(block) <- paste0("V", seq_len(ncol(block)))
+    write.table(block, file = output_file, sep = ",", row.names = FALSE, quote = FALSE,
+                col.names = first_block, append = !first_block)
+    first_block <<- FALSE
+  }
+  list(write = write, close = function() invisible(NULL))
+}
+
+pool_rows <- function(block, positions, pool) {
+  # Average every pool consecutive rows, the last group may be shorter. A pooled row
+  # gets the end position of its last window.
+  if (pool == 1) return(list(block = block, positions = positions))
+  groups <- (seq_len(nrow(block)) - 1) %/% pool
+  sizes <- tabulate(groups + 1)
+  list(block = rowsum(block, groups, reorder = FALSE) / sizes,
+       positions = positions[cumsum(sizes)])
+}
+
+export_states <- function(prediction_file, output_file, format, pool = 1, float16 = FALSE) {
+  # Copy the states of a deepG prediction file to the output block by block, so the
+  # full matrix is never held in memory
+  source <- hdf5r::H5File$new(prediction_file, mode = "r")
+  on.exit(source$close_all(), add = TRUE)
+  source_states <- source[["states"]]
+  source_positions <- source[["sample_end_position"]]
+  # discard first prediction (pred for all zero input)
+  n_rows <- source_states$dims[1] - 1
+  n_columns <- source_states$dims[2]
+  if (n_rows < 1) stop("Prediction failed. No states were written.")
+
+  # The first row is kept as is: readers of the states skip it, so pooling starts
+  # with the rows they see
+  n_out <- 1 + ceiling((n_rows - 1) / pool)
+  writer <- states_writer(output_file, format, n_out, n_columns, float16)
+  on.exit(writer$close(), add = TRUE, after = FALSE)
+  writer$write(matrix(source_states[2, ], nrow = 1), source_positions[2])
+
+  # Blocks of about 4M values, a multiple of pool rows
+  block_rows <- max(1, 2^22 %/% (n_columns * pool)) * pool
+  start <- 3
+  while (start <= n_rows + 1) {
+    rows <- start:min(start + block_rows - 1, n_rows + 1)
+    pooled <- pool_rows(matrix(source_states[rows, ], nrow = length(rows)), source_positions[rows], pool)
+    writer$write(pooled$block, pooled$positions)
+    start <- start + block_rows
+  }
+  c(n_out, n_columns)
+}
+
 predict_and_write <- function(opt, model, layer_name) {
   if (!file.exists(opt$input)) stop("Input file not found")
 
   # Use a temporary file for intermediate results
   temp_file <- tempfile()
+  on.exit(if (file.exists(temp_file)) invisible(file.remove(temp_file)), add = TRUE)
 
+  started <- proc.time()[["elapsed"]]
   pred <- predict_model(
     output_format = "one_seq",
     model = model,
@@ -62,27 +173,62 @@ predict_and_write <- function(opt, model, layer_name) {
     step = opt$step,
     batch_size = opt$batch_size,
     verbose = FALSE,
-    return_states = TRUE,
+    return_states = FALSE,
     padding = "maxlen",
     mode = "label",
     format = "fasta",
     filename = temp_file
   )
+  write_metric(opt$metrics, "inference", elapsed(started))
 
-  # create states matrix
-  pred_list <- load_prediction(temp_file, get_sample_position = TRUE)
+  # Incorporate the model name into the output filename
+  output_file <- paste0(opt$output, "_", opt$model, ".", opt$format)
+  started <- proc.time()[["elapsed"]]
+  dims <- export_states(temp_file, output_file, opt$format, opt$pool, opt$float16)
+  write_metric(opt$metrics, "export", elapsed(started), rows = dims[1])
 
-  on.exit(file.remove(temp_file), add = TRUE)
+  message(paste0("Exported state matrix (", dims[1], " rows and ", dims[2], " columns) to ", output_file))
 
-  states <- pred_list$states
-  states <- states[-1,] # discard first prediction (pred for all zero input)
-  
-  # Incorporate the model name into the output filename
-  output_file <- paste0(opt$output, "_", opt$model, ".csv")
-  write.csv(states, file = output_file, row.names = FALSE, quote = FALSE)
-  
-  message(paste0("Exported state matrix (", nrow(states), " rows and ", ncol(states), " columns) to ", output_file))
+}
+
+peak_rss_mb <- function() {
+  # Peak resident memory of the R process, from /proc on Linux
+  status <- tryCatch(readLines("/proc/self/status"), error = function(e) character(0))
+  hwm <- grep("^VmHWM:", status, value = TRUE)
+  if (length(hwm) == 0) return(NA)
+  as.numeric(gsub("[^0-9]", "", hwm)) / 1024
+}
+
+write_metric <- function(file, stage, seconds, rows = NA, bases = NA) {
+  # One tab-separated line per stage, collected by the Python wrapper for --profile
+  if (is.null(file)) return(invisible(NULL))
+  cat(paste(stage, round(seconds, 4), rows, bases, round(peak_rss_mb(), 1), sep = "\t"), "\n",
+      sep = "", file = file, append = TRUE)
+}
 
+elapsed <- function(since) proc.time()[["elapsed"]] - since
+
+serve_jobs <- function(opt_parser, run_job) {
+  # Status lines on stdout tell the Python wrapper when the worker is ready and
+  # when each job is done, the messages of the jobs go to stderr
+  con <- file("stdin")
+  open(con)
+  on.exit(close(con), add = TRUE)
+  cat("@@worker ready\n")
+  flush(stdout())
+  while (length(line <- readLines(con, n = 1)) > 0) {
+    status <- tryCatch({
+      job <- parse_args(opt_parser, args = strsplit(line, "\t", fixed = TRUE)[[1]])
+      run_job(job)
+      "@@worker done"
+    }, error = function(e) paste("@@worker error", gsub("\n", " ", conditionMessage(e))))
+    cat(status, "\n", sep = "")
+    flush(stdout())
+  }
+}
+
+if (!opt$format %in% c("csv", "npy", "h5")) {
+  stop(paste("Unsupported output format:", opt$format))
 }
 
 # Check if the model is supported and get the model path
@@ -99,8 +245,28 @@ if (!file.exists(model_path)) {
 }
 
 # Load model
+load_started <- proc.time()[["elapsed"]]
 model <- load_cp(model_path)
+write_metric(opt$metrics, "model load", elapsed(load_started))
+
+run_job <- function(job) {
+  if (job$model != opt$model) {
+    stop(paste("The worker has the", opt$model, "model loaded, not", job$model))
+  }
+  if (!job$format %in% c("csv", "npy", "h5")) {
+    stop(paste("Unsupported output format:", job$format))
+  }
+  if (job$pool < 1) {
+    stop("--pool must be at least 1")
+  }
 
-# Predict
-message("Predicting sequence")
-predict_and_write(opt, model, layer_name)
\ No newline at end of file
+  # Predict
+  message("Predicting sequence")
+  predict_and_write(job, model, layer_name)
+}
+
+if (opt$worker) {
+  serve_jobs(opt_parser, run_job)
+} else {
+  run_job(opt)
+}
@@ -0,0 +1,394 @@
+import faiss
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+from gff_index import parse_gff, describe_positions
+from state_store import is_binary_store, open_states, load_sequence_positions, query_rows
+from exact_search import DEFAULT_BLOCK_SIZE, exact_search
+from result_writer import OUTPUT_FORMATS, top_n, write_results
+from metrics import Metrics, add_metrics_arguments
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "interprete", "query")
+
+def cache_path(input_file, cache_dir):
+    """
+    Directory holding the cached matrix and index of a states file, one per input path.
+    """
+    key = hashlib.sha1(os.path.abspath(input_file).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(input_file)}.{key}")
+
+def file_signature(input_file):
+    """
+    Size and modification time of a states file. A change of either invalidates its
+    cache, without hashing the whole file on every call.
+    """
+    stat = os.stat(input_file)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def load_cache(input_file, cache_dir, fast_search):
+    """
+    Load the normalized matrix and, for --fast-search, the trained IVF index of a
+    states file from the cache.
+
+    Returns:
+    - data: The memory-mapped normalized matrix, or None if the cache is missing or stale.
+    - index: The trained IVF index, or None if it has not been cached yet.
+    """
+    path = cache_path(input_file, cache_dir)
+    try:
+        with open(os.path.join(path, "meta.json"), 'r') as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None, None
+    if meta.get("source") != file_signature(input_file):
+        return None, None
+
+    data = np.load(os.path.join(path, "states.npy"), mmap_mode='r')
+    index = None
+    ivf_file = os.path.join(path, "ivf.index")
+    if fast_search and os.path.exists(ivf_file):
+        index = faiss.read_index(ivf_file)
+    return data, index
+
+def store_cache(input_file, cache_dir, signature, data=None, index=None):
+    """
+    Write the normalized matrix and/or the trained IVF index of a states file to the
+    cache. Files are written under a temporary name and renamed, so concurrent
+    queries never read a partial cache.
+    """
+    path = cache_path(input_file, cache_dir)
+    os.makedirs(path, exist_ok=True)
+    if data is not None:
+        # The matrix changes, so the metadata and any old index are dropped first
+        for name in ("meta.json", "ivf.index"):
+            if os.path.exists(os.path.join(path, name)):
+                os.remove(os.path.join(path, name))
+        tmp_file = os.path.join(path, f"states.{os.getpid()}.npy")
+        np.save(tmp_file, data)
+        os.replace(tmp_file, os.path.join(path, "states.npy"))
+        tmp_file = os.path.join(path, f"meta.{os.getpid()}.json")
+        with open(tmp_file, 'w') as file:
+            json.dump({"input": os.path.abspath(input_file), "source": signature}, file, indent=2)
+        os.replace(tmp_file, os.path.join(path, "meta.json"))
+    if index is not None:
+        tmp_file = os.path.join(path, f"ivf.{os.getpid()}.index")
+        faiss.write_index(index, tmp_file)
+        os.replace(tmp_file, os.path.join(path, "ivf.index"))
+
+def load_normalized(input_file, cache_dir=None):
+    """
+    Parse and normalize a states file, reusing the cached matrix of earlier calls.
+
+    Returns:
+    - data: The normalized float32 matrix, memory-mapped when read from the cache.
+    """
+    if cache_dir:
+        data, _ = load_cache(input_file, cache_dir, fast_search=False)
+        if data is not None:
+            print("Using cached states...")
+            return data
+        signature = file_signature(input_file)
+
+    # Copy into a contiguous float32 array for in-place normalization
+    data = np.array(open_states(input_file), dtype='float32', order='C')
+
+    # Normalize vectors for cosine similarity
+    faiss.normalize_L2(data)
+    if cache_dir:
+        store_cache(input_file, cache_dir, signature, data=data)
+    return data
+
+def open_exact_states(input_file, cache_dir=None):
+    """
+    Open a states file for the exact block search without loading it into memory.
+
+    Returns:
+    - states: The state matrix, memory-mapped unless it is a CSV file without cache.
+    - normalized: Whether the rows of states are already normalized.
+    """
+    if is_binary_store(input_file):
+        # Binary stores are streamed directly and normalized block by block
+        return open_states(input_file), False
+    return load_normalized(input_file, cache_dir), True
+
+def prepare_index(input_file, cache_dir=None):
+    """
+    Load the normalized matrix of a states file and build the approximate IVF index
+    of --fast-search, reusing the cached matrix and trained index of earlier calls.
+
+    Parameters:
+    - input_file: Path to the states file (CSV, .npy or .h5).
+    - cache_dir: Directory of the cache. Caching is disabled if None.
+
+    Returns:
+    - data: The normalized float32 matrix.
+    - index: The IVF index holding every row of data.
+    """
+    index = None
+    if cache_dir:
+        _, index = load_cache(input_file, cache_dir, fast_search=True)
+    data = load_normalized(input_file, cache_dir)
+    if index is not None:
+        return data, index
+
+    # Use IndexIVFFlat for faster search
+    dimension = data.shape[1]
+    quantizer = faiss.IndexFlatL2(dimension)
+    nlist = 50  # determines the number of clusters (or centroids) to create in the vector space
+    index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+    assert not index.is_trained
+    print("Retraining index...")
+    train = np.ascontiguousarray(data)
+    index.train(train)
+    assert index.is_trained
+    index.nprobe = 10  # controls the number of clusters to visit during the search
+    index.add(train)
+    if cache_dir:
+        store_cache(input_file, cache_dir, file_signature(input_file), index=index)
+
+    return data, index
+
+def compute_similarity(input_file, row_nums, fast_search=False, top_k=None, min_similarity=None, full_track=False,
+                       cache_dir=None, block_size=DEFAULT_BLOCK_SIZE, threads=None, metrics=None):
+    """
+    Compute cosine similarity between the given rows and all other rows. All query
+    rows are searched in one batched call.
+    
+    Parameters:
+    - input_file: Path to the states file (CSV, .npy or .h5).
+    - row_nums: Row numbers to compare with all other rows (0-indexed).
+    - fast_search: Whether to use a faster, approximate search method. Otherwise the
+      exact search streams the states in blocks instead of building an index.
+    - top_k: Number of most similar rows to return per query. All rows are ranked if None.
+    - min_similarity: Only return rows above this similarity, using a range search.
+    - full_track: Return the similarity of every row, ordered by row, instead of hits.
+    - cache_dir: Directory to cache the normalized matrix and trained index in.
+    - block_size: Number of rows scored at once by the exact search.
+    - threads: Number of threads of the exact search, one per CPU if None.
+    - metrics: Metrics the load and search stages are recorded in.
+    
+    Returns:
+    - batch_results: One (rows, similarities) pair of arrays per query row, sorted by
+      decreasing similarity, or by row for the full track.
+    - query_vectors: The vectors of the given rows.
+    - data: Numpy array of the data from the states file, memory-mapped if possible.
+    """
+    metrics = metrics or Metrics()
+    # Load the states, reusing the cache of earlier calls
+    try:
+        with metrics.stage("load states") as stage:
+            if fast_search:
+                data, index = prepare_index(input_file, cache_dir)
+                normalized = True
+            else:
+                data, normalized = open_exact_states(input_file, cache_dir)
+            stage["rows"] = data.shape[0]
+    except Exception as e:
+        print(f"Failed to load states file. Error: {e}")
+        return [], [], []
+
+    for row_num in row_nums:
+        if not 0 <= row_num < data.shape[0]:
+            print(f"Row {row_num + 1} is outside of the {data.shape[0]} rows of the states file.")
+            return [], [], []
+
+    # Compute similarity for all query rows at once
+    with metrics.stage("search", rows=len(row_nums)):
+        query_vectors = np.array(data[row_nums], dtype='float32', order='C')
+        if not normalized:
+            faiss.normalize_L2(query_vectors)
+        batch_results = []
+        if not fast_search:
+            batch_results = exact_search(data, query_vectors, None if top_k is None else top_k + 1, min_similarity,
+                                         full_track, block_size, threads, normalized)
+        elif full_track:
+            # A range search without threshold returns every row unsorted, scatter it by row
+            lims, similarities, indices = index.range_search(query_vectors, -np.finfo('float32').max)
+            for q in range(len(row_nums)):
+                track = np.full(data.shape[0], np.nan, dtype='float32')
+                track[indices[lims[q]:lims[q + 1]]] = similarities[lims[q]:lims[q + 1]]
+                rows = np.flatnonzero(~np.isnan(track))
+                batch_results.append((rows, track[rows]))
+        elif min_similarity is not None:
+            lims, similarities, indices = index.range_search(query_vectors, min_similarity)
+            for q in range(len(row_nums)):
+                query_similarities = similarities[lims[q]:lims[q + 1]]
+                query_indices = indices[lims[q]:lims[q + 1]]
+                order = np.argsort(-query_similarities, kind='stable')
+                batch_results.append((query_indices[order], query_similarities[order]))
+        else:
+            # Ask for one extra hit since the queried row is removed below
+            k = data.shape[0] if top_k is None else min(top_k + 1, data.shape[0])
+            similarities, indices = index.search(query_vectors, k)
+            for query_similarities, query_indices in zip(similarities, indices):
+                # IVF indexes pad with -1 when the probed lists hold fewer than k rows
+                found = query_indices >= 0
+                batch_results.append((query_indices[found], query_similarities[found]))
+
+    # Exclude the queried rows
+    for q, row_num in enumerate(row_nums):
+        rows, similarities = batch_results[q]
+        other = rows != row_num
+        if full_track:
+            batch_results[q] = (rows[other], similarities[other])
+        else:
+            batch_results[q] = (rows[other][:top_k], similarities[other][:top_k])
+
+    return batch_results, query_vectors, data
+
+def select_hits(track, top_k=None, min_similarity=None):
+    """
+    Select the hits of a full track: rows above min_similarity, limited to the top_k
+    best. Only the selected rows are sorted.
+    """
+    rows, similarities = track
+    if min_similarity is not None:
+        above = similarities > min_similarity
+        rows, similarities = rows[above], similarities[above]
+    top = top_n(similarities, similarities.size if top_k is None else top_k)
+    return rows[top], similarities[top]
+
+if __name__ == "__main__":
+
+    # Argument parsing
+    parser = argparse.ArgumentParser(description="Compute cosine similarity using FAISS.")
+    parser.add_argument("--input", type=str, required=True, help="Path to the input states file (CSV, .npy or .h5).")
+    parser.add_argument("--position", type=int, nargs='+',
+                        help="Positions to compare with all other rows, searched in one batch. Like the Position of "
+                             "the hits, these are sequence positions for HDF5 stores with a position dataset and "
+                             "row numbers otherwise.")
+    parser.add_argument("--positions-file", type=str, help="File with one position per line to compare with all other rows.")
+    parser.add_argument("--output", type=str, required=True, help="Path to the output file where results will be saved.")
+    parser.add_argument("--gff", type=str, help="Path to the GFF file for annotation.")
+    parser.add_argument("--seqid", type=str,
+                        help="Only annotate with the features of this sequence id of a multi-sequence GFF file.")
+    parser.add_argument("--fast-search", action="store_true", 
+                        help="Use a faster, approximate search instead of brute force.")
+    parser.add_argument("--top-k", type=int,
+                        help="Number of most similar positions to return (default: 100, or every position above "
+                             "--min-similarity).")
+    parser.add_argument("--min-similarity", type=float,
+                        help="Only return positions with a similarity above this threshold (range search).")
+    parser.add_argument("--track", type=str,
+                        help="Optional path to write the similarity of every position.")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS,
+                        help="Format of the output files, inferred from the extension by default. "
+                             "CSV and TSV are compressed when the name ends in .gz, .bz2, .xz or .zst.")
+    parser.add_argument("--cache", action="store_true",
+                        help="Cache the normalized states and trained index, so later queries of an unchanged "
+                             "states file skip parsing and training. The cache keeps a float32 copy of every "
+                             "queried file and is never cleaned up, remove the folder to free the space.")
+    parser.add_argument("--cache-dir", type=str,
+                        help="Folder of the cache, implies --cache (default: ~/.cache/interprete/query).")
+    parser.add_argument("--threads", type=int,
+                        help="Number of threads of the exact search (default: one per CPU).")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Number of rows the exact search scores at once, bounds its memory use.")
+    add_metrics_arguments(parser)
+    
+    args = parser.parse_args()
+    # --top-k only limits a threshold search if it is given
+    if args.top_k is None and args.min_similarity is None:
+        args.top_k = 100
+
+    # Collect the query positions
+    positions = list(args.position or [])
+    if args.positions_file:
+        with open(args.positions_file, 'r') as file:
+            positions += [int(line) for line in file if line.strip()]
+    if not positions:
+        parser.error("at least one position is required (--position or --positions-file)")
+
+    # Check file validity
+    if not os.path.exists(args.input):
+        print(f"File {args.input} does not exist.")
+        exit(1)
+
+    if not os.path.isfile(args.input):
+        print(f"{args.input} is not a valid file.")
+        exit(1)
+
+    # Additional check to ensure CSV or binary format
+    if not args.input.endswith(('.csv', '.npy', '.h5')):
+        print(f"{args.input} might not be a states file as it doesn't have a .csv, .npy or .h5 extension.")
+        exit(1)
+
+    # Map the positions to 0-based rows, HDF5 stores are queried by sequence position
+    try:
+        row_nums = query_rows(args.input, positions).tolist()
+    except ValueError as e:
+        print(f"Error: {e}")
+        exit(1)
+
+    # Providing feedback to the user
+    print("Computing similarities...")
+    
+    # The cache is opt-in, it copies every queried file
+    cache_dir = None
+    if args.cache or args.cache_dir:
+        cache_dir = args.cache_dir or DEFAULT_CACHE_DIR
+
+    # Call the compute_similarity function, hits are selected from the full track if one is requested
+    metrics = Metrics("query")
+    if args.track:
+        batch_track, query_vectors, data = compute_similarity(args.input, row_nums, args.fast_search, full_track=True,
+                                                              cache_dir=cache_dir, block_size=args.block_size,
+                                                              threads=args.threads, metrics=metrics)
+        batch_results = [select_hits(track, args.top_k, args.min_similarity) for track in batch_track]
+    else:
+        batch_results, query_vectors, data = compute_similarity(args.input, row_nums, args.fast_search, args.top_k,
+                                                                args.min_similarity, cache_dir=cache_dir,
+                                                                block_size=args.block_size, threads=args.threads,
+                                                                metrics=metrics)
+
+    # If GFF file is provided, parse it
+    features = {}
+    if args.gff:
+        with metrics.stage("annotation") as stage:
+            features = parse_gff(args.gff, args.seqid)
+            stage["rows"] = len(features.get("start", []))
+
+    # Handle the potential issue of --position being out of bounds
+    if len(data) == 0:
+        print("Error: A position is out of bounds or there was an issue processing the states file.")
+        exit(1)
+
+    # Rows of HDF5 stores are labelled with the sequence position they were predicted at
+    sequence_positions = load_sequence_positions(args.input)
+    
+    for position, query_vector, results in zip(positions, query_vectors, batch_results):
+        # Print the query vector with truncation for high-dimensional data
+        if len(query_vector) > 10:
+            print(f"Query Vector (Position {position}): {query_vector[:5]} ... {query_vector[-5:]}")
+        else:
+            print(f"Query Vector (Position {position}): {query_vector}")
+
+        # Print the top 5 results to the screen
+        print("\nTop 5 Similarities:")
+        rows, similarities = results
+        top = top_n(similarities, 5)
+        hit_positions = rows[top] + 1 if sequence_positions is None else sequence_positions[rows[top]]
+        labels = describe_positions(hit_positions, features)
+        for position, value, annotation in zip(hit_positions, similarities[top], labels):
+            rounded_value = round(float(value), 2)
+            print(f"Position {position} ({rounded_value}){annotation}")
+
+
+    print("Writing output...")
+    # Single queries keep the original layout, batches are written in long format
+    with metrics.stage("write", rows=sum(len(rows) for rows, _ in batch_results)):
+        if len(positions) == 1:
+            write_results(batch_results[0], features, args.output, output_format=args.output_format,
+                          sequence_positions=sequence_positions)
+            if args.track:
+                write_results(batch_track[0], features, args.track, output_format=args.output_format,
+                              sequence_positions=sequence_positions)
+        else:
+            write_results(batch_results, features, args.output, positions, args.output_format, sequence_positions)
+            if args.track:
+                write_results(batch_track, features, args.track, positions, args.output_format, sequence_positions)
+
+    metrics.report(args.profile, args.metrics_json)
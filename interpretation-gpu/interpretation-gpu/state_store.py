@@ -0,0 +1,311 @@
+import io
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# The states CSV has always been parsed with skiprows=1, which turns its first data
+# row into the column header. Stores keep every row written by `interprete run` and
+# skip that row on open, so positions match existing indexes and search outputs.
+FIRST_ROW = 1
+
+def is_binary_store(path):
+    """
+    Check whether a states file uses a binary format (.npy or .h5).
+    """
+    return path.endswith('.npy') or is_hdf5_store(path)
+
+def is_hdf5_store(path):
+    return path.endswith('.h5')
+
+class HDF5States:
+    """
+    Row access to the chunked, compressed "states" dataset of an HDF5 store, starting
+    at a given row. Rows are decompressed on access and returned as float32, whatever
+    the precision they are stored in. The wrapper owns the open HDF5 file, close it
+    with close() or by using it in a with block.
+    """
+
+    def __init__(self, file, first_row=0):
+        self.file = file
+        self.dataset = file["states"]
+        self.first_row = first_row
+        self.shape = (self.dataset.shape[0] - first_row, self.dataset.shape[1])
+        self.dtype = np.dtype('float32')
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.shape[0])
+            return self.dataset[self.first_row + start:self.first_row + stop:step].astype('float32')
+        rows = np.asarray(rows)
+        if rows.ndim == 0:
+            return self.dataset[self.first_row + int(rows)].astype('float32')
+        # HDF5 reads increasing, unique rows
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return self.dataset[self.first_row + unique_rows].astype('float32')[inverse]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype or self.dtype, copy=False)
+
+def open_hdf5(input_file, first_row=0):
+    # h5py is only needed for HDF5 stores
+    import h5py
+    return HDF5States(h5py.File(input_file, 'r'), first_row)
+
+def load_sequence_positions(input_file):
+    """
+    Sequence position of every row of a states file, in the numbering of open_states.
+
+    Returns:
+    - positions: An int64 array with the end position of the window (or pooled
+      windows) of every row, as written to the "position" dataset of HDF5 stores by
+      `interprete run`. None for files without positions (.npy, .csv), whose rows are
+      labelled with their row number instead.
+    """
+    if not input_file or not is_hdf5_store(input_file) or not os.path.exists(input_file):
+        return None
+    import h5py
+    with h5py.File(input_file, 'r') as file:
+        if "position" not in file:
+            return None
+        return file["position"][FIRST_ROW:].astype(np.int64)
+
+def rows_at_positions(sequence_positions, positions):
+    """
+    Find the rows predicted at the given sequence positions.
+
+    Parameters:
+    - sequence_positions: The sequence position of every row, see load_sequence_positions.
+    - positions: Sequence positions, as in the Position column of the hits.
+
+    Returns:
+    - rows: The 0-based row of every position, the first one if several rows share it.
+    """
+    positions = np.asarray(positions, dtype=np.int64).reshape(-1)
+    if sequence_positions.size == 0:
+        raise ValueError("The states file has no rows")
+    order = np.argsort(sequence_positions, kind='stable')
+    found = np.searchsorted(sequence_positions, positions, sorter=order)
+    rows = order[np.minimum(found, order.size - 1)]
+    missing = sequence_positions[rows] != positions
+    if missing.any():
+        raise ValueError(f"No row of the states was predicted at position {positions[missing][0]}, the rows are "
+                         f"at sequence positions {sequence_positions.min()} to {sequence_positions.max()}")
+    return rows
+
+def query_rows(input_file, positions):
+    """
+    0-based rows of query positions of a states file, in the numbering of open_states.
+    Queries use the same numbering as the hits: sequence positions for HDF5 stores
+    with a "position" dataset, 1-based row numbers for every other file.
+    """
+    sequence_positions = load_sequence_positions(input_file)
+    if sequence_positions is None:
+        return np.asarray(positions, dtype=np.int64).reshape(-1) - 1
+    return rows_at_positions(sequence_positions, positions)
+
+def open_states(input_file):
+    """
+    Open a states file for row access.
+
+    Parameters:
+    - input_file: Path to the states file written by `interprete run` (.npy, .h5 or .csv).
+
+    Returns:
+    - states: A 2-D array with one row per position. Binary stores are memory-mapped,
+      or read chunk by chunk for HDF5, so rows are read from disk on access without
+      parsing or copying the file.
+    """
+    if is_hdf5_store(input_file):
+        return open_hdf5(input_file, FIRST_ROW)
+    if is_binary_store(input_file):
+        return np.load(input_file, mmap_mode='r')[FIRST_ROW:]
+    return pd.read_csv(input_file, skiprows=1).values.astype('float32')
+
+@contextmanager
+def opened_states(input_file):
+    """
+    open_states for a with block, closing the file of an HDF5 store at its end.
+    """
+    states = open_states(input_file)
+    try:
+        yield states
+    finally:
+        if isinstance(states, HDF5States):
+            states.close()
+
+def offsets_path(input_file):
+    return input_file + ".offsets.npy"
+
+def build_row_offsets(input_file, buffer_size=1 << 26):
+    """
+    Find the byte offset of every line of a CSV states file.
+
+    Returns:
+    - offsets: int64 array with the start of every line, including the header,
+      followed by the file size, so line i spans offsets[i]:offsets[i + 1].
+    """
+    starts = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(input_file, 'rb') as file:
+        while True:
+            buffer = file.read(buffer_size)
+            if not buffer:
+                break
+            newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines.astype(np.int64) + position + 1)
+            position += len(buffer)
+    offsets = np.concatenate(starts)
+    if offsets[-1] != position:
+        # The last line has no trailing newline
+        offsets = np.append(offsets, position)
+    return offsets
+
+def load_row_offsets(input_file):
+    """
+    Load the row-offset sidecar of a CSV states file (<input>.offsets.npy), building it
+    on first use. The sidecar is rebuilt when the CSV file changed since it was written.
+    """
+    sidecar = offsets_path(input_file)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(input_file):
+        offsets = np.load(sidecar)
+        if offsets[-1] == os.path.getsize(input_file):
+            return offsets
+
+    offsets = build_row_offsets(input_file)
+    try:
+        np.save(sidecar, offsets)
+    except OSError:
+        # Read-only location, the offsets are only kept for this call
+        pass
+    return offsets
+
+def read_rows(input_file, rows):
+    """
+    Read selected rows of a states file without parsing the rest of it.
+
+    Parameters:
+    - input_file: Path to the states file (.npy, .h5 or .csv).
+    - rows: 0-based row numbers, in the numbering of open_states.
+
+    Returns:
+    - states: A float32 array with one row per requested row, in the given order.
+      Binary stores are indexed directly, CSV rows are located with the row-offset
+      sidecar and only the requested lines are parsed.
+    """
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+    if is_binary_store(input_file):
+        with opened_states(input_file) as states:
+            if rows.size and (rows.min() < 0 or rows.max() >= states.shape[0]):
+                raise IndexError(f"Rows must be between 1 and {states.shape[0]}")
+            return np.array(states[rows], dtype='float32', order='C')
+
+    offsets = load_row_offsets(input_file)
+    # Line 0 is the header and FIRST_ROW more lines are skipped, like open_states
+    n_rows = offsets.size - 2 - FIRST_ROW
+    if rows.size and (rows.min() < 0 or rows.max() >= n_rows):
+        raise IndexError(f"Rows must be between 1 and {n_rows}")
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    lines = unique_rows + 1 + FIRST_ROW
+
+    # Read each run of consecutive lines with a single seek, so ranges are one read
+    breaks = np.flatnonzero(np.diff(lines) != 1) + 1
+    chunks = []
+    with open(input_file, 'rb') as file:
+        for run in np.split(lines, breaks):
+            if run.size == 0:
+                continue
+            file.seek(offsets[run[0]])
+            chunks.append(file.read(offsets[run[-1] + 1] - offsets[run[0]]).rstrip(b'\r\n') + b'\n')
+    if not chunks:
+        with open(input_file, 'rb') as file:
+            n_columns = file.readline().count(b',') + 1
+        return np.empty((0, n_columns), dtype='float32')
+
+    # Parse with the same CSV parser as open_states, so the values are identical
+    states = pd.read_csv(io.BytesIO(b''.join(chunks)), header=None).values.astype('float32')
+    return np.ascontiguousarray(states[inverse])
+
+def iter_state_chunks(input_file, chunk_size):
+    """
+    Read a states file incrementally, skipping the same first row as open_states.
+
+    Parameters:
+    - input_file: Path to the states file (.npy, .h5 or .csv).
+    - chunk_size: Maximum number of rows per chunk.
+
+    Yields:
+    - chunk: A writable, C-contiguous float32 array of at most chunk_size rows.
+    """
+    if is_binary_store(input_file):
+        with opened_states(input_file) as states:
+            for start in range(0, states.shape[0], chunk_size):
+                yield np.array(states[start:start + chunk_size], dtype='float32', order='C')
+    else:
+        for df in pd.read_csv(input_file, skiprows=1, chunksize=chunk_size):
+            yield np.array(df.values, dtype='float32', order='C')
+
+def read_all_rows(input_file):
+    """
+    Read every row of a states file, including the one skipped by open_states.
+    """
+    if is_hdf5_store(input_file):
+        return open_hdf5(input_file)
+    if is_binary_store(input_file):
+        return np.load(input_file, mmap_mode='r')
+    return pd.read_csv(input_file).values.astype('float32')
+
+def write_states(states, output_file, positions=None):
+    """
+    Write a states matrix as a binary store (.npy), a chunked and compressed HDF5
+    store (.h5) or as CSV in the layout of `interprete run`.
+
+    Parameters:
+    - states: 2-D array of hidden states, including the first row.
+    - output_file: Path to the output file. The format follows the extension.
+    - positions: Optional sequence position of every row, kept in HDF5 stores.
+    """
+    # Reads lazy stores such as HDF5States into memory once for every format
+    states = np.asarray(states, dtype='float32')
+    if is_hdf5_store(output_file):
+        import h5py
+        # Chunks of about 1 MB of whole rows, like the stores of `interprete run`
+        chunk_rows = max(1, min(states.shape[0], (1 << 18) // max(states.shape[1], 1)))
+        with h5py.File(output_file, 'w') as file:
+            file.create_dataset("states", data=states, chunks=(chunk_rows, states.shape[1]) if states.size else None,
+                                compression="gzip", compression_opts=4)
+            if positions is not None:
+                file.create_dataset("position", data=np.asarray(positions, dtype=np.int64))
+    elif is_binary_store(output_file):
+        np.save(output_file, states)
+    else:
+        header = [f"V{i + 1}" for i in range(states.shape[1])]
+        pd.DataFrame(states, columns=header).to_csv(output_file, index=False)
+
+def convert_states(input_file, output_file):
+    """
+    Convert a states file between the CSV and binary formats.
+    """
+    states = read_all_rows(input_file)
+    try:
+        positions = None
+        if isinstance(states, HDF5States) and "position" in states.file:
+            positions = states.file["position"][:]
+        write_states(states, output_file, positions)
+    finally:
+        if isinstance(states, HDF5States):
+            states.close()
+    return states.shape
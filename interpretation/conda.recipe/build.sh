@@ -5,11 +5,23 @@ set -e
 #wget -P $PREFIX/lib/interprete https://f000.backblazeb2.com/file/genomenet/models/virus_genus_2023-01-23.hdf5
 
 mkdir -p $PREFIX/bin
+# Helper modules and R scripts, kept apart from those of the other packages
+mkdir -p $PREFIX/share/interpretation
 
 # Install the Python script
 echo "Installing the scripts..."
 cp $SRC_DIR/interprete.py $PREFIX/bin/interprete  # copy it to the bin directory
-cp $SRC_DIR/predict.r $PREFIX/bin/predict.r  # copy it to the bin directory
+cp $SRC_DIR/predict.r $PREFIX/share/interpretation/predict.r
+cp $SRC_DIR/r_worker.py $PREFIX/share/interpretation/r_worker.py
+cp $SRC_DIR/metrics.py $PREFIX/share/interpretation/metrics.py
+cp $SRC_DIR/model_cache.py $PREFIX/share/interpretation/model_cache.py
+
+# Modules of the 'pipeline' command
+cp $SRC_DIR/query.py $PREFIX/share/interpretation/query.py
+cp $SRC_DIR/state_store.py $PREFIX/share/interpretation/state_store.py
+cp $SRC_DIR/exact_search.py $PREFIX/share/interpretation/exact_search.py
+cp $SRC_DIR/gff_index.py $PREFIX/share/interpretation/gff_index.py
+cp $SRC_DIR/result_writer.py $PREFIX/share/interpretation/result_writer.py
 
 # Make the script executable
 chmod +x $PREFIX/bin/interprete
@@ -0,0 +1,118 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 65536
+
+def normalized_block(states, start, stop, normalized=False):
+    """
+    Copy rows start:stop of a (memory-mapped) state matrix into a contiguous float32
+    block, normalized for cosine similarity unless the matrix already is.
+    """
+    block = np.array(states[start:stop], dtype='float32', order='C')
+    if not normalized:
+        faiss.normalize_L2(block)
+    return block
+
+def block_scores(block, query_vectors):
+    """
+    Inner products of every query with every row of a block.
+
+    Uses the FAISS kernel that IndexFlatIP uses for batches below
+    faiss.cvar.distance_compute_blas_threshold queries. Each score only depends on
+    its row and query, so the scores match the IndexFlatIP search bit for bit,
+    whatever the block size or thread count.
+    """
+    scores = np.empty((query_vectors.shape[0], block.shape[0]), dtype='float32')
+    for query, query_scores in zip(query_vectors, scores):
+        faiss.fvec_inner_products_ny(faiss.swig_ptr(query_scores), faiss.swig_ptr(query), faiss.swig_ptr(block),
+                                     block.shape[1], block.shape[0])
+    return scores
+
+def scan_blocks(states, query_vectors, reduce, block_size=DEFAULT_BLOCK_SIZE, threads=None, normalized=False):
+    """
+    Score the queries against a state matrix block by block on a thread pool.
+
+    Parameters:
+    - states: 2-D array of states, usually memory-mapped.
+    - query_vectors: Normalized, C-contiguous float32 query matrix.
+    - reduce: Function (start, scores) -> result, applied to each block so only its
+      reduced result is kept.
+    - block_size: Number of rows per block.
+    - threads: Number of worker threads, one per CPU if None.
+    - normalized: Whether the rows of states are already normalized.
+
+    Returns:
+    - results: The reduced result of every block, in row order.
+    """
+    def score(start):
+        block = normalized_block(states, start, start + block_size, normalized)
+        return reduce(start, block_scores(block, query_vectors))
+
+    # FAISS releases the GIL, so blocks are scored in parallel. At most one block per
+    # thread is held in memory, and map keeps the results in row order.
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+        return list(executor.map(score, range(0, states.shape[0], block_size)))
+
+def rank(rows, similarities, top_k=None):
+    """
+    Sort hits by decreasing similarity, ties by row, and keep the top_k best.
+    """
+    order = np.lexsort((rows, -similarities))[:top_k]
+    return rows[order], similarities[order]
+
+def exact_search(states, query_vectors, top_k=None, min_similarity=None, full_track=False,
+                 block_size=DEFAULT_BLOCK_SIZE, threads=None, normalized=False):
+    """
+    Exact cosine similarity search over a state matrix, streamed in fixed-size blocks.
+
+    Parameters:
+    - states: 2-D array of states, usually memory-mapped so only the current blocks
+      are read into memory.
+    - query_vectors: Normalized query matrix.
+    - top_k: Number of most similar rows to return per query. All rows are ranked if None.
+    - min_similarity: Only return rows above this similarity.
+    - full_track: Return the similarity of every row, ordered by row, instead of hits.
+    - block_size: Number of rows scored at once.
+    - threads: Number of worker threads, one per CPU if None.
+    - normalized: Whether the rows of states are already normalized.
+
+    Returns:
+    - batch_results: One (rows, similarities) pair of arrays per query, sorted by
+      decreasing similarity, or by row for the full track.
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+    n_queries = query_vectors.shape[0]
+
+    if full_track or (top_k is None and min_similarity is None):
+        tracks = np.hstack(scan_blocks(states, query_vectors, lambda start, scores: scores,
+                                       block_size, threads, normalized))
+        rows = np.arange(tracks.shape[1])
+        if full_track:
+            return [(rows, track) for track in tracks]
+        return [rank(rows, track) for track in tracks]
+
+    def select(start, scores):
+        # Keep the hits of each query in this block: every row above the threshold, or
+        # every row tied with or above the block's k-th best so ties are resolved by row
+        hits = []
+        for query_scores in scores:
+            if min_similarity is not None:
+                keep = np.flatnonzero(query_scores > min_similarity)
+            else:
+                keep = np.arange(query_scores.size)
+            if top_k is not None and keep.size > top_k:
+                kth = np.partition(query_scores[keep], keep.size - top_k)[keep.size - top_k]
+                keep = keep[query_scores[keep] >= kth]
+            hits.append((keep + start, query_scores[keep]))
+        return hits
+
+    blocks = scan_blocks(states, query_vectors, select, block_size, threads, normalized)
+    batch_results = []
+    for q in range(n_queries):
+        rows = np.concatenate([block[q][0] for block in blocks])
+        similarities = np.concatenate([block[q][1] for block in blocks])
+        batch_results.append(rank(rows, similarities, top_k))
+    return batch_results
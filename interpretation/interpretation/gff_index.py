@@ -0,0 +1,243 @@
+import os
+
+import numpy as np
+
+# Separator used when a position overlaps more than one feature
+FEATURE_SEPARATOR = "|"
+
+# Version of the compiled annotation cache, bump it when its layout changes
+COMPILED_VERSION = 1
+
+def build_feature_index(starts, ends, types, descriptions, seqids=None):
+    """
+    Build an interval index from parallel lists of feature coordinates.
+
+    Parameters:
+    - starts: 1-based inclusive start positions.
+    - ends: 1-based inclusive end positions.
+    - types: Feature types (e.g. gene, CDS).
+    - descriptions: Feature descriptions (the 'product' qualifier).
+    - seqids: Optional sequence (record) id of each feature.
+
+    Returns:
+    - features: A dictionary of NumPy arrays sorted by start position.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    order = np.argsort(starts, kind='stable')
+    if seqids is None:
+        seqids = [""] * len(starts)
+    return {
+        "start": starts[order],
+        "end": np.asarray(ends, dtype=np.int64)[order],
+        "type": np.asarray(types, dtype=object)[order],
+        "description": np.asarray(descriptions, dtype=object)[order],
+        "seqid": np.asarray(seqids, dtype=object)[order],
+    }
+
+def read_gff(gff_file):
+    """
+    Parse a GFF file with BioPython's GFF parser into an interval index.
+    """
+    from BCBio import GFF
+
+    starts, ends, types, descriptions, seqids = [], [], [], [], []
+    with open(gff_file, 'r') as file:
+        for rec in GFF.parse(file):
+            for feature in rec.features:
+                if feature.type == "region":  # Skip the 'region' feature
+                    continue
+                starts.append(int(feature.location.start) + 1)
+                ends.append(int(feature.location.end))
+                types.append(feature.type)
+                descriptions.append(feature.qualifiers.get("product", [""])[0])
+                seqids.append(rec.id)
+    return build_feature_index(starts, ends, types, descriptions, seqids)
+
+def compiled_path(gff_file):
+    return gff_file + ".features.npz"
+
+def source_signature(gff_file):
+    stat = os.stat(gff_file)
+    return np.array([COMPILED_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def save_compiled(features, gff_file):
+    """
+    Save a feature index as compact arrays: coordinates, and the types, descriptions
+    and seqids as codes into their unique (interned) values. The cache is written next
+    to the GFF file and skipped if that location is read-only.
+    """
+    arrays = {"source": source_signature(gff_file), "start": features["start"], "end": features["end"]}
+    for key in ("type", "description", "seqid"):
+        names, codes = np.unique(features[key].astype(str), return_inverse=True)
+        arrays[f"{key}_names"] = names
+        arrays[f"{key}_codes"] = codes.astype(np.int32)
+
+    output_file = compiled_path(gff_file)
+    tmp_file = f"{output_file}.{os.getpid()}.npz"
+    try:
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, output_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def load_compiled(gff_file):
+    """
+    Load the compiled feature index of a GFF file, or None if there is none or the GFF
+    file changed since it was compiled.
+    """
+    try:
+        with np.load(compiled_path(gff_file), allow_pickle=False) as compiled:
+            if not np.array_equal(compiled["source"], source_signature(gff_file)):
+                return None
+            features = {"start": compiled["start"], "end": compiled["end"]}
+            for key in ("type", "description", "seqid"):
+                # Every feature refers to one shared string object per unique value
+                names = compiled[f"{key}_names"].astype(object)
+                features[key] = names[compiled[f"{key}_codes"]]
+    except (OSError, KeyError, ValueError):
+        return None
+    return features
+
+def select_seqid(features, seqid):
+    """
+    Restrict a feature index to the features of one sequence (record) id.
+    """
+    keep = features["seqid"] == seqid
+    if not keep.any():
+        known = ", ".join(sorted(set(features["seqid"])))
+        raise ValueError(f"No features with seqid {seqid} in the GFF file (seqids: {known})")
+    return {key: values[keep] for key, values in features.items()}
+
+def parse_gff(gff_file, seqid=None, use_cache=True):
+    """
+    Parse the provided GFF file into an interval index using BioPython's GFF parser.
+    The result is compiled into a cache next to the GFF file (<gff>.features.npz),
+    which later calls load instead of parsing until the GFF file changes.
+
+    Parameters:
+    - gff_file: Path to the GFF file.
+    - seqid: Only keep the features of this sequence id. Features of all sequences
+      are kept if None.
+    - use_cache: Whether to read and write the compiled cache.
+
+    Returns:
+    - features: A dictionary of NumPy arrays ('start', 'end', 'type', 'description',
+      'seqid') sorted by start position. 'region' features are skipped since they span
+      the whole sequence.
+    """
+    features = load_compiled(gff_file) if use_cache else None
+    if features is None:
+        features = read_gff(gff_file)
+        if use_cache:
+            save_compiled(features, gff_file)
+    if seqid is not None:
+        features = select_seqid(features, seqid)
+    return features
+
+def find_overlaps(positions, features):
+    """
+    Find every feature overlapping each of the given positions.
+
+    Each feature is located in the sorted positions with two binary searches, so the
+    cost is O((positions + features) log positions + overlaps) instead of one scan of
+    all features per position.
+
+    Parameters:
+    - positions: 1-based positions to annotate.
+    - features: The feature index returned by parse_gff.
+
+    Returns:
+    - (position_idx, feature_idx): Index arrays into positions and features, one entry
+      per overlap, ordered by position_idx and then by feature start.
+    """
+    positions = np.asarray(positions, dtype=np.int64).ravel()
+    empty = np.empty(0, dtype=np.int64)
+    if not features or len(features["start"]) == 0 or positions.size == 0:
+        return empty, empty
+
+    order = np.argsort(positions, kind='stable')
+    sorted_positions = positions[order]
+    lo = np.searchsorted(sorted_positions, features["start"], side='left')
+    hi = np.searchsorted(sorted_positions, features["end"], side='right')
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return empty, empty
+
+    # Expand each feature into the run of sorted positions it covers
+    feature_idx = np.repeat(np.arange(len(counts)), counts)
+    run_offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    position_idx = order[np.repeat(lo, counts) + run_offsets]
+
+    pair_order = np.lexsort((feature_idx, position_idx))
+    return position_idx[pair_order], feature_idx[pair_order]
+
+def get_annotations(positions, features):
+    """
+    Retrieve the annotations of many positions in one vectorized call.
+
+    Parameters:
+    - positions: 1-based positions to annotate.
+    - features: The feature index returned by parse_gff.
+
+    Returns:
+    - (feature_types, descriptions): Object arrays aligned with positions. Positions
+      overlapping several features get their values joined with FEATURE_SEPARATOR,
+      positions without a feature get "NA".
+    """
+    positions = np.asarray(positions, dtype=np.int64).ravel()
+    feature_types = np.full(positions.size, "NA", dtype=object)
+    descriptions = np.full(positions.size, "NA", dtype=object)
+
+    position_idx, feature_idx = find_overlaps(positions, features)
+    if position_idx.size == 0:
+        return feature_types, descriptions
+
+    group_starts = np.flatnonzero(np.r_[True, position_idx[1:] != position_idx[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, position_idx.size])
+
+    # Most positions overlap a single feature and can be assigned directly
+    single = group_sizes == 1
+    targets = position_idx[group_starts[single]]
+    feature_types[targets] = features["type"][feature_idx[group_starts[single]]]
+    descriptions[targets] = features["description"][feature_idx[group_starts[single]]]
+
+    for start, size in zip(group_starts[~single], group_sizes[~single]):
+        hits = feature_idx[start:start + size]
+        feature_types[position_idx[start]] = FEATURE_SEPARATOR.join(features["type"][hits])
+        descriptions[position_idx[start]] = FEATURE_SEPARATOR.join(features["description"][hits])
+
+    return feature_types, descriptions
+
+def get_annotation(position, features):
+    """
+    Retrieve the annotation of a single position.
+
+    Parameters:
+    - position: The position to annotate.
+    - features: The feature index returned by parse_gff.
+
+    Returns:
+    - (feature_type, description): A tuple containing the feature type and description.
+    """
+    feature_types, descriptions = get_annotations([position], features)
+    return feature_types[0], descriptions[0]
+
+def describe_positions(positions, features):
+    """
+    Format the annotations of positions for console output.
+
+    Parameters:
+    - positions: 1-based positions to annotate.
+    - features: The feature index returned by parse_gff.
+
+    Returns:
+    - labels: One string per position listing every overlapping feature.
+    """
+    positions = np.asarray(positions, dtype=np.int64).ravel()
+    labels = [""] * positions.size
+    position_idx, feature_idx = find_overlaps(positions, features)
+    for i, j in zip(position_idx, feature_idx):
+        labels[i] += f" | {features['type'][j]} (product={features['description'][j]})"
+    return [label or " (no overlapping feature)" for label in labels]
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import faiss
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "interpretation"))
+from exact_search import exact_search
+
+@pytest.fixture
+def states(tmp_path):
+    """
+    A memory-mapped state matrix with repeated rows, so some similarities are tied.
+    """
+    rng = np.random.default_rng(5)
+    states = rng.standard_normal((5000, 48)).astype('float32')
+    states[4000:4100] = states[100:200]
+    np.save(tmp_path / "states.npy", states)
+    return np.load(tmp_path / "states.npy", mmap_mode='r')
+
+def flat_search(states, query_vectors):
+    """
+    The similarity of every row to each query, as searched by IndexFlatIP.
+    """
+    normalized = np.array(states, dtype='float32')
+    faiss.normalize_L2(normalized)
+    index = faiss.IndexFlatIP(normalized.shape[1])
+    index.add(normalized)
+    similarities, rows = index.search(query_vectors, index.ntotal)
+    tracks = np.empty_like(similarities)
+    for track, query_rows, query_similarities in zip(tracks, rows, similarities):
+        track[query_rows] = query_similarities
+    return tracks
+
+def queries(states, rows):
+    query_vectors = np.array(states[rows], dtype='float32')
+    faiss.normalize_L2(query_vectors)
+    return query_vectors
+
+def test_track_matches_flat_index(states):
+    query_vectors = queries(states, [3, 150, 4999])
+    tracks = flat_search(states, query_vectors)
+
+    # Bit for bit, whatever the block size and thread count
+    for block_size, threads in ((65536, None), (777, 3), (1, 1)):
+        results = exact_search(states, query_vectors, full_track=True, block_size=block_size, threads=threads)
+        for (rows, track), expected in zip(results, tracks):
+            np.testing.assert_array_equal(rows, np.arange(5000))
+            assert np.array_equal(track, expected)
+
+def test_hits_match_flat_index(states):
+    query_vectors = queries(states, [3, 150, 4999])
+    tracks = flat_search(states, query_vectors)
+
+    for (rows, similarities), track in zip(exact_search(states, query_vectors, top_k=20, block_size=512), tracks):
+        # Ties are ranked by row
+        expected = np.lexsort((np.arange(track.size), -track))[:20]
+        np.testing.assert_array_equal(rows, expected)
+        assert np.array_equal(similarities, track[expected])
+
+    for (rows, similarities), track in zip(exact_search(states, query_vectors, min_similarity=0.2, block_size=512),
+                                           tracks):
+        np.testing.assert_array_equal(np.sort(rows), np.flatnonzero(track > 0.2))
+        assert np.array_equal(similarities, track[rows])
+        assert np.all(np.diff(similarities) <= 0)
+
+def test_ties_across_blocks(states):
+    # Row 150 and its copy 4050 are in different blocks, both are kept in row order
+    rows, similarities = exact_search(states, queries(states, [150]), top_k=2, block_size=1000)[0]
+    np.testing.assert_array_equal(rows, [150, 4050])
+    assert similarities[0] == similarities[1]
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from urllib3.exceptions import ProtocolError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "interpretation"))
+import model_cache
+from model_cache import blob_path, cache_url, fetch, install, is_installed
+
+MODEL = os.urandom(3 * 1024 * 1024 + 12345)
+
+class ModelServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the model host: serves one file with an ETag and range
+    requests, and can cut the first transfer short or ignore ranges.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ModelHandler)
+        self.content = MODEL
+        self.etag = '"v1"'
+        self.truncate_at = None
+        self.ignore_range = False
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/model.h5"
+
+class ModelHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append({"Range": self.headers.get("Range"), "If-Range": self.headers.get("If-Range")})
+        start = 0
+        requested = self.headers.get("Range")
+        if requested and not server.ignore_range and self.headers.get("If-Range", server.etag) == server.etag:
+            start = int(requested[len("bytes="):].rstrip("-"))
+        body = server.content[start:]
+
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{len(server.content) - 1}/{len(server.content)}")
+        self.end_headers()
+        if server.truncate_at is not None:
+            # Drop the connection mid-transfer, once
+            body, server.truncate_at = body[:server.truncate_at], None
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(model_cache.time, "sleep", lambda seconds: None)
+    server = ModelServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def read(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+def test_resume_after_truncated_transfer(tmp_path, server):
+    # Less than one chunk is received before the connection drops
+    server.truncate_at = 300000
+    blob = cache_url(server.url, str(tmp_path), hashlib.sha256(MODEL).hexdigest())
+
+    assert read(blob) == MODEL
+    assert server.requests[1] == {"Range": "bytes=300000-", "If-Range": '"v1"'}
+
+def test_changed_file_restarts_download(tmp_path, server):
+    part_file = str(tmp_path / "model.part")
+    server.truncate_at = 500000
+    with pytest.raises((ProtocolError, requests.exceptions.ChunkedEncodingError, model_cache.IncompleteDownload)):
+        fetch(server.url, part_file, retries=0)
+    assert os.path.getsize(part_file) == 500000
+
+    # The file changed on the server, If-Range no longer matches and the whole file is sent
+    server.content, server.etag = MODEL[::-1], '"v2"'
+    fetch(server.url, part_file)
+
+    assert server.requests[-1]["If-Range"] == '"v1"'
+    assert read(part_file) == MODEL[::-1]
+
+def test_server_ignoring_range(tmp_path, server):
+    part_file = str(tmp_path / "model.part")
+    server.truncate_at = 500000
+    server.ignore_range = True
+    fetch(server.url, part_file, retries=1)
+
+    assert server.requests[-1]["Range"] == "bytes=500000-"
+    assert read(part_file) == MODEL
+
+def test_bad_digest_is_rejected(tmp_path, server):
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        cache_url(server.url, str(tmp_path), "0" * 64)
+
+    assert os.listdir(tmp_path / "sha256") == []
+    assert not os.path.exists(tmp_path / "partial" / (model_cache.url_key(server.url) + ".part"))
+
+def test_first_digest_is_recorded(tmp_path, server):
+    blob = cache_url(server.url, str(tmp_path))
+    os.remove(blob)
+
+    # A later download of the URL must match the first one
+    server.content = MODEL[::-1]
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        cache_url(server.url, str(tmp_path))
+
+def test_corrupted_cache_is_downloaded_again(tmp_path, server):
+    blob = cache_url(server.url, str(tmp_path))
+    with open(blob, 'r+b') as file:
+        file.write(b"corrupt")
+
+    assert read(cache_url(server.url, str(tmp_path))) == MODEL
+    assert len(server.requests) == 2
+
+def test_installed_copy_is_independent_of_cache(tmp_path, server):
+    blob = cache_url(server.url, str(tmp_path / "cache"))
+    destination = str(tmp_path / "model.h5")
+    install(blob, destination)
+    assert is_installed(server.url, destination, str(tmp_path / "cache"))
+
+    with open(destination, 'r+b') as file:
+        file.truncate(100)
+
+    assert read(blob_path(str(tmp_path / "cache"), hashlib.sha256(MODEL).hexdigest())) == MODEL
+    assert not is_installed(server.url, destination, str(tmp_path / "cache"))
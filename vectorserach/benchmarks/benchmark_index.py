@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vectorsearch"))
+from vectorsearch import INDEX_TYPES, default_index_params, make_index, compute_similarities
+from state_store import open_states
+
+def synthetic_states(n_rows, dimension, n_clusters=64, correlation=0.95, seed=0):
+    """
+    Generate a state matrix that looks like the hidden states of a sequence model:
+    rows fall into clusters (sequence contexts) and neighbouring positions are
+    strongly correlated, since consecutive windows overlap.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dimension)).astype('float32')
+    # Contexts change in runs of positions, like genes along a genome
+    run_lengths = rng.geometric(1 / 500, size=n_rows)
+    labels = np.repeat(rng.integers(0, n_clusters, size=run_lengths.size), run_lengths)[:n_rows]
+    noise = rng.standard_normal((n_rows, dimension)).astype('float32')
+    # AR(1) smoothing along the positions
+    for i in range(1, n_rows):
+        noise[i] = correlation * noise[i - 1] + np.sqrt(1 - correlation ** 2) * noise[i]
+    states = centers[labels] + 0.5 * noise
+    return np.ascontiguousarray(states, dtype='float32')
+
+def recall_at_k(found, truth):
+    """
+    Fraction of the exact top-k rows that the approximate search returned.
+    """
+    hits = sum(len(np.intersect1d(f, t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+def benchmark_config(data, queries, index_type, k_values, truth, repeats):
+    params = default_index_params(index_type, data.shape[0], data.shape[1])
+    start = time.perf_counter()
+    index = make_index(params)
+    if not index.is_trained:
+        index.train(data)
+    index.add(data)
+    build_time = time.perf_counter() - start
+
+    result = {
+        "index_type": index_type,
+        "params": params,
+        "build_seconds": build_time,
+        "index_bytes": int(faiss.serialize_index(index).nbytes),
+        "search": [],
+    }
+    for k in k_values:
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            batch_results = compute_similarities(index, queries, top_k=k)
+            latencies.append(time.perf_counter() - start)
+        found = [rows for rows, _ in batch_results]
+        result["search"].append({
+            "k": k,
+            "query_ms": 1000 * min(latencies) / queries.shape[0],
+            "recall": recall_at_k(found, truth[:, :k]),
+        })
+    return result
+
+def compare(results, baseline_file):
+    """
+    Print the change of build time, latency and recall against an earlier run.
+    """
+    with open(baseline_file, 'r') as file:
+        baseline = json.load(file)
+    previous = {(r["rows"], r["index_type"]): r for r in baseline["results"]}
+    print(f"\nComparison with {baseline_file}:")
+    for result in results:
+        old = previous.get((result["rows"], result["index_type"]))
+        if old is None:
+            continue
+        print(f"{result['index_type']:>12} rows={result['rows']}: build {result['build_seconds'] / max(old['build_seconds'], 1e-9):.2f}x")
+        old_search = {s["k"]: s for s in old["search"]}
+        for search in result["search"]:
+            if search["k"] in old_search:
+                o = old_search[search["k"]]
+                print(f"{'':>12} k={search['k']}: latency {search['query_ms'] / max(o['query_ms'], 1e-9):.2f}x, "
+                      f"recall {search['recall'] - o['recall']:+.4f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark build time, size, latency and recall of the vectorsearch index types.")
+    parser.add_argument("--rows", type=int, nargs='+', default=[20000, 100000], help="Row counts of the synthetic state matrices.")
+    parser.add_argument("--dimension", type=int, default=256, help="Dimension of the synthetic states.")
+    parser.add_argument("--states", type=str, help="Benchmark a states file (CSV or .npy) instead of synthetic data.")
+    parser.add_argument("--index-types", choices=INDEX_TYPES, nargs='+', default=INDEX_TYPES, help="Index types to benchmark.")
+    parser.add_argument("--k", type=int, nargs='+', default=[1, 10, 100], help="Numbers of hits to search for.")
+    parser.add_argument("--queries", type=int, default=100, help="Number of query rows, searched as one batch.")
+    parser.add_argument("--repeats", type=int, default=3, help="Repetitions per search, the fastest is reported.")
+    parser.add_argument("--threads", type=int, help="Number of OpenMP threads used by FAISS.")
+    parser.add_argument("--output", type=str, help="Path to write the results as JSON.")
+    parser.add_argument("--compare", type=str, help="JSON output of an earlier run to compare against.")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    if args.states:
+        datasets = [(os.path.basename(args.states), np.array(open_states(args.states), dtype='float32', order='C'))]
+    else:
+        datasets = [(f"synthetic-{n}x{args.dimension}", synthetic_states(n, args.dimension)) for n in args.rows]
+
+    results = []
+    for name, data in datasets:
+        faiss.normalize_L2(data)
+        rng = np.random.default_rng(1)
+        queries = np.ascontiguousarray(data[rng.choice(data.shape[0], size=min(args.queries, data.shape[0]), replace=False)])
+
+        # Ground truth from the exact IndexFlatIP search used by query.py
+        exact = faiss.IndexFlatIP(data.shape[1])
+        exact.add(data)
+        _, truth = exact.search(queries, max(args.k))
+
+        for index_type in args.index_types:
+            result = benchmark_config(data, queries, index_type, args.k, truth, args.repeats)
+            result.update(dataset=name, rows=int(data.shape[0]), dimension=int(data.shape[1]))
+            results.append(result)
+            print(f"{name} {index_type:>12}: build {result['build_seconds']:.2f} s, "
+                  f"size {result['index_bytes'] / 2 ** 20:.1f} MiB")
+            for search in result["search"]:
+                print(f"{'':>{len(name)}} {'':>12}  k={search['k']:<4} {search['query_ms']:.3f} ms/query, "
+                      f"recall@k {search['recall']:.4f}")
+
+    if args.output:
+        report = {
+            "meta": {
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "faiss": faiss.__version__,
+                "numpy": np.__version__,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "cpus": os.cpu_count(),
+                "threads": faiss.omp_get_max_threads(),
+                "queries": args.queries,
+            },
+            "results": results,
+        }
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
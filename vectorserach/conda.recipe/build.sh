@@ -2,10 +2,17 @@
 set -e
 
 mkdir -p $PREFIX/bin
+# Helper modules, kept apart from those of the other packages
+mkdir -p $PREFIX/share/vectorsearch
 
 # Install the Python script
 echo "Installing the scripts..."
 cp $SRC_DIR/vectorsearch.py $PREFIX/bin/vectorsearch
+cp $SRC_DIR/gff_index.py $PREFIX/share/vectorsearch/gff_index.py
+cp $SRC_DIR/state_store.py $PREFIX/share/vectorsearch/state_store.py
+cp $SRC_DIR/result_writer.py $PREFIX/share/vectorsearch/result_writer.py
+cp $SRC_DIR/downsample.py $PREFIX/share/vectorsearch/downsample.py
+cp $SRC_DIR/metrics.py $PREFIX/share/vectorsearch/metrics.py
 
 # Make the script executable
 chmod +x $PREFIX/bin/vectorsearch
\ No newline at end of file
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vectorsearch"))
+from downsample import downsample, lttb_downsample, minmax_downsample
+
+def similarity_track(n=200000):
+    """
+    A similarity track like that of a search: noise with a narrow peak at the hit and a dip.
+    """
+    rng = np.random.default_rng(6)
+    x = np.arange(1, n + 1) * 100
+    y = 0.3 + 0.05 * rng.standard_normal(n)
+    y[123457] = 1.0
+    y[4321] = -0.4
+    y[[10, 99999]] = np.nan
+    return x, y
+
+def test_minmax_keeps_extrema_of_every_bin():
+    x, y = similarity_track()
+    sampled_x, sampled_y = minmax_downsample(x, y, 1000)
+
+    assert sampled_x.size <= 2000
+    assert np.all(np.diff(sampled_x) > 0)
+    assert not np.isnan(sampled_y).any()
+    # Every bin keeps its minimum and maximum
+    finite = ~np.isnan(y)
+    bins = np.minimum(((x[finite] - x[0]) * (1000 / (x[-1] - x[0]))).astype(np.int64), 999)
+    sampled_bins = np.minimum(((sampled_x - x[0]) * (1000 / (x[-1] - x[0]))).astype(np.int64), 999)
+    np.testing.assert_array_equal(np.unique(bins), np.unique(sampled_bins))
+    for b in range(0, 1000, 37):
+        values = y[finite][bins == b]
+        assert sampled_y[sampled_bins == b].max() == values.max()
+        assert sampled_y[sampled_bins == b].min() == values.min()
+
+def test_lttb_keeps_peak_and_ends():
+    x, y = similarity_track()
+    sampled_x, sampled_y = lttb_downsample(x, y, 2000)
+
+    assert sampled_x.size == 2000
+    assert np.all(np.diff(sampled_x) > 0)
+    assert sampled_x[0] == x[0] and sampled_x[-1] == x[-1]
+    assert sampled_y.max() == np.nanmax(y) and sampled_x[np.argmax(sampled_y)] == x[123457]
+    assert sampled_y.min() == np.nanmin(y) and sampled_x[np.argmin(sampled_y)] == x[4321]
+
+def test_short_tracks_are_kept():
+    x, y = similarity_track()
+    x, y = x[:500], y[:500]
+    for method in ("minmax", "lttb", "none"):
+        sampled_x, sampled_y = downsample(x, y, 1000, method)
+        np.testing.assert_array_equal(sampled_x, x if method == "none" else x[~np.isnan(y)])
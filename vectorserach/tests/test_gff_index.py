@@ -0,0 +1,72 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vectorsearch"))
+from gff_index import FEATURE_SEPARATOR, compiled_path, get_annotation, get_annotations, parse_gff
+
+@pytest.fixture
+def gff_file(tmp_path):
+    """
+    A GFF file with overlapping genes and CDS features on two sequences, sorted by
+    start like the GFF files of NCBI.
+    """
+    rng = np.random.default_rng(3)
+    starts = np.sort(rng.integers(1, 20000, 300))
+    ends = starts + rng.integers(0, 1500, 300)
+    lines = ["##gff-version 3", "chr1\tRefSeq\tregion\t1\t25000\t.\t+\t.\tID=chr1"]
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        seqid = "chr1" if i % 3 else "chr2"
+        feature_type = "gene" if i % 2 else "CDS"
+        lines.append(f"{seqid}\tRefSeq\t{feature_type}\t{start}\t{end}\t.\t+\t.\tID=f{i};product=protein {i}")
+    path = str(tmp_path / "genome.gff")
+    with open(path, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    return path, starts, ends
+
+def linear_annotation(position, starts, ends, types, descriptions):
+    # Scans every feature like the lookup before the interval index, but keeps every match
+    hits = [i for i, (start, end) in enumerate(zip(starts, ends)) if start <= position <= end]
+    if not hits:
+        return "NA", "NA"
+    return (FEATURE_SEPARATOR.join(types[i] for i in hits), FEATURE_SEPARATOR.join(descriptions[i] for i in hits))
+
+def test_annotations_match_linear_scan(gff_file):
+    path, _, _ = gff_file
+    features = parse_gff(path, use_cache=False)
+    assert "region" not in set(features["type"])
+
+    positions = np.r_[np.random.default_rng(4).integers(1, 23000, 2000), features["start"][:50], features["end"][:50]]
+    feature_types, descriptions = get_annotations(positions, features)
+    for position, feature_type, description in zip(positions, feature_types, descriptions):
+        assert (feature_type, description) == linear_annotation(position, features["start"], features["end"],
+                                                                features["type"], features["description"])
+    assert get_annotation(positions[0], features) == (feature_types[0], descriptions[0])
+
+def test_single_features_match_baseline(gff_file):
+    path, starts, ends = gff_file
+    features = parse_gff(path, use_cache=False)
+
+    # Positions covered by one feature are annotated with it, as by the first match of the baseline
+    positions = np.arange(1, 23000)
+    coverage = ((positions[:, None] >= starts) & (positions[:, None] <= ends)).sum(axis=1)
+    feature_types, descriptions = get_annotations(positions, features)
+    assert set(feature_types[coverage == 0]) == {"NA"}
+    for position, description in zip(positions[coverage == 1], descriptions[coverage == 1]):
+        i = np.flatnonzero((starts <= position) & (position <= ends))[0]
+        assert description == f"protein {i}"
+
+def test_compiled_cache_and_seqid(gff_file):
+    path, _, _ = gff_file
+    parsed = parse_gff(path)
+    assert os.path.exists(compiled_path(path))
+    cached = parse_gff(path)
+    for key in ("start", "end", "type", "description", "seqid"):
+        np.testing.assert_array_equal(cached[key], parsed[key])
+
+    chr2 = parse_gff(path, "chr2")
+    assert set(chr2["seqid"]) == {"chr2"} and len(chr2["start"]) == 100
+    with pytest.raises(ValueError, match="No features with seqid chr3"):
+        parse_gff(path, "chr3")
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import h5py
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vectorsearch"))
+from result_writer import results_table
+from state_store import (FIRST_ROW, convert_states, iter_state_chunks, load_sequence_positions, open_states,
+                         read_rows)
+
+@pytest.fixture
+def hdf5_store(tmp_path):
+    """
+    A store like the ones of `interprete run --format h5 --step 100 --pool 2`.
+    """
+    states = np.random.default_rng(0).random((11, 4)).astype('float32')
+    positions = np.arange(1, 12, dtype=np.int64) * 200
+    path = str(tmp_path / "states.h5")
+    with h5py.File(path, 'w') as file:
+        file.create_dataset("states", data=states, chunks=(3, 4), compression="gzip")
+        file.create_dataset("position", data=positions)
+    return path, states, positions
+
+@pytest.mark.parametrize("extension", [".csv", ".npy", ".h5"])
+def test_convert_hdf5_round_trip(tmp_path, hdf5_store, extension):
+    path, states, _ = hdf5_store
+    output = str(tmp_path / ("converted" + extension))
+
+    assert convert_states(path, output) == states.shape
+
+    converted = open_states(output)
+    np.testing.assert_allclose(np.asarray(converted), states[FIRST_ROW:], rtol=1e-6)
+    if extension == ".h5":
+        converted.close()
+
+def test_convert_csv_back_to_hdf5(tmp_path, hdf5_store):
+    path, states, _ = hdf5_store
+    csv = str(tmp_path / "states.csv")
+    convert_states(path, csv)
+    convert_states(csv, str(tmp_path / "back.h5"))
+
+    np.testing.assert_allclose(read_rows(str(tmp_path / "back.h5"), [0, 5, 2]),
+                               states[FIRST_ROW:][[0, 5, 2]], rtol=1e-6)
+
+def test_hdf5_store_is_closed(hdf5_store):
+    path, states, _ = hdf5_store
+
+    with open_states(path) as store:
+        np.testing.assert_array_equal(store[[3, 1]], states[FIRST_ROW:][[3, 1]])
+    assert not store.file.id.valid
+
+    chunks = list(iter_state_chunks(path, 4))
+    np.testing.assert_array_equal(np.concatenate(chunks), states[FIRST_ROW:])
+    # No handle is left open, so the file can be rewritten
+    with h5py.File(path, 'w'):
+        pass
+
+def test_sequence_positions(tmp_path, hdf5_store):
+    path, _, positions = hdf5_store
+
+    np.testing.assert_array_equal(load_sequence_positions(path), positions[FIRST_ROW:])
+    assert load_sequence_positions(str(tmp_path / "states.npy")) is None
+    assert load_sequence_positions(None) is None
+
+    # Converting between HDF5 stores keeps the positions
+    convert_states(path, str(tmp_path / "copy.h5"))
+    np.testing.assert_array_equal(load_sequence_positions(str(tmp_path / "copy.h5")), positions[FIRST_ROW:])
+
+def test_hits_are_labelled_with_sequence_positions(hdf5_store):
+    path, _, positions = hdf5_store
+    sequence_positions = load_sequence_positions(path)
+
+    table = results_table(np.array([4, 0]), np.array([0.5, 0.9]), {}, sequence_positions=sequence_positions)
+
+    assert list(table["Position"]) == [positions[FIRST_ROW], positions[FIRST_ROW + 4]]
+    assert list(table["Row"]) == [1, 5]
+    assert list(results_table(np.array([4, 0]), np.array([0.5, 0.9]), {})["Position"]) == [1, 5]
@@ -0,0 +1,249 @@
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import faiss
+import h5py
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "vectorsearch"))
+import vectorsearch
+from result_writer import read_table, write_results
+from state_store import FIRST_ROW, load_sequence_positions, open_states
+from vectorsearch import (SearchService, add_genome, append_index, build_index, compute_similarities, compute_track,
+                          default_index_params, drop_genome, extract_vectors, load_queries, make_handler, make_index,
+                          plot_similar_vectors, read_collection, read_index, read_params, search_collection,
+                          select_query)
+
+@pytest.fixture
+def hdf5_store(tmp_path):
+    """
+    A store like the ones of `interprete run --format h5 --step 100 --pool 2`.
+    """
+    states = np.random.default_rng(1).standard_normal((41, 8)).astype('float32')
+    positions = np.arange(1, 42, dtype=np.int64) * 200
+    path = str(tmp_path / "states.h5")
+    with h5py.File(path, 'w') as file:
+        file.create_dataset("states", data=states, chunks=(8, 8), compression="gzip")
+        file.create_dataset("position", data=positions)
+    return path, states[FIRST_ROW:], positions[FIRST_ROW:]
+
+def test_queries_use_sequence_positions(tmp_path, hdf5_store):
+    path, states, positions = hdf5_store
+
+    query_vectors, labels = load_queries(states_file=path, positions=[positions[7], positions[2]])
+    expected = states[[7, 2]] / np.linalg.norm(states[[7, 2]], axis=1, keepdims=True)
+    np.testing.assert_allclose(query_vectors, expected, rtol=1e-6)
+    assert labels == [positions[7], positions[2]]
+
+    extract_vectors(path, [positions[3], positions[5]], str(tmp_path / "vectors.npy"))
+    np.testing.assert_array_equal(np.load(tmp_path / "vectors.npy"), states[[3, 5]])
+
+    # Row numbers are no valid positions of the store
+    with pytest.raises(ValueError, match="No row of the states was predicted at position 8"):
+        load_queries(states_file=path, positions=[8])
+
+def test_plotsim_reads_rows_of_hdf5_hits(tmp_path, hdf5_store, monkeypatch):
+    path, states, positions = hdf5_store
+    index_file = str(tmp_path / "states.index")
+    build_index(path, index_file, "flat")
+    query_vectors, _ = load_queries(states_file=path, positions=[positions[10]])
+    rows, similarities = compute_similarities(read_index(index_file), query_vectors)[0]
+    search_output = str(tmp_path / "hits.csv")
+    write_results((rows, similarities), {}, search_output, sequence_positions=load_sequence_positions(path))
+
+    read = []
+    def read_rows(input_file, rows):
+        read.append(np.asarray(rows))
+        return states[rows]
+    monkeypatch.setattr(vectorsearch, "read_rows", read_rows)
+    plot_similar_vectors(search_output, path, str(tmp_path / "plotsim.png"))
+
+    # The plotted vectors are those of the hits, read at their row and not at their sequence position
+    hits = read_table(search_output).set_index("Row")
+    top = read[0][:5] + 1
+    np.testing.assert_array_equal(top, hits["Similarity"].sort_values(ascending=False).index[:5])
+    assert hits.loc[top[0], "Position"] == positions[10]
+
+def test_plotsim_rejects_short_outputs(tmp_path, hdf5_store):
+    path, _, _ = hdf5_store
+    search_output = str(tmp_path / "hits.csv")
+    write_results((np.arange(6), np.linspace(1, 0.5, 6)), {}, search_output)
+
+    with pytest.raises(ValueError, match="has 6 rows, plotsim needs at least 10"):
+        plot_similar_vectors(search_output, path, str(tmp_path / "plotsim.png"))
+
+def test_hnsw_track_is_exact():
+    data = np.random.default_rng(2).standard_normal((6000, 32)).astype('float32')
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    hnsw = make_index(default_index_params("hnsw", *data.shape))
+    hnsw.add(data)
+
+    # The graph search reaches only part of the rows for k = ntotal, the track scores all of them
+    rows, track = compute_track(hnsw, data[:1], chunk_size=1000)
+    np.testing.assert_array_equal(rows, np.arange(6000))
+    np.testing.assert_allclose(track, data @ data[0], atol=1e-5)
+
+    rows, similarities = compute_similarities(hnsw, data[:1], min_similarity=0.3)[0]
+    np.testing.assert_array_equal(np.sort(rows), np.flatnonzero(data @ data[0] > 0.3))
+    assert np.all(np.diff(similarities) <= 0)
+
+@pytest.fixture
+def search_server(tmp_path, hdf5_store):
+    path, _, _ = hdf5_store
+    build_index(path, str(tmp_path / "states.index"), "flat")
+    service = SearchService({"genome": {"index": str(tmp_path / "states.index"), "states": path, "gff": None}})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(service))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+def post(url, body):
+    try:
+        with urlopen(url, data=body.encode()) as response:
+            return response.status, json.load(response)
+    except HTTPError as e:
+        return e.code, json.load(e)
+
+def test_serve_answers_errors_with_json(search_server, hdf5_store, monkeypatch):
+    url = search_server
+    _, _, positions = hdf5_store
+
+    status, response = post(f"{url}/search", json.dumps({"positions": [int(positions[3])], "top_k": 3}))
+    assert status == 200 and response["results"][0]["hits"][0]["row"] == 4
+
+    assert post(f"{url}/search", "[1, 2]") == (400, {"error": "The request must be a JSON object"})
+    assert post(f"{url}/search", json.dumps({"positions": [5]}))[0] == 400
+
+    def fail(*args):
+        raise RuntimeError("Error in faiss::IndexFlat::search")
+    monkeypatch.setattr(vectorsearch, "compute_similarities", fail)
+    assert post(f"{url}/search", json.dumps({"positions": [int(positions[3])]})) == \
+        (500, {"error": "RuntimeError: Error in faiss::IndexFlat::search"})
+
+def test_batch_outputs_are_plotted_by_query(tmp_path):
+    track = str(tmp_path / "track.csv")
+    write_results([(np.arange(20), np.linspace(1, 0, 20)), (np.arange(20), np.linspace(0, 1, 20))], {}, track,
+                  labels=[5000, 7000])
+    df = read_table(track)
+
+    with pytest.raises(ValueError, match="holds 2 queries, select one with --query"):
+        select_query(df)
+    selected = select_query(df, "7000")
+    assert len(selected) == 20 and (selected["Query"] == 7000).all()
+    with pytest.raises(ValueError, match="Unknown query"):
+        select_query(df, 9)
+
+def clustered_states(path, centers, n_rows, seed):
+    rng = np.random.default_rng(seed)
+    states = centers[rng.integers(0, len(centers), n_rows)] + 0.1 * rng.standard_normal((n_rows, centers.shape[1]))
+    np.save(path, states.astype('float32'))
+    return path
+
+def read_centroids(index_file):
+    index = read_index(index_file)
+    ivf = faiss.extract_index_ivf(index)
+    return ivf.quantizer.reconstruct_n(0, ivf.nlist)
+
+def test_append_keeps_or_retrains_quantizer(tmp_path):
+    rng = np.random.default_rng(7)
+    centers, shifted_centers = rng.standard_normal((8, 16)), rng.standard_normal((8, 16))
+    first = clustered_states(str(tmp_path / "first.npy"), centers, 3000, 8)
+    similar = clustered_states(str(tmp_path / "similar.npy"), centers, 2000, 9)
+    shifted = clustered_states(str(tmp_path / "shifted.npy"), shifted_centers, 2000, 10)
+    index_file = str(tmp_path / "states.index")
+    build_index(first, index_file, "ivf-flat", nlist=8)
+    centroids = read_centroids(index_file)
+    train_residual = read_params(index_file)["train_residual"]
+
+    # Rows of the training distribution are added with the trained quantizer
+    params = append_index(similar, index_file)
+    np.testing.assert_array_equal(read_centroids(index_file), centroids)
+    assert params["train_residual"] == train_residual
+    assert [(source["name"], source["first_id"], source["rows"]) for source in params["sources"]] == \
+        [("first", 0, 2999), ("similar", 2999, 1999)]
+
+    # Rows far from the trained lists retrain the index on every source
+    params = append_index(shifted, index_file, gff=str(tmp_path / "shifted.gff"))
+    assert not np.array_equal(read_centroids(index_file), centroids)
+    assert params["rows"] == read_index(index_file).ntotal == 6997
+    assert [source["name"] for source in params["sources"]] == ["first", "similar", "shifted"]
+    assert [source["gff"] for source in params["sources"]] == [None, None, str(tmp_path / "shifted.gff")]
+
+    with pytest.raises(ValueError, match="already holds a source named similar"):
+        append_index(similar, index_file)
+    os.remove(first)
+    with pytest.raises(ValueError, match="the states of first are not available"):
+        append_index(shifted, index_file, name="again", drift_threshold=0)
+
+def test_append_matches_fresh_build(tmp_path):
+    centers = np.random.default_rng(11).standard_normal((8, 16))
+    first = clustered_states(str(tmp_path / "first.npy"), centers, 1500, 12)
+    second = clustered_states(str(tmp_path / "second.npy"), centers, 1500, 13)
+    build_index(first, str(tmp_path / "appended.index"), "flat")
+    append_index(second, str(tmp_path / "appended.index"))
+    build_index([first, second], str(tmp_path / "fresh.index"), "flat")
+
+    query_vectors, _ = load_queries(states_file=second, positions=[20, 700])
+    appended = compute_similarities(read_index(str(tmp_path / "appended.index")), query_vectors, 50)
+    fresh = compute_similarities(read_index(str(tmp_path / "fresh.index")), query_vectors, 50)
+    for (rows, similarities), (fresh_rows, fresh_similarities) in zip(appended, fresh):
+        np.testing.assert_array_equal(rows, fresh_rows)
+        np.testing.assert_array_equal(similarities, fresh_similarities)
+    sources = read_params(str(tmp_path / "appended.index"))["sources"]
+    assert sources == read_params(str(tmp_path / "fresh.index"))["sources"]
+
+def test_collection_search_merges_shards(tmp_path):
+    collection_dir = str(tmp_path / "collection")
+    centers = np.random.default_rng(14).standard_normal((8, 16))
+    genomes = {name: clustered_states(str(tmp_path / f"{name}.npy"), centers, 800, seed)
+               for name, seed in (("T4", 15), ("lambda", 16), ("P22", 17))}
+    for name, path in genomes.items():
+        add_genome(collection_dir, name, path, index_type="flat")
+    assert list(read_collection(collection_dir)["shards"]) == ["T4", "lambda", "P22"]
+
+    # The merged top k is the top k of all genomes
+    query_vectors, _ = load_queries(states_file=genomes["lambda"], positions=[5, 300])
+    states = {name: np.array(open_states(path)) for name, path in genomes.items()}
+    for name in states:
+        states[name] /= np.linalg.norm(states[name], axis=1, keepdims=True)
+    for query_vector, (names, rows, similarities) in zip(query_vectors, search_collection(collection_dir, query_vectors,
+                                                                                          top_k=10, workers=2)):
+        scores = np.concatenate([states[name] @ query_vector for name in genomes])
+        np.testing.assert_allclose(similarities, np.sort(scores)[::-1][:10], rtol=1e-5)
+        for name, row, similarity in zip(names, rows, similarities):
+            assert similarity == pytest.approx(states[name][row] @ query_vector, abs=1e-5)
+    assert search_collection(collection_dir, query_vectors, top_k=3)[0][0][0] == "lambda"
+
+    drop_genome(collection_dir, "lambda")
+    assert not os.path.exists(os.path.join(collection_dir, "lambda.index"))
+    names, _, _ = search_collection(collection_dir, query_vectors, top_k=50)[0]
+    assert set(names) == {"T4", "P22"}
+    with pytest.raises(ValueError, match="Unknown genome: lambda"):
+        drop_genome(collection_dir, "lambda")
+    with pytest.raises(ValueError, match="Unknown genome: lambda"):
+        search_collection(collection_dir, query_vectors, genomes=["lambda"])
+
+    np.save(tmp_path / "wide.npy", np.ones((10, 32), dtype='float32'))
+    with pytest.raises(ValueError, match="have 32 columns, the collection 16"):
+        add_genome(collection_dir, "wide", str(tmp_path / "wide.npy"), index_type="flat")
+    assert list(read_collection(collection_dir)["shards"]) == ["T4", "P22"]
+
+def test_concurrent_adds_keep_every_shard(tmp_path):
+    collection_dir = str(tmp_path / "collection")
+    centers = np.random.default_rng(18).standard_normal((4, 16))
+    path = clustered_states(str(tmp_path / "genome.npy"), centers, 200, 19)
+    names = [f"genome{i}" for i in range(8)]
+    threads = [threading.Thread(target=add_genome, args=(collection_dir, name, path), kwargs={"index_type": "flat"})
+               for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(read_collection(collection_dir)["shards"]) == names
@@ -0,0 +1,86 @@
+import numpy as np
+
+DOWNSAMPLE_METHODS = ["minmax", "lttb", "none"]
+
+def axes_pixels(ax, dpi):
+    """
+    Width of the plot area in pixels at the given output resolution.
+    """
+    return max(int(ax.get_window_extent().width * dpi / ax.figure.dpi), 1)
+
+def minmax_downsample(x, y, n_bins):
+    """
+    Keep the minimum and maximum of y in each of n_bins equally wide x ranges, so every
+    peak and dip visible at that resolution is preserved.
+
+    Parameters:
+    - x: Positions, sorted in increasing order.
+    - y: Values at the positions. NaN values are dropped.
+    - n_bins: Number of bins, usually the pixel width of the plot.
+
+    Returns:
+    - x, y: The selected points, in their original order.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    finite = ~np.isnan(y)
+    x, y = x[finite], y[finite]
+    if x.size <= 2 * n_bins or x[-1] == x[0]:
+        return x, y
+
+    bins = ((x - x[0]) * (n_bins / (x[-1] - x[0]))).astype(np.int64)
+    bins = np.minimum(bins, n_bins - 1)
+
+    # Sort by bin and value, the first and last entry of each bin are its min and max
+    order = np.lexsort((y, bins))
+    sorted_bins = bins[order]
+    starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    ends = np.r_[starts[1:], order.size] - 1
+    keep = np.unique(np.r_[order[starts], order[ends]])
+    return x[keep], y[keep]
+
+def lttb_downsample(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets downsampling: keep n_out points that preserve the
+    visual shape of the line, always including the first and last point.
+
+    Parameters:
+    - x: Positions, sorted in increasing order.
+    - y: Values at the positions. NaN values are dropped.
+    - n_out: Number of points to keep.
+
+    Returns:
+    - x, y: The selected points, in their original order.
+    """
+    x, y = np.asarray(x, dtype='float64'), np.asarray(y, dtype='float64')
+    finite = ~np.isnan(y)
+    x, y = x[finite], y[finite]
+    if x.size <= n_out or n_out < 3:
+        return x, y
+
+    # Bucket boundaries of the points between the first and the last one
+    edges = np.linspace(1, x.size - 1, n_out - 1).astype(np.int64)
+    keep = np.empty(n_out, dtype=np.int64)
+    keep[0], keep[-1] = 0, x.size - 1
+    selected = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        # Average of the next bucket, or the last point for the final bucket
+        next_stop = edges[i + 2] if i + 2 < edges.size else x.size
+        next_x, next_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        # Keep the point forming the largest triangle with the previous point and the average
+        areas = np.abs((x[selected] - next_x) * (y[start:stop] - y[selected])
+                       - (x[selected] - x[start:stop]) * (next_y - y[selected]))
+        selected = start + int(np.argmax(areas))
+        keep[i + 1] = selected
+    return x[keep], y[keep]
+
+def downsample(x, y, n_pixels, method="minmax"):
+    """
+    Reduce a line to about the number of points that can be told apart at n_pixels
+    width with the given method (minmax, lttb or none).
+    """
+    if method == "minmax":
+        return minmax_downsample(x, y, n_pixels)
+    if method == "lttb":
+        return lttb_downsample(x, y, 2 * n_pixels)
+    return np.asarray(x), np.asarray(y)
@@ -0,0 +1,136 @@
+import os
+
+import numpy as np
+import pandas as pd
+from gff_index import get_annotations
+
+OUTPUT_FORMATS = ["csv", "tsv", "parquet"]
+COMPRESSION_SUFFIXES = (".gz", ".bz2", ".xz", ".zst", ".zip")
+
+def split_output_path(output_file):
+    """
+    Split a path into root, table extension and compression suffix, e.g.
+    'hits.csv.gz' into ('hits', '.csv', '.gz').
+    """
+    root, compression = output_file, ""
+    if output_file.lower().endswith(COMPRESSION_SUFFIXES):
+        root, compression = os.path.splitext(output_file)
+    root, ext = os.path.splitext(root)
+    return root, ext, compression
+
+def infer_format(output_file, output_format=None):
+    """
+    Infer the table format from the file extension unless it is given explicitly.
+    """
+    if output_format:
+        return output_format
+    ext = split_output_path(output_file)[1].lower()
+    if ext == ".parquet":
+        return "parquet"
+    if ext in (".tsv", ".tab", ".txt"):
+        return "tsv"
+    return "csv"
+
+def top_n(similarities, n):
+    """
+    Indices of the n largest similarities in decreasing order. Uses argpartition, so
+    only the n selected values are sorted.
+    """
+    n = min(n, similarities.size)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-similarities, n - 1)[:n]
+    return top[np.argsort(-similarities[top], kind='stable')]
+
+def results_table(rows, similarities, features, queries=None, sequence_positions=None):
+    """
+    Build the annotated result table from NumPy columns, sorted by query and position.
+
+    Parameters:
+    - rows: 0-based row numbers of the hits.
+    - similarities: Similarity of each hit.
+    - features: The feature index returned by parse_gff.
+    - queries: Optional query label of each hit, adds a leading Query column.
+    - sequence_positions: Optional sequence position of every row of the states, see
+      load_sequence_positions. Hits are then labelled and annotated with their
+      sequence position and their row number is kept in a Row column.
+
+    Returns:
+    - table: A DataFrame with the columns Query (optional), Position, Row (optional),
+      Similarity, Feature Type and Description.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if queries is None:
+        order = np.argsort(rows, kind='stable')
+    else:
+        queries = np.asarray(queries)
+        order = np.lexsort((rows, queries))
+    positions = rows[order] + 1 if sequence_positions is None else sequence_positions[rows[order]]
+
+    # Annotate all positions at once
+    feature_types, descriptions = get_annotations(positions, features)
+
+    columns = {}
+    if queries is not None:
+        columns["Query"] = queries[order]
+    columns["Position"] = positions
+    if sequence_positions is not None:
+        columns["Row"] = rows[order] + 1
+    columns["Similarity"] = np.asarray(similarities)[order]
+    columns["Feature Type"] = feature_types
+    columns["Description"] = pd.Series(descriptions, dtype=object).str.replace(",", ";", regex=False).values
+    return pd.DataFrame(columns)
+
+def write_table(table, output_file, output_format=None):
+    """
+    Write a result table in one call as CSV, TSV or Parquet. CSV and TSV files are
+    compressed according to their suffix (.gz, .bz2, .xz, .zst, .zip).
+    """
+    output_format = infer_format(output_file, output_format)
+    if output_format == "parquet":
+        try:
+            table.to_parquet(output_file, index=False)
+        except ImportError as e:
+            raise ImportError("Parquet output requires pyarrow, install it with 'conda install pyarrow'") from e
+    else:
+        table.to_csv(output_file, sep="\t" if output_format == "tsv" else ",", index=False, compression='infer')
+
+def read_table(input_file):
+    """
+    Read a result table written by write_table.
+    """
+    input_format = infer_format(input_file)
+    if input_format == "parquet":
+        return pd.read_parquet(input_file)
+    return pd.read_csv(input_file, sep="\t" if input_format == "tsv" else ",")
+
+def write_results(results, features, output_file, labels=None, output_format=None, sequence_positions=None):
+    """
+    Write search results, sorted by position and annotated, in bulk.
+
+    Parameters:
+    - results: A (rows, similarities) pair of arrays, or one pair per query if labels
+      are given.
+    - features: The feature index returned by parse_gff.
+    - output_file: Path to the output file.
+    - labels: Query labels. If given, results are written in long format with a
+      leading Query column.
+    - output_format: csv, tsv or parquet. Inferred from the extension if None.
+    - sequence_positions: Optional sequence position of every row, see results_table.
+    """
+    if labels is None:
+        rows, similarities = results
+        table = results_table(rows, similarities, features, sequence_positions=sequence_positions)
+    else:
+        rows = np.concatenate([query_rows for query_rows, _ in results])
+        similarities = np.concatenate([query_similarities for _, query_similarities in results])
+        queries = np.repeat(labels, [len(query_rows) for query_rows, _ in results])
+        table = results_table(rows, similarities, features, queries, sequence_positions)
+    write_table(table, output_file, output_format)
+
+def per_query_path(output_file, label):
+    """
+    Derive the output file of a single query from the batch output file.
+    """
+    root, ext, compression = split_output_path(output_file)
+    return f"{root}_{label}{ext}{compression}"
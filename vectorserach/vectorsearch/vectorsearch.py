@@ -4,67 +4,596 @@ import faiss
 import numpy as np
 import pandas as pd
 import argparse
+import fcntl
 import os
-from BCBio import GFF
+import sys
+import time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import matplotlib
+matplotlib.use("Agg")  # Plots are only written to files, never shown
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 from matplotlib.backends.backend_pdf import PdfPages
 
-def build_index(input_file, output_file):
-    df = pd.read_csv(input_file, skiprows=1)
-    data = np.ascontiguousarray(df.values.astype('float32'))
-    faiss.normalize_L2(data)
-    dimension = data.shape[1]
-    quantizer = faiss.IndexFlatL2(dimension)
-    nlist = 50
-    index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
-    assert not index.is_trained
-    index.train(data)
-    assert index.is_trained
-    index.nprobe = 50
-    index.add(data)
+# The conda recipe installs the helper modules into share/vectorsearch, so they do not
+# clash with those of other packages in $PREFIX/bin. In the source tree they are next
+# to this script.
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "vectorsearch")
+if not os.path.isdir(PACKAGE_DIR):
+    PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PACKAGE_DIR)
+
+from gff_index import parse_gff, get_annotations, describe_positions
+from state_store import (open_states, read_rows, iter_state_chunks, convert_states, load_sequence_positions,
+                         query_rows, rows_at_positions)
+from result_writer import OUTPUT_FORMATS, top_n, results_table, write_table, write_results, read_table, per_query_path
+from downsample import DOWNSAMPLE_METHODS, axes_pixels, downsample
+from metrics import Metrics, add_metrics_arguments
+
+INDEX_TYPES = ["flat", "ivf-flat", "ivf-pq", "opq-ivf-pq", "ivf-sq8", "ivf-sqfp16", "hnsw"]
+DEFAULT_TOP_K = 100
+
+def default_index_params(index_type, n_rows, dimension, n_train=None, nlist=None, nprobe=None, pq_m=None, hnsw_m=32):
+    """
+    Derive index parameters from the size of the state matrix. nlist follows the
+    usual 4 * sqrt(rows) rule, capped so every list gets 39 training rows, and nprobe
+    visits about an eighth of the lists. PQ uses sub-quantizers of 4 dimensions.
+    """
+    n_train = n_rows if n_train is None else min(n_train, n_rows)
+    params = {"index_type": index_type, "rows": int(n_rows), "dimension": int(dimension)}
+    if index_type.startswith("ivf") or index_type.startswith("opq"):
+        if nlist is None:
+            nlist = int(np.clip(4 * np.sqrt(n_rows), 1, max(1, n_train // 39)))
+        if nprobe is None:
+            nprobe = min(nlist, max(8, nlist // 8))
+        params.update(nlist=int(nlist), nprobe=int(nprobe))
+    if index_type in ("ivf-pq", "opq-ivf-pq"):
+        if pq_m is None:
+            # Largest divisor of the dimension giving at least 4 dimensions per sub-quantizer
+            pq_m = max(m for m in range(1, max(1, dimension // 4) + 1) if dimension % m == 0)
+        params["pq_m"] = int(pq_m)
+    if index_type == "hnsw":
+        params.update(hnsw_m=int(hnsw_m), ef_search=int(max(64, 2 * hnsw_m)))
+    return params
+
+def make_index(params):
+    """
+    Create an empty inner-product index described by params.
+    """
+    dimension = params["dimension"]
+    factory = {
+        "flat": "Flat",
+        "ivf-flat": "IVF{nlist},Flat",
+        "ivf-pq": "IVF{nlist},PQ{pq_m}",
+        "opq-ivf-pq": "OPQ{pq_m},IVF{nlist},PQ{pq_m}",
+        "ivf-sq8": "IVF{nlist},SQ8",
+        "ivf-sqfp16": "IVF{nlist},SQfp16",
+        "hnsw": "HNSW{hnsw_m},Flat",
+    }[params["index_type"]].format(**params)
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_INNER_PRODUCT)
+    apply_search_params(index, params)
+    return index
+
+def apply_search_params(index, params):
+    """
+    Set the search-time parameters (nprobe, efSearch) stored with an index.
+    """
+    parameter_space = faiss.ParameterSpace()
+    if "nprobe" in params:
+        parameter_space.set_index_parameter(index, "nprobe", params["nprobe"])
+    if "ef_search" in params:
+        parameter_space.set_index_parameter(index, "efSearch", params["ef_search"])
+
+def params_path(index_file):
+    return index_file + ".json"
+
+def write_index(index, params, output_file):
+    """
+    Write the index and the parameters it was built with to a JSON file next to it.
+    """
     faiss.write_index(index, output_file)
+    with open(params_path(output_file), 'w') as file:
+        json.dump(params, file, indent=2)
 
-def extract_vector(input_file, position, output_file):
-    df = pd.read_csv(input_file, skiprows=1)
-    vector = df.iloc[position-1].values
-    pd.DataFrame(vector).to_csv(output_file, index=False, header=["Value"])
+def read_params(index_file):
+    """
+    Read the parameters stored next to an index, empty for indexes built without them.
+    """
+    if not os.path.exists(params_path(index_file)):
+        return {}
+    with open(params_path(index_file), 'r') as file:
+        return json.load(file)
 
-def compute_similarity(index, query_vector):
-    similarities, indices = index.search(query_vector, index.ntotal)
-    similarity_tuples = [(i, s) for i, s in zip(indices[0], similarities[0])]
-    return similarity_tuples
+def read_index(index_file, nprobe=None):
+    """
+    Read an index and apply its stored search parameters. nprobe overrides the
+    stored value for IVF indexes.
+    """
+    index = faiss.read_index(index_file)
+    params = read_params(index_file)
+    if nprobe is not None:
+        params["nprobe"] = nprobe
+    apply_search_params(index, params)
+    return index
 
-def parse_gff(gff_file):
-    features = {}
-    with open(gff_file, 'r') as file:
-        for rec in GFF.parse(file):
-            for feature in rec.features:
-                if feature.type == "region":  # Skip the 'region' feature
-                    continue
-                start = int(feature.location.start) + 1
-                end = int(feature.location.end)
-                feature_type = feature.type
-                description = feature.qualifiers.get("product", [""])[0]
-                features[(start, end)] = (feature_type, description)
-    return features
-
-def get_annotation(position, features):
-    for (start, end), (feature_type, description) in features.items():
-        if start <= position <= end:
-            return feature_type, description
-    return "NA", "NA"
-
-def plot(data_file, output_file):
-    df = pd.read_csv(data_file)
+def quantization_residual(index, vectors):
+    """
+    Mean squared distance of normalized vectors to their nearest IVF centroid, the error
+    of the trained coarse quantizer. None for indexes without one (flat, HNSW).
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return None
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexPreTransform):
+        # OPQ rotates the vectors before they are assigned to a list
+        for i in range(index.chain.size()):
+            vectors = faiss.downcast_VectorTransform(index.chain.at(i)).apply(vectors)
+    _, assignment = ivf.quantizer.search(vectors, 1)
+    centroids = ivf.quantizer.reconstruct_n(0, ivf.nlist)
+    return float(np.mean(np.sum((vectors - centroids[assignment[:, 0]]) ** 2, axis=1)))
+
+def source_name(input_file):
+    return os.path.splitext(os.path.basename(input_file))[0]
+
+def index_sources(input_files, rows, names=None, gffs=None):
+    """
+    The ID mapping stored with an index: the states file every range of index rows was
+    added from, so row i of the index is row i - first_id of its source, and the GFF
+    file its hits are annotated with.
+    """
+    names = names or [source_name(input_file) for input_file in input_files]
+    gffs = gffs or [None] * len(input_files)
+    first_ids = np.concatenate([[0], np.cumsum(rows)[:-1]])
+    return [{"name": name, "states": os.path.abspath(input_file), "first_id": int(first_id), "rows": int(n),
+             "gff": os.path.abspath(gff) if gff else None}
+            for name, input_file, first_id, n, gff in zip(names, input_files, first_ids, rows, gffs)]
+
+def source_gff_files(sources, gff=None):
+    """
+    The GFF file of every source of an index, as recorded by 'index --gff'. gff replaces
+    that of the first source, the only one of an index built from a single states file.
+    """
+    gff_files = {source["name"]: source.get("gff") for source in sources}
+    if gff and sources:
+        gff_files[sources[0]["name"]] = gff
+    return gff_files
+
+def build_index(input_file, output_file, index_type="ivf-flat", nlist=None, nprobe=None, pq_m=None, metrics=None,
+                names=None, gffs=None):
+    """
+    Build the index in memory. input_file can be a list of states files, whose rows are
+    indexed in order and recorded as the sources of the index, named by names or after
+    their files and annotated with the GFF files gffs.
+    """
+    metrics = metrics or Metrics()
+    input_files = [input_file] if isinstance(input_file, str) else list(input_file)
+    with metrics.stage("load states") as stage:
+        parts = [np.array(open_states(path), dtype='float32', order='C') for path in input_files]
+        data = parts[0] if len(parts) == 1 else np.vstack(parts)
+        faiss.normalize_L2(data)
+        stage["rows"] = data.shape[0]
+    with metrics.stage("index build", rows=data.shape[0]):
+        params = default_index_params(index_type, data.shape[0], data.shape[1], nlist=nlist, nprobe=nprobe, pq_m=pq_m)
+        index = make_index(params)
+        if not index.is_trained:
+            index.train(data)
+        assert index.is_trained
+        index.add(data)
+    # The error of the quantizer on its training rows is the baseline of the drift check of --append
+    sample = data[np.random.default_rng(0).choice(data.shape[0], min(data.shape[0], 100000), replace=False)]
+    params["train_residual"] = quantization_residual(index, sample)
+    params["sources"] = index_sources(input_files, [len(part) for part in parts], names, gffs)
+    with metrics.stage("write", rows=index.ntotal):
+        write_index(index, params, output_file)
+    return params
+
+def reservoir_sample(chunks, sample_size, seed=0):
+    """
+    Draw a uniform random sample of rows from a stream of chunks (Algorithm R),
+    holding at most sample_size rows in memory. Returns the sample and the number
+    of rows seen.
+    """
+    rng = np.random.default_rng(seed)
+    sample = None
+    seen = 0
+    for chunk in chunks:
+        if sample is None:
+            sample = np.empty((sample_size, chunk.shape[1]), dtype='float32')
+        # Fill the reservoir first, then replace rows with decreasing probability
+        fill = min(max(sample_size - seen, 0), len(chunk))
+        sample[seen:seen + fill] = chunk[:fill]
+        rest = chunk[fill:]
+        if len(rest):
+            slots = rng.integers(0, np.arange(seen + fill, seen + len(chunk)) + 1)
+            keep = slots < sample_size
+            sample[slots[keep]] = rest[keep]
+        seen += len(chunk)
+    return sample[:min(seen, sample_size)], seen
+
+def iter_source_chunks(input_files, chunk_size):
+    for input_file in input_files:
+        yield from iter_state_chunks(input_file, chunk_size)
+
+def build_index_streaming(input_file, output_file, chunk_size=100000, train_size=100000,
+                          index_type="ivf-flat", nlist=None, nprobe=None, pq_m=None, metrics=None, names=None,
+                          gffs=None):
+    """
+    Build the index without loading the states into memory at once. The quantizer
+    is trained on a reservoir sample, then rows are normalized and added in chunks.
+    input_file can be a list of states files as for build_index.
+    """
+    metrics = metrics or Metrics()
+    input_files = [input_file] if isinstance(input_file, str) else list(input_file)
+    start_time = time.time()
+    print(f"Sampling {train_size} training rows...")
+    with metrics.stage("training sample") as stage:
+        train, n_rows = reservoir_sample(iter_source_chunks(input_files, chunk_size), train_size)
+        faiss.normalize_L2(train)
+        stage["rows"] = n_rows
+    with metrics.stage("index training", rows=train.shape[0]):
+        params = default_index_params(index_type, n_rows, train.shape[1], n_train=train.shape[0],
+                                      nlist=nlist, nprobe=nprobe, pq_m=pq_m)
+        index = make_index(params)
+        if not index.is_trained:
+            index.train(train)
+        assert index.is_trained
+        params["train_residual"] = quantization_residual(index, train)
+        del train
+
+    rows = []
+    with metrics.stage("index build") as stage:
+        for path in input_files:
+            start = index.ntotal
+            for chunk in iter_state_chunks(path, chunk_size):
+                faiss.normalize_L2(chunk)
+                index.add(chunk)
+                print(f"Indexed {index.ntotal} rows ({time.time() - start_time:.1f} s)")
+            rows.append(index.ntotal - start)
+        stage["rows"] = index.ntotal
+    params["sources"] = index_sources(input_files, rows, names, gffs)
+    with metrics.stage("write", rows=index.ntotal):
+        write_index(index, params, output_file)
+    return params
+
+def append_index(input_file, index_file, name=None, drift_threshold=1.5, chunk_size=100000, train_size=100000,
+                 streaming=False, metrics=None, gff=None):
+    """
+    Add the rows of another states file to an existing index with its trained
+    quantizer, so only the new rows are read and encoded. The new rows are recorded as
+    a source of the index, mapping their index rows back to the file and position.
+
+    Drift is measured on a sample of the new rows as the ratio of their quantization
+    residual to that of the training rows. Above drift_threshold the quantizer no
+    longer fits the data, and the index is retrained on all of its sources instead,
+    which requires their states files.
+
+    Parameters:
+    - name: Name of the new source, the file name without extension by default.
+    - drift_threshold: Residual ratio above which the index is retrained, 0 always
+      retrains.
+    - streaming: Retrain chunk by chunk as in build_index_streaming.
+    - gff: Optional GFF file the hits of the new rows are annotated with.
+
+    Returns:
+    - params: The parameters stored with the updated index.
+    """
+    metrics = metrics or Metrics()
+    with metrics.stage("load index") as stage:
+        index = read_index(index_file)
+        params = read_params(index_file)
+        stage["rows"] = index.ntotal
+    # Indexes built before sources were recorded hold a single, unnamed source
+    sources = params.get("sources") or [{"name": source_name(index_file), "states": None, "first_id": 0,
+                                          "rows": int(index.ntotal)}]
+    name = name or source_name(input_file)
+    if name in [source["name"] for source in sources]:
+        raise ValueError(f"The index already holds a source named {name}")
+
+    with metrics.stage("drift check") as stage:
+        sample, n_rows = reservoir_sample(iter_state_chunks(input_file, chunk_size), train_size)
+        stage["rows"] = sample.shape[0]
+        if sample.shape[1] != index.d:
+            raise ValueError(f"The states of {name} have {sample.shape[1]} columns, the index {index.d}")
+        faiss.normalize_L2(sample)
+        residual = quantization_residual(index, sample)
+        drift = residual / params["train_residual"] if residual is not None and params.get("train_residual") else None
+        del sample
+
+    if drift is None and residual is not None:
+        print("The index stores no training residual, drift is not checked")
+    elif drift is not None:
+        print(f"Quantization residual of the new rows is {drift:.2f} times that of the training rows")
+
+    if drift is not None and drift > drift_threshold:
+        missing = [source["name"] for source in sources if not source["states"] or not os.path.exists(source["states"])]
+        if missing:
+            raise ValueError(f"The index needs to be retrained, but the states of {', '.join(missing)} are not "
+                             f"available. Rebuild it with 'vectorsearch index'.")
+        print("Retraining the index on all of its sources")
+        input_files = [source["states"] for source in sources] + [input_file]
+        names = [source["name"] for source in sources] + [name]
+        gffs = [source.get("gff") for source in sources] + [gff]
+        # Keep the parameters the index was built with
+        build_params = {"nlist": params.get("nlist"), "nprobe": params.get("nprobe"), "pq_m": params.get("pq_m")}
+        if streaming:
+            return build_index_streaming(input_files, index_file, chunk_size, train_size, params["index_type"],
+                                         metrics=metrics, names=names, gffs=gffs, **build_params)
+        return build_index(input_files, index_file, params["index_type"], metrics=metrics, names=names, gffs=gffs,
+                           **build_params)
+
+    first_id = int(index.ntotal)
+    with metrics.stage("index add", rows=n_rows):
+        for chunk in iter_state_chunks(input_file, chunk_size):
+            faiss.normalize_L2(chunk)
+            index.add(chunk)
+    sources.append({"name": name, "states": os.path.abspath(input_file), "first_id": first_id, "rows": int(n_rows),
+                    "gff": os.path.abspath(gff) if gff else None})
+    params.update(rows=int(index.ntotal), sources=sources)
+    with metrics.stage("write", rows=index.ntotal):
+        write_index(index, params, index_file)
+    print(f"Appended {n_rows} rows of {name}, the index holds {index.ntotal} rows")
+    return params
+
+def map_to_sources(sources, rows):
+    """
+    Map index rows to the source they were added from.
+
+    Returns:
+    - names: The name of the source of every row.
+    - source_rows: The 0-based row within its source.
+    """
+    first_ids = np.array([source["first_id"] for source in sources], dtype=np.int64)
+    which = np.searchsorted(first_ids, rows, side='right') - 1
+    names = np.array([source["name"] for source in sources], dtype=object)
+    return names[which], rows - first_ids[which]
+
+def load_source_positions(sources):
+    """
+    The sequence positions of every source that is an HDF5 store, see
+    load_sequence_positions. Sources without them map to None.
+    """
+    return {source["name"]: load_sequence_positions(source["states"]) for source in sources}
+
+def locate_rows(sources, rows, source_positions):
+    """
+    Map index rows to their source and the position they are reported at, the
+    sequence position for HDF5 sources and the 1-based row within the source otherwise.
+
+    Returns:
+    - names: The name of the source of every row.
+    - source_rows: The 0-based row within its source.
+    - positions: The position of every row within its source.
+    """
+    names, source_rows = map_to_sources(sources, rows)
+    positions = source_rows + 1
+    for name, sequence_positions in source_positions.items():
+        if sequence_positions is not None:
+            in_source = names == name
+            positions[in_source] = sequence_positions[source_rows[in_source]]
+    return names, source_rows, positions
+
+def load_source_features(gff_files, seqid=None):
+    """
+    Parse the GFF file of every source, see source_gff_files. Files shared by several
+    sources are parsed once, sources without one map to an empty feature index.
+    """
+    features = {gff: parse_gff(gff, seqid) for gff in set(gff_files.values()) if gff}
+    return {name: features[gff] if gff else {} for name, gff in gff_files.items()}
+
+def get_source_annotations(names, positions, source_features):
+    """
+    get_annotations for the hits of an index with several sources, each annotated with
+    the features of its own source, see load_source_features.
+    """
+    feature_types = np.full(len(positions), "NA", dtype=object)
+    descriptions = np.full(len(positions), "NA", dtype=object)
+    for name in np.unique(names):
+        in_source = names == name
+        feature_types[in_source], descriptions[in_source] = get_annotations(positions[in_source],
+                                                                            source_features[name])
+    return feature_types, descriptions
+
+def extract_vectors(input_file, positions, output_file):
+    """
+    Extract the vectors of the given positions, sequence positions for HDF5 stores and
+    row numbers otherwise (see query_rows). Only the requested rows are read, CSV
+    states are located through their row-offset sidecar.
+
+    A single position is written as one "Value" column. Several positions are written
+    with one vector per row and a leading Position column, or as a matrix if the
+    output ends in .npy. Both can be used as the --query of 'search'.
+    """
+    vectors = read_rows(input_file, query_rows(input_file, positions))
+    if output_file.endswith('.npy'):
+        np.save(output_file, vectors)
+    elif len(positions) == 1:
+        pd.DataFrame(vectors[0]).to_csv(output_file, index=False, header=["Value"])
+    else:
+        df = pd.DataFrame(vectors, columns=[f"V{i + 1}" for i in range(vectors.shape[1])])
+        df.insert(0, "Position", positions)
+        df.to_csv(output_file, index=False)
+
+def read_positions(positions=None, positions_file=None, position_range=None, sequence_positions=None):
+    """
+    Collect query positions given on the command line, in a file with one position
+    per line and/or as an inclusive START END range. With the sequence positions of
+    an HDF5 store, the range holds the positions of its rows between START and END.
+    """
+    positions = list(positions or [])
+    if positions_file:
+        with open(positions_file, 'r') as file:
+            positions += [int(line) for line in file if line.strip()]
+    if position_range:
+        start, end = position_range
+        if sequence_positions is None:
+            positions += list(range(start, end + 1))
+        else:
+            positions += [int(position) for position in sequence_positions
+                          if start <= position <= end]
+    return positions
+
+def load_queries(query_file=None, states_file=None, positions=None):
+    """
+    Load normalized query vectors, either from the rows of a states file at the given
+    positions (see query_rows) or from a query file. A query file is a single vector (the CSV written by
+    'extract'), a CSV with one vector per row (labelled by its Position column if
+    present) or a .npy matrix.
+
+    Returns the query matrix and one label per query.
+    """
+    if positions:
+        query_vectors = read_rows(states_file, query_rows(states_file, positions))
+        labels = list(positions)
+    else:
+        if query_file.endswith('.npy'):
+            query_vectors = np.array(np.load(query_file), dtype='float32', order='C', ndmin=2)
+        else:
+            df = pd.read_csv(query_file, header=0)
+            if "Value" in df.columns:
+                query_vectors = df["Value"].values.reshape(1, -1).astype('float32')
+            else:
+                # Vectors extracted from several positions are labelled with them
+                positions = df.pop("Position").tolist() if "Position" in df.columns else None
+                query_vectors = np.array(df.values, dtype='float32', order='C')
+        labels = positions or list(range(1, query_vectors.shape[0] + 1))
+    faiss.normalize_L2(query_vectors)
+    return query_vectors, labels
+
+def supports_range_search(index):
+    return not isinstance(faiss.downcast_index(index), faiss.IndexHNSW)
+
+def compute_similarities(index, query_vectors, top_k=None, min_similarity=None):
+    """
+    Search the index for the rows most similar to each query vector in one batched
+    call. top_k limits the search to the k best hits, min_similarity runs a range
+    search that only returns hits above the threshold. Without either, the whole
+    index is ranked.
+
+    Returns one (rows, similarities) pair of arrays per query, sorted by decreasing
+    similarity.
+    """
+    batch_results = []
+    if top_k is None and not supports_range_search(index):
+        # The graph search of HNSW misses rows for large k, rank the exact track instead
+        for query_vector in query_vectors:
+            rows, similarities = compute_track(index, query_vector.reshape(1, -1))
+            if min_similarity is not None:
+                above = similarities > min_similarity
+                rows, similarities = rows[above], similarities[above]
+            top = top_n(similarities, similarities.size)
+            batch_results.append((rows[top], similarities[top]))
+    elif min_similarity is not None and not supports_range_search(index):
+        # HNSW has no range search, rank the k best hits and apply the threshold
+        for rows, similarities in compute_similarities(index, query_vectors, top_k):
+            above = similarities > min_similarity
+            batch_results.append((rows[above], similarities[above]))
+    elif min_similarity is not None:
+        lims, similarities, indices = index.range_search(query_vectors, min_similarity)
+        for q in range(query_vectors.shape[0]):
+            query_similarities = similarities[lims[q]:lims[q + 1]]
+            query_indices = indices[lims[q]:lims[q + 1]]
+            order = np.argsort(-query_similarities, kind='stable')[:top_k]
+            batch_results.append((query_indices[order], query_similarities[order]))
+    else:
+        k = index.ntotal if top_k is None else min(top_k, index.ntotal)
+        similarities, indices = index.search(query_vectors, k)
+        for query_similarities, query_indices in zip(similarities, indices):
+            # IVF indexes pad with -1 when the probed lists hold fewer than k rows
+            found = query_indices >= 0
+            batch_results.append((query_indices[found], query_similarities[found]))
+    return batch_results
+
+def resolve_top_k(top_k, min_similarity):
+    """
+    Number of hits returned per query: top_k if given, otherwise every hit above
+    min_similarity for a threshold search and DEFAULT_TOP_K for a plain search.
+    """
+    if top_k is None and min_similarity is None:
+        return DEFAULT_TOP_K
+    return top_k
+
+def compute_similarity(index, query_vector, top_k=None, min_similarity=None):
+    """
+    Search the index for the rows most similar to a single query vector.
+    """
+    return compute_similarities(index, query_vector, top_k, min_similarity)[0]
+
+def compute_track(index, query_vector, chunk_size=100000):
+    """
+    Compute the similarity of every indexed row to a single query vector, ordered by
+    row. An exhaustive range search returns the rows unsorted, so unlike ranking the
+    whole index nothing is sorted. IVF indexes visit all lists for the track. HNSW has
+    no range search and its graph search does not reach every row, so the stored
+    vectors are scored directly, chunk_size rows at a time.
+
+    Returns the (rows, similarities) pair of arrays.
+    """
+    if not supports_range_search(index):
+        track = np.empty(index.ntotal, dtype='float32')
+        for start in range(0, index.ntotal, chunk_size):
+            chunk = index.reconstruct_n(start, min(chunk_size, index.ntotal - start))
+            track[start:start + len(chunk)] = chunk @ query_vector[0]
+        return np.arange(index.ntotal), track
+
+    ivf = faiss.try_extract_index_ivf(index)
+    nprobe = ivf.nprobe if ivf is not None else None
+    if ivf is not None:
+        ivf.nprobe = ivf.nlist
+    try:
+        _, similarities, indices = index.range_search(query_vector[:1], -np.finfo('float32').max)
+    finally:
+        if ivf is not None:
+            ivf.nprobe = nprobe
+    track = np.full(index.ntotal, np.nan, dtype='float32')
+    track[indices] = similarities
+    rows = np.flatnonzero(~np.isnan(track))
+    return rows, track[rows]
+
+def figure_format(fig, output_file):
+    """
+    Image format of a plot, taken from the file extension and PDF by default.
+    """
+    ext = os.path.splitext(output_file)[1].lower().lstrip('.')
+    return ext if ext in fig.canvas.get_supported_filetypes() else 'pdf'
+
+def select_query(df, query=None):
+    """
+    Select the rows of one query from a search output. Outputs of a batch search have a
+    Query column and need a query, those of a single query are used as they are.
+    """
+    if "Query" not in df.columns:
+        if query is not None:
+            raise ValueError("The search output holds a single query, it has no Query column")
+        return df
+    queries = df["Query"].unique()
+    if query is None:
+        if len(queries) > 1:
+            raise ValueError(f"The search output holds {len(queries)} queries, select one with --query "
+                             f"({', '.join(map(str, queries[:5]))}{', ...' if len(queries) > 5 else ''})")
+        return df
+    selected = df[df["Query"].astype(str) == str(query)]
+    if selected.empty:
+        raise ValueError(f"Unknown query: {query}")
+    return selected
+
+def plot(data_file, output_file, method="minmax", dpi=300, rasterize=False, query=None):
+    df = select_query(read_table(data_file), query).sort_values('Position')
     
     # Round the values
     df['Similarity'] = df['Similarity'].round(2)
     
     fig, ax = plt.subplots()
+
+    # Only keep the points that can be told apart at the output resolution
+    positions, similarities = downsample(df['Position'].values, df['Similarity'].values, axes_pixels(ax, dpi), method)
     
     # Plot a line graph with reduced line width
-    ax.plot(df['Position'], df['Similarity'], linestyle='-', marker='', color='b', linewidth=0.7)
+    ax.plot(positions, similarities, linestyle='-', marker='', color='b', linewidth=0.7, rasterized=rasterize)
     
     # Hide x-axis labels and set x-axis label
     ax.set_xticks([])
@@ -76,8 +605,8 @@ def plot(data_file, output_file):
     plt.tight_layout()
     
     # Save to the specified output file
-    plt.savefig(output_file, format='pdf')
-    plt.show()
+    plt.savefig(output_file, format=figure_format(fig, output_file), dpi=dpi)
+    plt.close(fig)
 
 def plot_vector(vector_file, output_file):
     # Load the vector data from CSV
@@ -98,35 +627,44 @@ def plot_vector(vector_file, output_file):
     cbar.set_label('Value')
     
     plt.tight_layout()
-    plt.savefig(output_file, format='pdf')
-    plt.show()
-
-import matplotlib.pyplot as plt
-import pandas as pd
-import matplotlib.colors as mcolors
+    plt.savefig(output_file, format=figure_format(fig, output_file))
+    plt.close(fig)
 
-def plot_similar_vectors(search_output, data_file, output_file):
+def plot_similar_vectors(search_output, data_file, output_file, method="minmax", dpi=300, rasterize=False,
+                         query=None):
+    """
+    Plot the vectors of the 5 best hits next to 5 random other rows, and the similarity
+    along the genome. The random rows and the overview are taken from search_output,
+    so it is meant to be the --track output of 'search', which holds every row. The
+    output of a batch search is plotted for one query, see select_query.
+    """
     # Load the search output data
-    df_search = pd.read_csv(search_output)
+    df_search = select_query(read_table(search_output), query).sort_values('Position')
+    if len(df_search) < 10:
+        raise ValueError(f"{search_output} has {len(df_search)} rows, plotsim needs at least 10. "
+                         f"Plot the --track output of 'search', which holds every position.")
+    # Hits of HDF5 stores are labelled with their sequence position, their row is in the Row column
+    row_column = "Row" if "Row" in df_search.columns else "Position"
     
-    # Extract data from the input data file
-    data = pd.read_csv(data_file, skiprows=1).values.astype('float32')
-    
-    # Determine the range for the heatmap
-    abs_max_value = max(np.abs(data).max(), 1e-10)
-
     # Sort the DataFrame based on the similarity values
-    top_5_positions = df_search.sort_values(by="Similarity", ascending=False).head(5)["Position"].values - 1
-    top_similarities = df_search.sort_values(by="Similarity", ascending=False).head(5)["Similarity"].values
+    top_5_hits = df_search.sort_values(by="Similarity", ascending=False).head(5)
+    top_similarities = top_5_hits["Similarity"].values
     
     # Randomly sample 5 positions (excluding top 5 hits)
-    random_positions = df_search.loc[~df_search["Position"].isin(top_5_positions + 1)].sample(5)["Position"].values - 1
+    random_hits = df_search.drop(top_5_hits.index).sample(5)
+
+    # Only read the 10 plotted vectors from the states file
+    vectors = read_rows(data_file, np.concatenate([top_5_hits[row_column].values, random_hits[row_column].values]) - 1)
+    top_vectors, random_vectors = vectors[:5], vectors[5:]
+
+    # Determine the range for the heatmap from the plotted vectors
+    abs_max_value = max(np.abs(vectors).max(), 1e-10)
     
     # Create a 3-row subplot
     fig, (ax1, ax2, ax3) = plt.subplots(nrows=3, figsize=(12, 15))
     
     # Display heatmap of top 5 hits
-    cax1 = ax1.imshow(data[top_5_positions], aspect='auto', cmap='viridis', norm=mcolors.Normalize(vmin=-abs_max_value, vmax=abs_max_value))
+    cax1 = ax1.imshow(top_vectors, aspect='auto', cmap='viridis', norm=mcolors.Normalize(vmin=-abs_max_value, vmax=abs_max_value))
     y_labels_top = [f'Hit {i+1} (Similarity: {sim:.2f})' for i, sim in enumerate(top_similarities)]
     ax1.set_yticks(range(len(y_labels_top)))
     ax1.set_yticklabels(y_labels_top)
@@ -140,7 +678,7 @@ def plot_similar_vectors(search_output, data_file, output_file):
     ax1.axhline(0.5, color='black', lw=3)  
     
     # Display heatmap of random vectors
-    cax2 = ax2.imshow(data[random_positions], aspect='auto', cmap='viridis', norm=mcolors.Normalize(vmin=-abs_max_value, vmax=abs_max_value))
+    cax2 = ax2.imshow(random_vectors, aspect='auto', cmap='viridis', norm=mcolors.Normalize(vmin=-abs_max_value, vmax=abs_max_value))
     y_labels_random = [f'Random {i+1}' for i in range(5)]
     ax2.set_yticks(range(len(y_labels_random)))
     ax2.set_yticklabels(y_labels_random)
@@ -150,18 +688,422 @@ def plot_similar_vectors(search_output, data_file, output_file):
     for y in range(1, 5):
         ax2.axhline(y - 0.5, color='black', lw=0.5)
     
-    # Overview plot
-    ax3.plot(df_search['Position'], df_search['Similarity'], lw=0.5, color='grey', label="Similarity")
-    ax3.scatter(random_positions + 1, df_search.loc[df_search["Position"].isin(random_positions + 1), "Similarity"], s=20, c='green', label="Random 5 Hits", zorder=3) 
-    ax3.scatter(top_5_positions + 1, top_similarities, s=10, c='red', label="Top 5 Hits")  
+    # Overview plot, downsampled to the output resolution
+    positions, similarities = downsample(df_search['Position'].values, df_search['Similarity'].values,
+                                         axes_pixels(ax3, dpi), method)
+    ax3.plot(positions, similarities, lw=0.5, color='grey', label="Similarity", rasterized=rasterize)
+    ax3.scatter(random_hits["Position"], random_hits["Similarity"], s=20, c='green', label="Random 5 Hits", zorder=3) 
+    ax3.scatter(top_5_hits["Position"], top_similarities, s=10, c='red', label="Top 5 Hits")  
     ax3.set_xlabel('Genome Position')
     ax3.set_ylabel('Similarity')
     ax3.legend()
     ax3.set_title('Hits along the genome')
     
     plt.tight_layout()
-    plt.savefig(output_file)
-    plt.show()
+    plt.savefig(output_file, format=figure_format(fig, output_file), dpi=dpi)
+    plt.close(fig)
+
+def parse_named_paths(values, names=None):
+    """
+    Parse NAME=PATH arguments. Without a name, an index is named after its file and
+    a states or GFF file belongs to the only index.
+    """
+    paths = {}
+    for value in values or []:
+        name, sep, path = value.partition("=")
+        if not sep:
+            path = value
+            if names is None:
+                name = os.path.splitext(os.path.basename(value))[0]
+            elif len(names) == 1:
+                name = names[0]
+            else:
+                raise ValueError(f"'{value}' needs a NAME=PATH prefix when serving several indexes")
+        paths[name] = path
+    return paths
+
+def load_dataset(paths):
+    """
+    Load an index together with its optional states file and GFF annotation. Hits of
+    an index with several sources are located by source, see locate_rows, and annotated
+    with the GFF file recorded for their source.
+    """
+    sources = read_params(paths["index"]).get("sources", [])
+    source_features = None
+    if len(sources) > 1:
+        source_features = load_source_features(source_gff_files(sources, paths.get("gff")))
+    return {
+        "paths": paths,
+        "index": read_index(paths["index"]),
+        "states": open_states(paths["states"]) if paths.get("states") else None,
+        "sequence_positions": load_sequence_positions(paths.get("states")),
+        "sources": sources if len(sources) > 1 else None,
+        "source_positions": load_source_positions(sources) if len(sources) > 1 else None,
+        "features": parse_gff(paths["gff"]) if paths.get("gff") else {},
+        "source_features": source_features,
+    }
+
+class SearchService:
+    """
+    Keeps indexes, state stores and parsed annotations resident and answers search,
+    extract and annotate requests against them.
+    """
+
+    def __init__(self, dataset_paths):
+        self.dataset_paths = dataset_paths
+        self.datasets = {name: load_dataset(paths) for name, paths in dataset_paths.items()}
+        self.lock = threading.Lock()
+
+    def dataset(self, request):
+        name = request.get("dataset")
+        if name is None and len(self.datasets) == 1:
+            name = next(iter(self.datasets))
+        if name not in self.datasets:
+            raise ValueError(f"Unknown dataset: {name}")
+        # Requests keep using the dataset they started with while a reload swaps it
+        with self.lock:
+            return self.datasets[name]
+
+    def status(self, request):
+        with self.lock:
+            datasets = dict(self.datasets)
+        return {name: {"rows": int(dataset["index"].ntotal), **dataset["paths"]}
+                for name, dataset in datasets.items()}
+
+    def rows(self, dataset, positions):
+        # Positions of HDF5 stores are sequence positions like those of the hits, see query_rows
+        if dataset["states"] is None:
+            raise ValueError("The dataset has no states file")
+        positions = np.asarray(positions, dtype=np.int64)
+        if positions.size == 0:
+            raise ValueError("Positions are out of bounds")
+        if dataset["sequence_positions"] is not None:
+            rows = rows_at_positions(dataset["sequence_positions"], positions)
+        elif positions.min() < 1 or positions.max() > dataset["states"].shape[0]:
+            raise ValueError("Positions are out of bounds")
+        else:
+            rows = positions - 1
+        return np.array(dataset["states"][rows], dtype='float32', order='C')
+
+    def search(self, request):
+        dataset = self.dataset(request)
+        if "positions" in request:
+            query_vectors = self.rows(dataset, request["positions"])
+            labels = list(request["positions"])
+        else:
+            query_vectors = np.array(request["vectors"], dtype='float32', order='C', ndmin=2)
+            labels = list(range(1, query_vectors.shape[0] + 1))
+        # faiss asserts on bad arguments instead of raising, check them so they are answered with 400
+        if query_vectors.ndim != 2 or query_vectors.shape[1] != dataset["index"].d:
+            raise ValueError(f"Query vectors must have {dataset['index'].d} dimensions")
+        top_k = request.get("top_k")
+        if top_k is not None and (not isinstance(top_k, int) or isinstance(top_k, bool) or top_k < 1):
+            raise ValueError("top_k must be a positive integer")
+        min_similarity = request.get("min_similarity")
+        if min_similarity is not None and (not isinstance(min_similarity, (int, float)) or isinstance(min_similarity, bool)):
+            raise ValueError("min_similarity must be a number")
+        top_k = resolve_top_k(top_k, min_similarity)
+        faiss.normalize_L2(query_vectors)
+        batch_results = compute_similarities(dataset["index"], query_vectors, top_k, min_similarity)
+        response = []
+        sequence_positions = dataset["sequence_positions"]
+        for label, (rows, similarities) in zip(labels, batch_results):
+            # Rows of HDF5 stores are reported at the sequence position they were predicted at,
+            # rows of an index with several sources at their position within the source
+            if dataset["sources"] is not None:
+                names, rows, positions = locate_rows(dataset["sources"], rows, dataset["source_positions"])
+                feature_types, descriptions = get_source_annotations(names, positions, dataset["source_features"])
+            else:
+                positions = rows + 1 if sequence_positions is None else sequence_positions[rows]
+                feature_types, descriptions = get_annotations(positions, dataset["features"])
+            hits = [{"position": int(position), "similarity": float(value), "feature_type": feature_type,
+                     "description": description}
+                    for position, value, feature_type, description
+                    in zip(positions, similarities, feature_types, descriptions)]
+            if dataset["sources"] is not None:
+                for hit, name in zip(hits, names):
+                    hit["genome"] = name
+            if sequence_positions is not None or dataset["sources"] is not None:
+                for hit, row in zip(hits, rows):
+                    hit["row"] = int(row) + 1
+            response.append({"query": label, "hits": hits})
+        return {"results": response}
+
+    def extract(self, request):
+        dataset = self.dataset(request)
+        return {"vectors": self.rows(dataset, request["positions"]).tolist()}
+
+    def annotate(self, request):
+        dataset = self.dataset(request)
+        feature_types, descriptions = get_annotations(request["positions"], dataset["features"])
+        return {"annotations": [{"position": int(position), "feature_type": feature_type, "description": description}
+                                for position, feature_type, description
+                                in zip(request["positions"], feature_types, descriptions)]}
+
+    def reload(self, request):
+        names = [request["dataset"]] if "dataset" in request else list(self.dataset_paths)
+        for name in names:
+            if name not in self.dataset_paths:
+                raise ValueError(f"Unknown dataset: {name}")
+            # Load outside of the lock so running requests are not blocked
+            dataset = load_dataset(self.dataset_paths[name])
+            with self.lock:
+                self.datasets[name] = dataset
+        return {"reloaded": names}
+
+def make_handler(service):
+    """
+    Create the HTTP request handler serving JSON requests to the given service.
+    """
+    routes = {
+        "/status": service.status,
+        "/search": service.search,
+        "/extract": service.extract,
+        "/annotate": service.annotate,
+        "/reload": service.reload,
+    }
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        def respond(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_request(self, request):
+            if self.path not in routes:
+                self.respond(404, {"error": f"Unknown endpoint: {self.path}"})
+                return
+            try:
+                self.respond(200, routes[self.path](request))
+            except (KeyError, ValueError, TypeError) as e:
+                self.respond(400, {"error": str(e)})
+            except Exception as e:
+                # Errors of faiss or the state stores are answered instead of dropping the connection
+                self.respond(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def do_GET(self):
+            self.handle_request({})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except json.JSONDecodeError as e:
+                self.respond(400, {"error": f"Invalid JSON: {e}"})
+                return
+            if not isinstance(request, dict):
+                self.respond(400, {"error": "The request must be a JSON object"})
+                return
+            self.handle_request(request)
+
+        def log_message(self, format, *args):
+            pass
+
+    return SearchHandler
+
+def serve(dataset_paths, host, port):
+    """
+    Load the datasets once and answer requests until interrupted.
+    """
+    service = SearchService(dataset_paths)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Serving {', '.join(dataset_paths)} on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+COLLECTION_MANIFEST = "collection.json"
+COLLECTION_LOCK = ".collection.lock"
+
+def read_collection(collection_dir):
+    """
+    Read the manifest of a collection index, a folder with one index shard per genome.
+    Every shard records its index file, number of rows and the states and GFF files of
+    its genome, so a hit maps to a (genome, position) pair. A folder without manifest
+    is an empty collection.
+    """
+    try:
+        with open(os.path.join(collection_dir, COLLECTION_MANIFEST), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"dimension": None, "shards": {}}
+
+def write_collection(collection_dir, collection):
+    """
+    Write the manifest under a temporary name and rename it, so searches never read a
+    partial manifest.
+    """
+    tmp_file = os.path.join(collection_dir, f"{COLLECTION_MANIFEST}.{os.getpid()}.tmp")
+    with open(tmp_file, 'w') as file:
+        json.dump(collection, file, indent=2)
+    os.replace(tmp_file, os.path.join(collection_dir, COLLECTION_MANIFEST))
+
+@contextmanager
+def locked_collection(collection_dir):
+    """
+    Hold an exclusive lock on a collection while its manifest is read, changed and
+    written, so concurrent add and drop commands wait for each other instead of
+    dropping each other's shards.
+    """
+    with open(os.path.join(collection_dir, COLLECTION_LOCK), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def add_genome(collection_dir, name, input_file, gff=None, streaming=False, chunk_size=100000, train_size=100000,
+               index_type="ivf-flat", nlist=None, nprobe=None, pq_m=None, metrics=None):
+    """
+    Index the states of one genome as a shard of a collection. Only the new shard is
+    built, the other shards are neither read nor rewritten. A shard of the same name
+    is replaced once the new one is complete.
+
+    Parameters:
+    - collection_dir: Folder of the collection, created if needed.
+    - name: Name of the genome, used as the name of its shard.
+    - input_file: Path to the states file of the genome (CSV, .npy or .h5).
+    - gff: Optional GFF file the hits of this genome are annotated with.
+    - streaming: Build the shard chunk by chunk as in build_index_streaming.
+
+    Returns:
+    - shard: The manifest entry of the shard.
+    """
+    if not name or name.startswith(".") or os.sep in name:
+        raise ValueError(f"Invalid genome name: {name!r}")
+    os.makedirs(collection_dir, exist_ok=True)
+    index_file = os.path.join(collection_dir, f"{name}.index")
+    tmp_file = os.path.join(collection_dir, f".{name}.{os.getpid()}.index")
+    try:
+        if streaming:
+            params = build_index_streaming(input_file, tmp_file, chunk_size, train_size, index_type, nlist, nprobe,
+                                           pq_m, metrics)
+        else:
+            params = build_index(input_file, tmp_file, index_type, nlist, nprobe, pq_m, metrics)
+
+        with locked_collection(collection_dir):
+            collection = read_collection(collection_dir)
+            if collection["dimension"] not in (None, params["dimension"]):
+                raise ValueError(f"The states of {name} have {params['dimension']} columns, "
+                                 f"the collection {collection['dimension']}")
+            os.replace(params_path(tmp_file), params_path(index_file))
+            os.replace(tmp_file, index_file)
+
+            shard = {"index": os.path.basename(index_file), "rows": params["rows"],
+                     "states": os.path.abspath(input_file), "gff": os.path.abspath(gff) if gff else None}
+            collection["dimension"] = params["dimension"]
+            collection["shards"][name] = shard
+            write_collection(collection_dir, collection)
+    finally:
+        for path in (tmp_file, params_path(tmp_file)):
+            if os.path.exists(path):
+                os.remove(path)
+    return shard
+
+def drop_genome(collection_dir, name):
+    """
+    Remove the shard of a genome from a collection. The manifest is updated before the
+    index file is deleted, so running searches never open a missing shard.
+    """
+    if not os.path.isdir(collection_dir):
+        raise ValueError(f"Unknown genome: {name}")
+    with locked_collection(collection_dir):
+        collection = read_collection(collection_dir)
+        if name not in collection["shards"]:
+            raise ValueError(f"Unknown genome: {name}")
+        shard = collection["shards"].pop(name)
+        if not collection["shards"]:
+            collection["dimension"] = None
+        write_collection(collection_dir, collection)
+        index_file = os.path.join(collection_dir, shard["index"])
+        for path in (index_file, params_path(index_file)):
+            if os.path.exists(path):
+                os.remove(path)
+
+def search_collection(collection_dir, query_vectors, top_k=DEFAULT_TOP_K, min_similarity=None, genomes=None, workers=None,
+                      nprobe=None):
+    """
+    Search every shard of a collection for the rows most similar to each normalized
+    query vector. Shards are loaded and searched in parallel threads, each returns its
+    own top_k hits and these are merged into the global top_k.
+
+    Parameters:
+    - genomes: Only search the shards of these genomes, all shards if None.
+    - workers: Number of shards searched at once, one per CPU if None.
+    - nprobe: Override the number of IVF lists visited per query of every shard.
+
+    Returns:
+    - batch_results: One (genomes, rows, similarities) triple of arrays per query,
+      sorted by decreasing similarity.
+    """
+    collection = read_collection(collection_dir)
+    names = list(collection["shards"]) if genomes is None else list(genomes)
+    for name in names:
+        if name not in collection["shards"]:
+            raise ValueError(f"Unknown genome: {name}")
+    if collection["dimension"] is not None and query_vectors.shape[1] != collection["dimension"]:
+        raise ValueError(f"The queries have {query_vectors.shape[1]} columns, the collection {collection['dimension']}")
+
+    def search_shard(name):
+        index = read_index(os.path.join(collection_dir, collection["shards"][name]["index"]), nprobe)
+        return compute_similarities(index, query_vectors, top_k, min_similarity)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        shard_results = list(executor.map(search_shard, names))
+
+    names = np.array(names, dtype=object)
+    batch_results = []
+    for q in range(query_vectors.shape[0]):
+        shards = np.concatenate([np.full(len(results[q][0]), i) for i, results in enumerate(shard_results)] or [[]])
+        rows = np.concatenate([results[q][0] for results in shard_results] or [[]]).astype(np.int64)
+        similarities = np.concatenate([results[q][1] for results in shard_results] or [[]]).astype('float32')
+        top = top_n(similarities, similarities.size if top_k is None else top_k)
+        batch_results.append((names[shards[top].astype(np.int64)], rows[top], similarities[top]))
+    return batch_results
+
+def collection_table(batch_results, gff_files, labels=None, seqid=None, source_positions=None):
+    """
+    Build the annotated result table of a collection search, or of an index with
+    several sources, sorted by query, genome and position.
+
+    Parameters:
+    - batch_results: One (genomes, rows, similarities) triple of arrays per query.
+    - gff_files: The GFF file of every genome, the hits of a genome without one are
+      not annotated. Each file is only parsed if one of its genomes has a hit.
+    - labels: Query labels. If given, a leading Query column is added.
+    - source_positions: The sequence positions of every genome that is an HDF5 store,
+      see load_source_positions. Its hits are labelled with them, see results_table.
+
+    Returns:
+    - table: A DataFrame with the columns Query (optional), Genome, Position,
+      Similarity, Feature Type and Description.
+    """
+    features = {}
+    source_positions = source_positions or {}
+    tables = []
+    for q, (genomes, rows, similarities) in enumerate(batch_results):
+        for genome in np.unique(genomes):
+            gff = gff_files.get(genome)
+            if gff and gff not in features:
+                features[gff] = parse_gff(gff, seqid)
+            hit = genomes == genome
+            table = results_table(rows[hit], similarities[hit], features[gff] if gff else {},
+                                  sequence_positions=source_positions.get(genome))
+            table.insert(0, "Genome", genome)
+            if labels is not None:
+                table.insert(0, "Query", labels[q])
+            tables.append(table)
+    if not tables:
+        columns = ["Genome", "Position", "Similarity", "Feature Type", "Description"]
+        return pd.DataFrame(columns=(["Query"] if labels is not None else []) + columns)
+    table = pd.concat(tables, ignore_index=True)
+    if "Row" in table:
+        # Only HDF5 stores have a Row column, keep it integer with gaps for the other genomes
+        table["Row"] = table["Row"].astype("Int64")
+    return table
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Query tool for indexing, extracting, and searching vectors.")
@@ -170,26 +1112,44 @@ if __name__ == "__main__":
 
     # Indexing parser
     index_parser = subparsers.add_parser('index')
-    index_parser.add_argument("--input", type=str, required=True, help="Path to the input CSV file.")
+    index_parser.add_argument("--input", type=str, required=True, help="Path to the input states file (CSV, .npy or .h5).")
     index_parser.add_argument("--output", type=str, required=True, help="Path to the output index file.")
+    index_parser.add_argument("--append", action="store_true", help="Add the states to the existing --output index with its trained quantizer instead of building a new one.")
+    index_parser.add_argument("--name", type=str, help="Name of the states in the index, reported with the hits of an index with several states files (default: the file name).")
+    index_parser.add_argument("--gff", type=str, help="GFF file the hits of these states are annotated with, recorded with them in the index.")
+    index_parser.add_argument("--drift-threshold", type=float, default=1.5, help="With --append, retrain the index on all of its states files when the quantization residual of the new rows exceeds that of the training rows by this factor.")
     
     # Extracting parser
     extract_parser = subparsers.add_parser('extract')
-    extract_parser.add_argument("--input", type=str, required=True, help="Path to the input CSV file.")
-    extract_parser.add_argument("--position", type=int, required=True, help="Row number to extract.")
+    extract_parser.add_argument("--input", type=str, required=True, help="Path to the input states file (CSV, .npy or .h5).")
+    extract_parser.add_argument("--position", type=int, nargs='+', help="Positions to extract: sequence positions for HDF5 stores with a position dataset, row numbers otherwise.")
+    extract_parser.add_argument("--positions-file", type=str, help="File with one position to extract per line.")
+    extract_parser.add_argument("--range", type=int, nargs=2, metavar=("START", "END"),
+                                help="Extract every position from START to END (inclusive).")
     extract_parser.add_argument("--output", type=str, required=True, help="Path to the output file where vector will be saved.")
     
     # Searching parser
     search_parser = subparsers.add_parser('search')
     search_parser.add_argument("--input", type=str, required=True, help="Path to the index file.")
-    search_parser.add_argument("--query", type=str, required=True, help="Path to the query vector CSV.")
-    search_parser.add_argument("--gff", type=str, help="Path to the GFF file for annotation.")
+    search_parser.add_argument("--query", type=str, help="Path to the query vector CSV, a CSV with one query vector per row or a .npy query matrix.")
+    search_parser.add_argument("--positions", type=int, nargs='+', help="Positions whose state vectors are used as queries, searched in one batch (requires --states). Like the Position of the hits, these are sequence positions for HDF5 stores with a position dataset and row numbers otherwise.")
+    search_parser.add_argument("--positions-file", type=str, help="File with one query position per line (requires --states).")
+    search_parser.add_argument("--states", type=str, help="Path to the states file (CSV, .npy or .h5) the query positions are read from.")
+    search_parser.add_argument("--output-format", choices=OUTPUT_FORMATS, help="Format of the output files, inferred from the extension by default. CSV and TSV are compressed when the name ends in .gz, .bz2, .xz or .zst.")
+    search_parser.add_argument("--nprobe", type=int, help="Override the number of IVF lists visited per query stored with the index.")
+    search_parser.add_argument("--per-query", action="store_true", help="Write one output file per query instead of a single long-format file.")
+    search_parser.add_argument("--gff", type=str, help="Path to the GFF file for annotation. Replaces that recorded with 'index --gff', of the first states file of an index with several.")
+    search_parser.add_argument("--seqid", type=str,
+                               help="Only annotate with the features of this sequence id of a multi-sequence GFF file.")
     search_parser.add_argument("--output", type=str, required=True, help="Path to the output file where results will be saved.")
+    search_parser.add_argument("--top-k", type=int, help=f"Number of most similar positions to return (default: {DEFAULT_TOP_K}, or every position above --min-similarity).")
+    search_parser.add_argument("--min-similarity", type=float, help="Only return positions with a similarity above this threshold (range search).")
+    search_parser.add_argument("--track", type=str, help="Optional path to write the similarity of every position, needed for 'plot'. Ranks the whole index.")
 
     # Add the "plot" parser
     plot_parser = subparsers.add_parser('plot')
     plot_parser.add_argument("data_file", type=str, help="Path to the data file (CSV).")
-    plot_parser.add_argument("--output", type=str, required=True, help="Path to the output PDF file.")
+    plot_parser.add_argument("--output", type=str, required=True, help="Path to the output PDF file (or .png, .svg).")
 
     # Add the "plotvector" parser
     plotvector_parser = subparsers.add_parser('plotvector')
@@ -198,61 +1158,292 @@ if __name__ == "__main__":
 
     # Add the "plotsim" parser
     plotsim_parser = subparsers.add_parser('plotsim')
-    plotsim_parser.add_argument("--input", type=str, required=True, help="Path to the search output file (CSV).")
-    plotsim_parser.add_argument("--states", type=str, required=True, help="Path to the data file (CSV) containing all vectors.")
-    plotsim_parser.add_argument("--output", type=str, required=True, help="Path to the output PDF file.")
+    plotsim_parser.add_argument("--input", type=str, required=True, help="Path to the --track output of search (CSV). The random vectors and the overview are drawn from its rows, a top-k output only holds the hits.")
+    plotsim_parser.add_argument("--states", type=str, required=True, help="Path to the states file (CSV, .npy or .h5) containing all vectors.")
+    plotsim_parser.add_argument("--output", type=str, required=True, help="Path to the output PDF file (or .png, .svg).")
+    for track_parser in (plot_parser, plotsim_parser):
+        track_parser.add_argument("--downsample", choices=DOWNSAMPLE_METHODS, default="minmax",
+                                  help="Reduce the similarity track to the output resolution. minmax keeps every peak, "
+                                       "lttb keeps the shape of the line.")
+        track_parser.add_argument("--dpi", type=int, default=300, help="Output resolution the track is downsampled to.")
+        track_parser.add_argument("--rasterize", action="store_true",
+                                  help="Draw the track as an embedded image, keeps PDFs of dense tracks small.")
+        track_parser.add_argument("--query", type=str, help="Query to plot of the output of a batch search, as in its Query column.")
+
+    # Add the "convert" parser
+    convert_parser = subparsers.add_parser('convert')
+    convert_parser.add_argument("--input", type=str, required=True, help="Path to the input states file (CSV, .npy or .h5).")
+    convert_parser.add_argument("--output", type=str, required=True, help="Path to the output states file, .npy for the binary store, .h5 for the compressed HDF5 store or .csv for CSV export.")
+
+    # Add the "collection" parser, one index shard per genome
+    collection_parser = subparsers.add_parser('collection')
+    collection_subparsers = collection_parser.add_subparsers(dest="collection_command", required=True)
+    collection_add_parser = collection_subparsers.add_parser('add', help="Index the states of a genome as a new shard, or replace its shard.")
+    collection_add_parser.add_argument("--name", type=str, required=True, help="Name of the genome.")
+    collection_add_parser.add_argument("--input", type=str, required=True, help="Path to the states file (CSV, .npy or .h5) of the genome.")
+    collection_add_parser.add_argument("--gff", type=str, help="GFF file the hits of this genome are annotated with.")
+    collection_drop_parser = collection_subparsers.add_parser('drop', help="Remove the shard of a genome.")
+    collection_drop_parser.add_argument("--name", type=str, required=True, help="Name of the genome.")
+    collection_list_parser = collection_subparsers.add_parser('list', help="List the genomes of the collection.")
+    collection_search_parser = collection_subparsers.add_parser('search', help="Search every genome and merge the global top hits.")
+    collection_search_parser.add_argument("--query", type=str, help="Path to the query vector CSV, a CSV with one query vector per row or a .npy query matrix.")
+    collection_search_parser.add_argument("--genome", type=str, help="Genome of the collection whose states the query positions are read from.")
+    collection_search_parser.add_argument("--positions", type=int, nargs='+', help="Positions of --genome whose state vectors are used as queries, sequence positions if its states are an HDF5 store.")
+    collection_search_parser.add_argument("--positions-file", type=str, help="File with one query position of --genome per line.")
+    collection_search_parser.add_argument("--genomes", type=str, nargs='+', help="Only search these genomes (default: all).")
+    collection_search_parser.add_argument("--top-k", type=int, help=f"Number of most similar positions to return over all genomes (default: {DEFAULT_TOP_K}, or every position above --min-similarity).")
+    collection_search_parser.add_argument("--min-similarity", type=float, help="Only return positions with a similarity above this threshold.")
+    collection_search_parser.add_argument("--nprobe", type=int, help="Override the number of IVF lists visited per query stored with every shard.")
+    collection_search_parser.add_argument("--workers", type=int, help="Number of shards searched in parallel (default: one per CPU).")
+    collection_search_parser.add_argument("--output", type=str, required=True, help="Path to the output file where results will be saved.")
+    collection_search_parser.add_argument("--output-format", choices=OUTPUT_FORMATS, help="Format of the output file, inferred from the extension by default.")
+    for collection_command_parser in (collection_add_parser, collection_drop_parser, collection_list_parser,
+                                      collection_search_parser):
+        collection_command_parser.add_argument("--collection", type=str, required=True, help="Folder of the collection index.")
+        add_metrics_arguments(collection_command_parser)
+
+    for build_parser in (index_parser, collection_add_parser):
+        build_parser.add_argument("--streaming", action="store_true", help="Build the index chunk by chunk with bounded memory, for states larger than RAM.")
+        build_parser.add_argument("--chunk-size", type=int, default=100000, help="Rows read and added per chunk in streaming mode.")
+        build_parser.add_argument("--train-size", type=int, default=100000, help="Rows sampled to train the quantizer in streaming mode.")
+        build_parser.add_argument("--index-type", choices=INDEX_TYPES, default="ivf-flat", help="Index type: exact flat, IVF with flat, PQ, OPQ+PQ, int8 or float16 scalar-quantized lists, or HNSW.")
+        build_parser.add_argument("--nlist", type=int, help="Number of IVF lists. Derived from the number of rows by default.")
+        build_parser.add_argument("--nprobe", type=int, help="Number of IVF lists visited per query. Derived from nlist by default.")
+        build_parser.add_argument("--pq-m", type=int, help="Number of PQ sub-quantizers, must divide the dimension.")
+
+    # Add the "serve" parser
+    serve_parser = subparsers.add_parser('serve')
+    serve_parser.add_argument("--index", type=str, action="append", required=True, help="Index to serve as NAME=PATH, can be repeated. The name defaults to the file name.")
+    serve_parser.add_argument("--states", type=str, action="append", help="States file (CSV, .npy or .h5) of an index as NAME=PATH, needed for position queries and extract. Positions of HDF5 stores are sequence positions.")
+    serve_parser.add_argument("--gff", type=str, action="append", help="GFF file of an index as NAME=PATH for annotation.")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    serve_parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+
+    for command_parser in (index_parser, extract_parser, search_parser, plot_parser, plotvector_parser,
+                           plotsim_parser, convert_parser):
+        add_metrics_arguments(command_parser)
 
     args = parser.parse_args()
+    metrics = Metrics(f"vectorsearch {args.command}")
 
     if args.command == "index":
-        build_index(args.input, args.output)
+        names = [args.name] if args.name else None
+        gffs = [args.gff] if args.gff else None
+        if args.append:
+            if not os.path.exists(args.output):
+                index_parser.error(f"--append requires an existing index, {args.output} does not exist")
+            try:
+                append_index(args.input, args.output, args.name, args.drift_threshold, args.chunk_size,
+                             args.train_size, args.streaming, metrics, args.gff)
+            except ValueError as e:
+                print(f"Error: {e}")
+                exit(1)
+        elif args.streaming:
+            build_index_streaming(args.input, args.output, args.chunk_size, args.train_size,
+                                  args.index_type, args.nlist, args.nprobe, args.pq_m, metrics, names, gffs)
+        else:
+            build_index(args.input, args.output, args.index_type, args.nlist, args.nprobe, args.pq_m, metrics, names,
+                        gffs)
     elif args.command == "extract":
-        extract_vector(args.input, args.position, args.output)
+        positions = read_positions(args.position, args.positions_file, args.range,
+                                   load_sequence_positions(args.input))
+        if not positions:
+            extract_parser.error("at least one position is required (--position, --positions-file or --range)")
+        try:
+            with metrics.stage("extract", rows=len(positions)):
+                extract_vectors(args.input, positions, args.output)
+        except ValueError as e:
+            print(f"Error: {e}")
+            exit(1)
+    elif args.command == "convert":
+        with metrics.stage("convert") as stage:
+            rows, columns = convert_states(args.input, args.output)
+            stage["rows"] = rows
+        print(f"Converted state matrix ({rows} rows and {columns} columns) to {args.output}")
     
     if args.command == "plotvector":
-        plot_vector(args.vector_file, args.output)
+        with metrics.stage("plot"):
+            plot_vector(args.vector_file, args.output)
 
     elif args.command == "plot":
-        plot(args.data_file, args.output)
+        try:
+            with metrics.stage("plot"):
+                plot(args.data_file, args.output, args.downsample, args.dpi, args.rasterize, args.query)
+        except ValueError as e:
+            print(f"Error: {e}")
+            exit(1)
 
     if args.command == "plotsim":
-        plot_similar_vectors(args.input, args.states, args.output)
+        try:
+            with metrics.stage("plot"):
+                plot_similar_vectors(args.input, args.states, args.output, args.downsample, args.dpi, args.rasterize,
+                                     args.query)
+        except ValueError as e:
+            print(f"Error: {e}")
+            exit(1)
 
     elif args.command == "search":
+        positions = read_positions(args.positions, args.positions_file)
+        if not args.query and not positions:
+            parser.error("search requires --query or query positions")
+        if positions and not args.states:
+            parser.error("query positions require --states")
+
         # Load the saved index
-        index = faiss.read_index(args.input)
-        # Load the query vector
-        query_vector = pd.read_csv(args.query, header=0)["Value"].values.reshape(1, -1).astype('float32')
-        faiss.normalize_L2(query_vector)
+        with metrics.stage("load index") as stage:
+            index = read_index(args.input, args.nprobe)
+            stage["rows"] = index.ntotal
+        # Load the query vectors
+        with metrics.stage("load queries") as stage:
+            try:
+                query_vectors, labels = load_queries(args.query, args.states, positions)
+            except ValueError as e:
+                print(f"Error: {e}")
+                exit(1)
+            stage["rows"] = len(labels)
         
-        # Compute similarities
-        results = compute_similarity(index, query_vector)
+        # Compute similarities for all queries in one batch
+        with metrics.stage("search", rows=len(labels)):
+            batch_results = compute_similarities(index, query_vectors, resolve_top_k(args.top_k, args.min_similarity),
+                                                 args.min_similarity)
+
+        # Hits of an index with several states files are reported by source and position within it
+        sources = read_params(args.input).get("sources", [])
+        multiple_sources = len(sources) > 1
 
-        # If GFF file is provided, parse it
+        # Parse the GFF file, or that recorded for every states file of the index
+        gff_files = source_gff_files(sources, args.gff) if sources else {"": args.gff}
         features = {}
-        if args.gff:
-            features = parse_gff(args.gff)
-
-        # Print the top 5 results to the screen without sorting
-        print("\nTop 30 Similarities:")
-        for position, value in results[:30]:
-            rounded_value = round(value, 2)
-            feature_type, description = get_annotation(position+1, features)
-            annotation = ""
-            if feature_type != "NA":
-                annotation = f" | {feature_type} (product={description})"
+        if any(gff_files.values()):
+            with metrics.stage("annotation") as stage:
+                source_features = load_source_features(gff_files, args.seqid)
+                features = next(iter(source_features.values()))
+                stage["rows"] = sum(len(source["start"]) for source in source_features.values() if source)
+        # Rows of HDF5 stores are labelled with the sequence position they were predicted at
+        if multiple_sources:
+            source_positions = load_source_positions(sources)
+        else:
+            states_file = sources[0]["states"] if sources else args.states
+            sequence_positions = load_sequence_positions(states_file)
+
+        # Print the top results to the screen, fewer per query for batches
+        n_top = 30 if len(labels) == 1 else 5
+        for label, (rows, similarities) in zip(labels, batch_results):
+            if len(labels) == 1:
+                print(f"\nTop {n_top} Similarities:")
+            else:
+                print(f"\nTop {n_top} Similarities for query {label}:")
+            top = top_n(similarities, n_top)
+            if multiple_sources:
+                names, _, hit_positions = locate_rows(sources, rows[top], source_positions)
+            else:
+                names = [""] * len(top)
+                hit_positions = rows[top] + 1 if sequence_positions is None else sequence_positions[rows[top]]
+            if multiple_sources:
+                annotations = np.empty(len(top), dtype=object)
+                for name in np.unique(names):
+                    in_source = names == name
+                    annotations[in_source] = describe_positions(hit_positions[in_source], source_features[name])
             else:
-                annotation = " (no overlapping feature)"
+                annotations = describe_positions(hit_positions, features)
+            for name, position, value, annotation in zip(names, hit_positions, similarities[top], annotations):
+                rounded_value = round(float(value), 2)
+                prefix = f"{name} position" if name else "Position"
+                print(f"{prefix} {position} ({rounded_value}){annotation}")
+
+        def write_hits(batch, output_file):
+            # Hits and the track are written alike, by source for indexes with several of them
+            if multiple_sources:
+                source_results = [(*map_to_sources(sources, rows), similarities) for rows, similarities in batch]
+                if args.per_query and len(labels) > 1:
+                    for label, results in zip(labels, source_results):
+                        write_table(collection_table([results], gff_files, seqid=args.seqid,
+                                                     source_positions=source_positions),
+                                    per_query_path(output_file, label), args.output_format)
+                else:
+                    write_table(collection_table(source_results, gff_files, labels if len(labels) > 1 else None,
+                                                 args.seqid, source_positions), output_file, args.output_format)
+            elif len(labels) == 1:
+                write_results(batch[0], features, output_file, output_format=args.output_format,
+                              sequence_positions=sequence_positions)
+            elif args.per_query:
+                for label, results in zip(labels, batch):
+                    write_results(results, features, per_query_path(output_file, label), output_format=args.output_format,
+                                  sequence_positions=sequence_positions)
+            else:
+                write_results(batch, features, output_file, labels, args.output_format, sequence_positions)
+
+        with metrics.stage("write", rows=sum(len(rows) for rows, _ in batch_results)):
+            write_hits(batch_results, args.output)
+
+        # The full per-position similarity track is only computed if requested
+        if args.track:
+            with metrics.stage("track", rows=len(labels) * index.ntotal):
+                batch_track = [compute_track(index, query_vector.reshape(1, -1)) for query_vector in query_vectors]
+            write_hits(batch_track, args.track)
+
+    elif args.command == "collection":
+        try:
+            if args.collection_command == "add":
+                shard = add_genome(args.collection, args.name, args.input, args.gff, args.streaming, args.chunk_size,
+                                   args.train_size, args.index_type, args.nlist, args.nprobe, args.pq_m, metrics)
+                print(f"Added {args.name} ({shard['rows']} rows) to {args.collection}")
+            elif args.collection_command == "drop":
+                drop_genome(args.collection, args.name)
+                print(f"Dropped {args.name} from {args.collection}")
+            elif args.collection_command == "list":
+                for name, shard in read_collection(args.collection)["shards"].items():
+                    print(f"{name}\t{shard['rows']} rows\t{shard['states']}")
+            else:
+                collection = read_collection(args.collection)
+                positions = read_positions(args.positions, args.positions_file)
+                if not args.query and not positions:
+                    parser.error("collection search requires --query or query positions")
+                if positions and args.genome not in collection["shards"]:
+                    parser.error("query positions require the --genome of the collection they are read from")
+                with metrics.stage("load queries") as stage:
+                    states_file = collection["shards"][args.genome]["states"] if positions else None
+                    query_vectors, labels = load_queries(args.query, states_file, positions)
+                    stage["rows"] = len(labels)
+                with metrics.stage("search", rows=len(labels)):
+                    top_k = resolve_top_k(args.top_k, args.min_similarity)
+                    batch_results = search_collection(args.collection, query_vectors, top_k, args.min_similarity,
+                                                      args.genomes, args.workers, args.nprobe)
+                with metrics.stage("annotation") as stage:
+                    # Only the positions of genomes with hits are loaded
+                    hit_genomes = set(np.concatenate([genomes for genomes, _, _ in batch_results] or [[]]))
+                    source_positions = load_source_positions([dict(shard, name=name) for name, shard
+                                                              in collection["shards"].items() if name in hit_genomes])
+                    gff_files = {name: shard["gff"] for name, shard in collection["shards"].items()}
+                    table = collection_table(batch_results, gff_files, labels if len(labels) > 1 else None,
+                                             source_positions=source_positions)
+                    stage["rows"] = len(table)
+
+                # Print the best hits of every query, at the positions of the output
+                n_top = 30 if len(labels) == 1 else 5
+                for label, (genomes, rows, similarities) in zip(labels, batch_results):
+                    print(f"\nTop {n_top} Similarities:" if len(labels) == 1 else f"\nTop {n_top} Similarities for query {label}:")
+                    for genome, row, value in zip(genomes[:n_top], rows[:n_top], similarities[:n_top]):
+                        sequence_positions = source_positions[genome]
+                        position = row + 1 if sequence_positions is None else sequence_positions[row]
+                        print(f"{genome} position {position} ({round(float(value), 2)})")
 
-            print(f"Position {position + 1} ({rounded_value}){annotation}")
+                with metrics.stage("write", rows=len(table)):
+                    write_table(table, args.output, args.output_format)
+        except ValueError as e:
+            print(f"Error: {e}")
+            exit(1)
 
-        # Sort results based on row number (position) for writing to file
-        sorted_results = sorted(results, key=lambda x: x[0])
+    elif args.command == "serve":
+        try:
+            index_paths = parse_named_paths(args.index)
+            states_paths = parse_named_paths(args.states, list(index_paths))
+            gff_paths = parse_named_paths(args.gff, list(index_paths))
+        except ValueError as e:
+            parser.error(str(e))
+        dataset_paths = {name: {"index": path, "states": states_paths.get(name), "gff": gff_paths.get(name)}
+                         for name, path in index_paths.items()}
+        serve(dataset_paths, args.host, args.port)
 
-        # Write all results to the output file with added annotations
-        with open(args.output, 'w') as file:
-            file.write("Position,Similarity,Feature Type,Description\n")  # Header line
-            for position, value in sorted_results:
-                feature_type, description = get_annotation(position+1, features)
-                description = description.replace(",", ";")
-                file.write(f"{position + 1},{value},{feature_type},{description}\n")
\ No newline at end of file
+    if args.command != "serve" and args.command is not None:
+        metrics.report(args.profile, args.metrics_json)
@@ -5,11 +5,16 @@ wget -P $PREFIX/lib/virusnet https://f000.backblazeb2.com/file/genomenet/models/
 wget -P $PREFIX/lib/virusnet https://f000.backblazeb2.com/file/genomenet/models/virus_genus_2023-01-23_labels.rds
 
 mkdir -p $PREFIX/bin
+# Helper modules and R scripts, kept apart from those of the other packages
+mkdir -p $PREFIX/share/virusnet-gpu
 
 # Install the Python script
 echo "Installing the scripts..."
 cp $SRC_DIR/virusnet.py $PREFIX/bin/virusnet
-cp $SRC_DIR/predict.r $PREFIX/bin/predict.r
+cp $SRC_DIR/predict.r $PREFIX/share/virusnet-gpu/predict.r
+cp $SRC_DIR/r_worker.py $PREFIX/share/virusnet-gpu/r_worker.py
+cp $SRC_DIR/metrics.py $PREFIX/share/virusnet-gpu/metrics.py
+cp $SRC_DIR/fasta_shards.py $PREFIX/share/virusnet-gpu/fasta_shards.py
 
 # Make the script executable
 chmod +x $PREFIX/bin/virusnet
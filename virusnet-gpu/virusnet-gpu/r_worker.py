@@ -0,0 +1,117 @@
+import json
+import os
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+
+# Prefix of the status lines the R worker writes to stdout after each job
+MARKER = "@@worker"
+
+def job_line(options):
+    """
+    Turn the options of a job into the tab-separated command line the R script parses
+    with optparse, e.g. {'batch_size': 32} into '--batch_size\\t32'.
+    """
+    args = []
+    for key, value in options.items():
+        if value is None:
+            continue
+        args += [f"--{key}", str(value)]
+    return "\t".join(args)
+
+class RWorker:
+    """
+    A persistent Rscript process that loads its model once and then runs jobs sent over
+    stdin, one command line per job, until it is closed.
+    """
+
+    def __init__(self, command, env=None):
+        """
+        Parameters:
+        - command: The Rscript command line, including the options fixed for the
+          worker such as the model. '--worker' is appended.
+        - env: Environment of the R process.
+        """
+        self.process = subprocess.Popen(command + ["--worker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        text=True, env=env)
+        self.lock = threading.Lock()
+        # Wait until the model is loaded
+        self.read_status()
+
+    def read_status(self):
+        # Forward the regular output of the R process until its next status line
+        for line in self.process.stdout:
+            if line.startswith(MARKER):
+                status, _, message = line[len(MARKER):].strip().partition(" ")
+                if status == "error":
+                    raise RuntimeError(message)
+                return status
+            sys.stdout.write(line)
+        raise RuntimeError(f"The R worker exited with code {self.process.wait()}")
+
+    def run(self, **options):
+        """
+        Run one job with the given command line options. Jobs are run one at a time.
+        """
+        with self.lock:
+            self.process.stdin.write(job_line(options) + "\n")
+            self.process.stdin.flush()
+            return self.read_status()
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.stdin.close()
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def serve(worker, socket_path):
+    """
+    Accept jobs for a worker on a local Unix socket until interrupted. Each request is
+    one JSON object of job options, answered with {"status": "done"} or
+    {"status": "error", "message": ...}.
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            options = json.loads(self.rfile.readline())
+            try:
+                worker.run(**options)
+                reply = {"status": "done"}
+            except RuntimeError as e:
+                reply = {"status": "error", "message": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+    # Clean up the socket and the R process on kill as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Worker ready, listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+        worker.close()
+
+def submit(socket_path, **options):
+    """
+    Send a job to a worker started with serve and wait until it is done. Paths are
+    resolved by the worker, so they should be absolute.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(options) + "\n").encode())
+        with client.makefile('r') as reply_file:
+            reply = json.loads(reply_file.readline())
+    if reply["status"] == "error":
+        raise RuntimeError(reply["message"])
@@ -24,7 +24,15 @@ option_list <- list(
   make_option(c("-s", "--step"), type = "integer", default = 1000,
               help = "Step size to iterate through sequences [default %default].", metavar = "number"),
   make_option(c("-b", "--batch_size"), type = "integer", default = 32,
-              help = "Number of samples processed in one batch [default %default].", metavar = "number")
+              help = "Number of samples processed in one batch [default %default].", metavar = "number"),
+  make_option(c("-a", "--aggregate"), type = "character", default = "mean",
+              help = "Aggregate the windows of each FASTA record by mean or max, or write every window (window) [default %default]."),
+  make_option(c("-k", "--top_k"), type = "integer", default = 0,
+              help = "Only write the k best genera of each record instead of all of them, 0 for all [default %default].", metavar = "number"),
+  make_option(c("--metrics"), type = "character", default = NULL,
+              help = "Append the wall time, rows, bases and peak memory of every stage to this file."),
+  make_option(c("--worker"), action = "store_true", default = FALSE,
+              help = "Keep the model loaded and run jobs read from stdin, one tab-separated command line per line.")
 )
 
 # Parse command line arguments
@@ -34,6 +42,7 @@ opt <- parse_args(opt_parser)
 # Functions
 predict_and_write <- function(opt, model, genus_labels, tmp_file) {
   if (!file.exists(opt$input)) stop("Input file not found")
+  started <- proc.time()[["elapsed"]]
   pred <- predict_model(
     output_format = "one_seq",
     model = model,
@@ -50,10 +59,14 @@ predict_and_write <- function(opt, model, genus_labels, tmp_file) {
     filename = tmp_file
   )
 
+  write_metric(opt$metrics, "inference", elapsed(started), rows = nrow(pred$states))
+
+  started <- proc.time()[["elapsed"]]
   df <- data.frame(pred$states)
   names(df) <- genus_labels
   write.table(df, file = opt$output, sep = "\t",
   row.names = FALSE, quote = FALSE)
+  write_metric(opt$metrics, "write", elapsed(started), rows = nrow(df))
 
   # Validate the prediction DataFrame
   if (is.null(df) || nrow(df) == 0) {
@@ -62,6 +75,151 @@ predict_and_write <- function(opt, model, genus_labels, tmp_file) {
   return(df)
 }
 
+for_each_record <- function(path, callback, block_size = 100000) {
+  # Stream a FASTA file and call callback(header, sequence) for each record, so
+  # only one record is held in memory
+  con <- file(path, "r")
+  on.exit(close(con), add = TRUE)
+  header <- NULL
+  lines_of_record <- character(0)
+  emit <- function() {
+    if (!is.null(header)) callback(header, gsub("\\s", "", paste0(lines_of_record, collapse = "")))
+  }
+  while (length(lines <- readLines(con, n = block_size)) > 0) {
+    starts <- which(startsWith(lines, ">"))
+    ends <- c(starts[-1] - 1, length(lines))
+    # Lines before the first header continue the record of the previous block
+    continued <- if (length(starts) > 0) starts[1] - 1 else length(lines)
+    lines_of_record <- c(lines_of_record, lines[seq_len(continued)])
+    for (i in seq_along(starts)) {
+      emit()
+      header <- substring(lines[starts[i]], 2)
+      lines_of_record <- lines[seq.int(starts[i] + 1, length.out = ends[i] - starts[i])]
+    }
+  }
+  emit()
+}
+
+aggregate_windows <- function(states, method) {
+  states <- as.matrix(states)
+  if (method == "max") apply(states, 2, max) else colMeans(states)
+}
+
+record_row <- function(id, length, windows, scores, top_k) {
+  row <- data.frame(contig = id, length = length, windows = windows)
+  if (top_k > 0) {
+    top <- order(scores, decreasing = TRUE)[seq_len(min(top_k, length(scores)))]
+    for (i in seq_along(top)) {
+      row[[paste0("genus_", i)]] <- names(scores)[top[i]]
+      row[[paste0("score_", i)]] <- round(scores[[top[i]]], 4)
+    }
+    return(row)
+  }
+  cbind(row, as.data.frame(as.list(round(scores, 4)), check.names = FALSE))
+}
+
+predict_records <- function(opt, model, genus_labels, tmp_file) {
+  # Predict the FASTA records one at a time and append one row per record to the
+  # output as soon as it is predicted
+  if (!file.exists(opt$input)) stop("Input file not found")
+  if (!opt$aggregate %in% c("mean", "max")) stop(paste("Unknown aggregation:", opt$aggregate))
+  if (file.exists(opt$output)) invisible(file.remove(opt$output))
+  record_file <- tempfile(fileext = ".fasta")
+  on.exit(if (file.exists(record_file)) invisible(file.remove(record_file)), add = TRUE)
+
+  records <- 0
+  windows <- 0
+  bases <- 0
+  inference_seconds <- 0
+  write_seconds <- 0
+  started <- proc.time()[["elapsed"]]
+  for_each_record(opt$input, function(header, sequence) {
+    id <- sub("\\s.*", "", header)
+    if (nchar(sequence) == 0) {
+      message(paste0("Skipping empty record ", id))
+      return(invisible())
+    }
+    inference_started <- proc.time()[["elapsed"]]
+    writeLines(c(paste0(">", header), sequence), record_file)
+    if (file.exists(tmp_file)) invisible(file.remove(tmp_file))
+    pred <- predict_model(
+      output_format = "one_seq",
+      model = model,
+      layer_name = "dense_3",
+      path_input = record_file,
+      round_digits = 4,
+      step = opt$step,
+      batch_size = opt$batch_size,
+      verbose = FALSE,
+      return_states = TRUE,
+      padding = "standard",
+      mode = "label",
+      format = "fasta",
+      filename = tmp_file
+    )
+    scores <- aggregate_windows(pred$states, opt$aggregate)
+    names(scores) <- genus_labels
+    inference_seconds <<- inference_seconds + elapsed(inference_started)
+
+    write_started <- proc.time()[["elapsed"]]
+    row <- record_row(id, nchar(sequence), nrow(pred$states), scores, opt$top_k)
+    write.table(row, file = opt$output, sep = "\t", row.names = FALSE, quote = FALSE,
+                append = records > 0, col.names = records == 0)
+    write_seconds <<- write_seconds + elapsed(write_started)
+    records <<- records + 1
+    windows <<- windows + nrow(pred$states)
+    bases <<- bases + nchar(sequence)
+    best <- which.max(scores)
+    message(paste0("Predicted ", id, " as ", genus_labels[best], " (", round(scores[[best]] * 100, digits = 1), "%)"))
+  })
+
+  if (records == 0) {
+    stop("Prediction failed. No FASTA records were predicted.")
+  }
+  # Reading the records is what remains of the streaming loop
+  write_metric(opt$metrics, "fasta parse", elapsed(started) - inference_seconds - write_seconds,
+               rows = records, bases = bases)
+  write_metric(opt$metrics, "inference", inference_seconds, rows = windows, bases = bases)
+  write_metric(opt$metrics, "write", write_seconds, rows = records)
+  return(records)
+}
+
+peak_rss_mb <- function() {
+  # Peak resident memory of the R process, from /proc on Linux
+  status <- tryCatch(readLines("/proc/self/status"), error = function(e) character(0))
+  hwm <- grep("^VmHWM:", status, value = TRUE)
+  if (length(hwm) == 0) return(NA)
+  as.numeric(gsub("[^0-9]", "", hwm)) / 1024
+}
+
+write_metric <- function(file, stage, seconds, rows = NA, bases = NA) {
+  # One tab-separated line per stage, collected by the Python wrapper for --profile
+  if (is.null(file)) return(invisible(NULL))
+  cat(paste(stage, round(seconds, 4), rows, bases, round(peak_rss_mb(), 1), sep = "\t"), "\n",
+      sep = "", file = file, append = TRUE)
+}
+
+elapsed <- function(since) proc.time()[["elapsed"]] - since
+
+serve_jobs <- function(opt_parser, run_job) {
+  # Status lines on stdout tell the Python wrapper when the worker is ready and
+  # when each job is done, the messages of the jobs go to stderr
+  con <- file("stdin")
+  open(con)
+  on.exit(close(con), add = TRUE)
+  cat("@@worker ready\n")
+  flush(stdout())
+  while (length(line <- readLines(con, n = 1)) > 0) {
+    status <- tryCatch({
+      job <- parse_args(opt_parser, args = strsplit(line, "\t", fixed = TRUE)[[1]])
+      run_job(job)
+      "@@worker done"
+    }, error = function(e) paste("@@worker error", gsub("\n", " ", conditionMessage(e))))
+    cat(status, "\n", sep = "")
+    flush(stdout())
+  }
+}
+
 print_top_predictions <- function(df) {
   # aggregate
   agg <- colMeans(df)
@@ -76,28 +234,43 @@ print_top_predictions <- function(df) {
 # Define paths
 model_path <- paste0(Sys.getenv("CONDA_PREFIX"), "/lib/virusnet/virus_genus_2023-01-23.hdf5")
 annotation_path <- paste0(Sys.getenv("CONDA_PREFIX"), "/lib/virusnet/virus_genus_2023-01-23_labels.rds")
-tmp_file <- tempfile(fileext = ".h5")
-
 # Validate the model and annotation paths
 if (!file.exists(model_path)) stop("Model file not found")
 if (!file.exists(annotation_path)) stop("Annotation file not found")
 
 # Load model and annotations
 message("Loading model and processing file")
+load_started <- proc.time()[["elapsed"]]
 if (!file.exists(model_path)) stop("Model file not found")
 model <- keras::load_model_hdf5(model_path, compile = FALSE)
 
 message("Loading annotations")
 if (!file.exists(annotation_path)) stop("Annotation file not found")
 genus_labels <- readRDS(annotation_path)
+write_metric(opt$metrics, "model load", elapsed(load_started))
 
-# Predict
-message("Predicting sequence")
-pred <- predict_and_write(opt, model, genus_labels, tmp_file)
+run_job <- function(opt) {
+  tmp_file <- tempfile(fileext = ".h5")
+  on.exit(if (file.exists(tmp_file)) invisible(file.remove(tmp_file)), add = TRUE)
 
-# Display top 5 predictions
-print_top_predictions(pred)
+  if (opt$aggregate == "window") {
+    # Predict
+    message("Predicting sequence")
+    pred <- predict_and_write(opt, model, genus_labels, tmp_file)
+
+    # Display top 5 predictions
+    print_top_predictions(pred)
+  } else {
+    message("Predicting records")
+    records <- predict_records(opt, model, genus_labels, tmp_file)
+    message(paste0("Predicted ", records, " records"))
+  }
 
-# Cleanup
-invisible(file.remove(tmp_file))
-message(paste0("Wrote predictions to ", opt$output))
+  message(paste0("Wrote predictions to ", opt$output))
+}
+
+if (opt$worker) {
+  serve_jobs(opt_parser, run_job)
+} else {
+  run_job(opt)
+}
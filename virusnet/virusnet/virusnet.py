@@ -1,26 +1,153 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import shutil
 import subprocess
 import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
-def run_prediction(model='genus', input='test.fasta', output='prediction.csv', step=1000, batch_size=32):
+import numpy as np
+
+# The conda recipe installs the helper modules and R scripts into share/virusnet, so
+# they do not clash with those of other packages in $PREFIX/bin. In the source tree
+# they are next to this script.
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "share", "virusnet")
+if not os.path.isdir(PACKAGE_DIR):
+    PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, PACKAGE_DIR)
+
+from fasta_shards import split_fasta
+from metrics import Metrics, add_metrics_arguments, r_metrics_file
+from r_worker import RWorker, serve, submit
+
+# Define the path to your R script
+R_SCRIPT_PATH = os.path.join(PACKAGE_DIR, "predict.r")
+
+AGGREGATIONS = ["mean", "max", "window"]
+
+def start_worker(env=None):
+    """
+    Start a persistent R process with the model loaded. Pass it to run_prediction to
+    predict many files without loading R, TensorFlow and the model again.
+    """
+    return RWorker(["Rscript", R_SCRIPT_PATH], env=env)
+
+def run_prediction(model='genus', input='test.fasta', output='prediction.csv', step=1000, batch_size=32, env=None,
+                   worker=None, aggregate='mean', top_k=0, metrics=None):
     """
     Function to run the R script for virus prediction using the specified arguments.
+    The job is sent to `worker` if given, either a worker from start_worker or the
+    socket path of a running `virusnet --serve`.
+
+    By default one row is written per FASTA record, with the mean (or max) of its
+    windows, as soon as the record is predicted. aggregate='window' writes the
+    prediction of every window instead, and top_k > 0 only keeps the k best genera
+    of each record. The stage timings of the R script are added to `metrics` if given.
     """
+    with r_metrics_file(metrics, input=os.path.basename(input)) as metrics_file:
+        if isinstance(worker, RWorker):
+            return worker.run(input=input, output=output, step=step, batch_size=batch_size, aggregate=aggregate,
+                              top_k=top_k, metrics=metrics_file)
+        if worker is not None:
+            return submit(worker, input=os.path.abspath(input), output=os.path.abspath(output), step=step,
+                          batch_size=batch_size, aggregate=aggregate, top_k=top_k, metrics=metrics_file)
 
-    # Define the path to your R script
-    r_script_path = os.path.join(os.path.dirname(__file__), "predict.r")
+        # Define the command that you would use to run the R script from the command line
+        command = ["Rscript", R_SCRIPT_PATH,
+                   '--input', input,
+                   '--output', output,
+                   '--step', str(step),
+                   '--batch_size', str(batch_size),
+                   '--aggregate', aggregate,
+                   '--top_k', str(top_k)]
+        if metrics_file:
+            command += ['--metrics', metrics_file]
 
-    # Define the command that you would use to run the R script from the command line
-    command = ["Rscript", r_script_path, 
-               '--input', input,
-               '--output', output,
-               '--step', str(step),
-               '--batch_size', str(batch_size)]
+        # Run the command
+        return subprocess.run(command, env=env)
+
+def merge_predictions(shard_outputs, output, means=True):
+    """
+    Concatenate the prediction tables of the shards in order, keeping the header of the
+    first one, and return the mean prediction of every label of a per-window table
+    (means=True).
+    """
+    header, total, rows = None, None, 0
+    with open(output, 'w') as out:
+        for shard_output in shard_outputs:
+            with open(shard_output, 'r') as file:
+                shard_header = file.readline()
+                if header is None:
+                    header = shard_header
+                    out.write(header)
+                for line in file:
+                    out.write(line)
+                    if not means:
+                        continue
+                    values = np.array(line.split('\t'), dtype=float)
+                    total = values if total is None else total + values
+                    rows += 1
+    labels = header.rstrip('\n').split('\t')
+    return dict(zip(labels, total / rows)) if rows else {}
 
-    # Run the command
-    subprocess.run(command)
+def print_top_predictions(means):
+    print("Top 5 predictions of the sample:")
+    for label, value in sorted(means.items(), key=lambda item: item[1], reverse=True)[:5]:
+        print(f"Predicted FASTA sample as {label} ({round(value * 100, 1)}%)")
+
+def run_parallel_prediction(input='test.fasta', output='prediction.csv', step=1000, batch_size=32, workers=2,
+                            threads=None, aggregate='mean', top_k=0, metrics=None):
+    """
+    Predict a multi-record FASTA file with several R processes in parallel.
+
+    The records are split into balanced shards of consecutive records, one per worker,
+    each shard is predicted by its own Rscript process and the outputs are merged in
+    input order with the same columns as a single run. Per-record rows are the same as
+    those of a single run. With aggregate='window', windows are cut per shard, so next
+    to a shard boundary they can differ from those of a single run.
+
+    Parameters:
+    - workers: Number of parallel R processes.
+    - threads: TensorFlow threads per process, the CPUs divided by workers if None.
+    - metrics: Metrics the split, prediction and merge stages, and the stages of
+      every R process, are recorded in.
+    """
+    metrics = metrics or Metrics()
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    env = dict(os.environ,
+               TF_NUM_INTRAOP_THREADS=str(threads),
+               TF_NUM_INTEROP_THREADS="1",
+               OMP_NUM_THREADS=str(threads))
+
+    shard_dir = tempfile.mkdtemp(prefix="virusnet_")
+    try:
+        with metrics.stage("split") as stage:
+            shards = split_fasta(input, workers, shard_dir)
+            stage["rows"] = len(shards)
+        shard_outputs = [shard[:-len(".fasta")] + ".csv" for shard in shards]
+        print(f"Predicting {len(shards)} shards with {threads} threads each")
+
+        def predict(shard, shard_output):
+            return run_prediction(input=shard, output=shard_output, step=step, batch_size=batch_size, env=env,
+                                  aggregate=aggregate, top_k=top_k, metrics=metrics)
+
+        with metrics.stage("prediction", rows=len(shards)), ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(predict, shards, shard_outputs))
+
+        failed = [shard for shard, result in zip(shards, results) if result.returncode != 0]
+        if failed:
+            raise RuntimeError(f"Prediction failed for {len(failed)} of {len(shards)} shards")
+
+        with metrics.stage("merge"):
+            if aggregate == "window":
+                print_top_predictions(merge_predictions(shard_outputs, output))
+            else:
+                merge_predictions(shard_outputs, output, means=False)
+        print(f"Wrote predictions to {output}")
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
 
 if __name__ == "__main__":
 
@@ -33,7 +160,37 @@ if __name__ == "__main__":
                         help='Step size to iterate though sequences.')
     parser.add_argument('-b', '--batch_size', type=int, default=32,
                         help='Number of samples processed in one batch.')
+    parser.add_argument('-a', '--aggregate', type=str, default='mean', choices=AGGREGATIONS,
+                        help='Write one row per FASTA record with the mean or max of its windows, or one row per window.')
+    parser.add_argument('-k', '--top_k', type=int, default=0,
+                        help='Only write the k best genera of each record, 0 for all (default: 0).')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of parallel prediction processes. Records are split into shards of similar base count. '
+                             'Can not be combined with --worker or --serve.')
+    parser.add_argument('-t', '--threads', type=int,
+                        help='TensorFlow threads per worker (default: CPUs divided by workers).')
+    parser.add_argument('--serve', type=str, metavar='SOCKET',
+                        help='Load the model once and predict the jobs sent to this local socket until interrupted.')
+    parser.add_argument('--worker', type=str, metavar='SOCKET',
+                        help='Send the prediction to the model kept loaded by a running virusnet --serve.')
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
+    # A running --serve has a single model process, it can not split the input into shards
+    if args.workers > 1 and (args.worker or args.serve):
+        parser.error("--workers can not be combined with --worker or --serve")
+    metrics = Metrics("virusnet")
+
+    if args.serve:
+        serve(start_worker(), args.serve)
+    elif args.workers > 1:
+        run_parallel_prediction(input=args.input, output=args.output, step=args.step, batch_size=args.batch_size,
+                                workers=args.workers, threads=args.threads, aggregate=args.aggregate,
+                                top_k=args.top_k, metrics=metrics)
+    else:
+        with metrics.stage("prediction"):
+            run_prediction(input=args.input, output=args.output, step=args.step, batch_size=args.batch_size,
+                           worker=args.worker, aggregate=args.aggregate, top_k=args.top_k, metrics=metrics)
 
-    run_prediction(input=args.input, output=args.output, step=args.step, batch_size=args.batch_size)
+    if not args.serve:
+        metrics.report(args.profile, args.metrics_json)